@@ -0,0 +1,276 @@
+"""
+Admission control for the prediction backend
+
+Limits how much work the backend accepts at once so that a burst of uploads
+degrades into fast rejections instead of unbounded latency for everyone:
+
+- a bounded number of requests are processed concurrently (in-flight limit)
+- a bounded wait queue, ordered by priority lane then arrival
+- deadline-aware rejection: requests that cannot start before their deadline
+  are refused up front with 503 and a Retry-After hint
+- per-client token-bucket rate limiting (429 with Retry-After). Clients are
+  told apart by remote address; an X-Client-ID header is only believed from
+  the proxies in TRUSTED_PROXIES, since anyone else could pick a new one per
+  request. At most `max_clients` buckets are kept, least recently used
+  dropped first
+
+Counters and queue depth are available from `AdmissionController.stats()`.
+"""
+
+import heapq
+import ipaddress
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, jsonify
+
+PRIORITIES = ('urgent', 'routine')
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; carries the HTTP status and Retry-After"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `burst` tokens"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def take(self, now):
+        """Consume one token; return 0 on success or seconds until one is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=4, max_queue=32, max_wait=10.0,
+                 client_rate=5.0, client_burst=10, max_clients=10000):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_clients = max_clients
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = []  # heap of [priority_rank, seq, state]
+        self._seq = itertools.count()
+        self._buckets = OrderedDict()  # least recently used first
+        # Exponentially weighted moving average of service time, seeded with 1s
+        self._service_time = 1.0
+
+        self._admitted = {p: 0 for p in PRIORITIES}
+        self._shed = {
+            'rate_limited': 0,
+            'queue_full': 0,
+            'deadline_unreachable': 0,
+            'deadline_expired': 0,
+            'preempted': 0
+        }
+        self._max_queue_seen = 0
+
+    def _check_rate(self, client_id, now):
+        """Apply the per-client token bucket (caller holds the lock)"""
+        if self.client_rate <= 0:
+            return
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_clients:
+                self._prune_buckets(now)
+            bucket = self._buckets[client_id] = TokenBucket(self.client_rate, self.client_burst, now)
+        else:
+            self._buckets.move_to_end(client_id)
+        wait = bucket.take(now)
+        if wait > 0:
+            self._shed['rate_limited'] += 1
+            raise AdmissionRejected(429, 'Rate limit exceeded for client', wait)
+
+    def _prune_buckets(self, now):
+        """
+        Forget clients whose bucket has refilled completely, then the least
+        recently seen ones until there is room for one more
+        """
+        refill = self.client_burst / self.client_rate
+        for client in [client for client, bucket in self._buckets.items() if now - bucket.updated >= refill]:
+            del self._buckets[client]
+        while len(self._buckets) >= self.max_clients:
+            self._buckets.popitem(last=False)
+
+    def _estimated_wait(self, ahead):
+        """Expected seconds before a request with `ahead` requests in front of it starts"""
+        backlog = self._in_flight + ahead - self.max_in_flight + 1
+        if backlog <= 0:
+            return 0.0
+        return backlog * self._service_time / self.max_in_flight
+
+    def acquire(self, client_id, priority='routine', deadline=None):
+        """
+        Block until the request may run, or raise AdmissionRejected.
+        `deadline` is the number of seconds the caller is willing to wait.
+        """
+        if priority not in PRIORITIES:
+            priority = 'routine'
+        rank = PRIORITIES.index(priority)
+        timeout = self.max_wait if deadline is None else min(deadline, self.max_wait)
+
+        with self._cond:
+            now = time.monotonic()
+            self._check_rate(client_id, now)
+
+            if self._in_flight < self.max_in_flight and not self._waiting:
+                self._in_flight += 1
+                self._admitted[priority] += 1
+                return
+
+            ahead = sum(1 for entry in self._waiting if entry[0] <= rank)
+            estimate = self._estimated_wait(ahead)
+            if estimate > timeout:
+                self._shed['deadline_unreachable'] += 1
+                raise AdmissionRejected(503, 'Server busy, request cannot start before its deadline', estimate)
+
+            if len(self._waiting) >= self.max_queue:
+                # An urgent request may take the place of the newest routine one
+                victim = max(self._waiting, key=lambda entry: (entry[0], entry[1]))
+                if victim[0] <= rank:
+                    self._shed['queue_full'] += 1
+                    raise AdmissionRejected(503, 'Server busy, wait queue is full', estimate)
+                self._waiting.remove(victim)
+                heapq.heapify(self._waiting)
+                victim[2]['preempted'] = True
+                self._shed['preempted'] += 1
+                self._cond.notify_all()  # the victim answers 503 now rather than at its deadline
+
+            entry = [rank, next(self._seq), {'preempted': False}]
+            heapq.heappush(self._waiting, entry)
+            self._max_queue_seen = max(self._max_queue_seen, len(self._waiting))
+
+            give_up = now + timeout
+            while True:
+                if entry[2]['preempted']:
+                    self._cond.notify_all()
+                    raise AdmissionRejected(503, 'Server busy, preempted by an urgent request',
+                                            self._estimated_wait(len(self._waiting)))
+                if self._waiting[0] is entry and self._in_flight < self.max_in_flight:
+                    heapq.heappop(self._waiting)
+                    self._in_flight += 1
+                    self._admitted[priority] += 1
+                    self._cond.notify_all()
+                    return
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                    self._shed['deadline_expired'] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected(503, 'Server busy, deadline expired while queued',
+                                            self._estimated_wait(len(self._waiting)))
+                self._cond.wait(remaining)
+
+    def release(self, service_time=None):
+        """Mark a request as finished and wake up the queue"""
+        with self._cond:
+            self._in_flight -= 1
+            if service_time is not None:
+                self._service_time = 0.8 * self._service_time + 0.2 * service_time
+            self._cond.notify_all()
+
+    def stats(self):
+        """Snapshot of queue depth and admission/shed counters"""
+        with self._cond:
+            depth = {p: 0 for p in PRIORITIES}
+            for entry in self._waiting:
+                depth[PRIORITIES[entry[0]]] += 1
+            return {
+                'in_flight': self._in_flight,
+                'max_in_flight': self.max_in_flight,
+                'queue_depth': len(self._waiting),
+                'queue_depth_by_priority': depth,
+                'max_queue': self.max_queue,
+                'max_queue_depth_seen': self._max_queue_seen,
+                'admitted': dict(self._admitted),
+                'shed': dict(self._shed),
+                'shed_total': sum(self._shed.values()),
+                'service_time_ewma_s': round(self._service_time, 4),
+                'tracked_clients': len(self._buckets)
+            }
+
+
+def request_priority():
+    """Priority lane from the X-Priority header or ?priority= query argument"""
+    value = request.headers.get('X-Priority') or request.args.get('priority', 'routine')
+    return value.strip().lower()
+
+
+def request_deadline():
+    """Seconds the client is willing to wait, from the X-Deadline-Ms header"""
+    value = request.headers.get('X-Deadline-Ms')
+    try:
+        return max(0.0, float(value) / 1000.0) if value else None
+    except ValueError:
+        return None
+
+
+def trusted_proxies(values):
+    """Networks from a list of addresses or CIDR ranges, for the TRUSTED_PROXIES setting"""
+    return [ipaddress.ip_network(value, strict=False) for value in values]
+
+
+def request_client_id():
+    """
+    Identify the caller by its remote address. X-Client-ID is used instead only
+    when the request comes from one of the app's TRUSTED_PROXIES networks.
+    """
+    address = request.remote_addr or 'unknown'
+    client_id = request.headers.get('X-Client-ID')
+    if client_id:
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return address
+        if any(ip in network for network in current_app.config.get('TRUSTED_PROXIES', ())):
+            return client_id
+    return address
+
+
+def admission_controlled(controller):
+    """
+    Decorator for Flask views: runs the view only once the controller admits
+    the request. Rejection happens before the upload body is read.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                controller.acquire(request_client_id(), request_priority(), request_deadline())
+            except AdmissionRejected as e:
+                response = jsonify({'error': e.reason, 'retry_after': e.retry_after})
+                response.status_code = e.status
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+
+            start = time.monotonic()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release(time.monotonic() - start)
+        return wrapper
+    return decorator
@@ -1,12 +1,34 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import cv2
 import numpy as np
 import os
+import json
+import threading
+import time
+import atexit
+import uuid
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+import cv2
 import tensorflow as tf
 
+from admission import AdmissionController, admission_controlled, request_client_id, trusted_proxies
+from batching import BatchPredictor
+from cascade import load_pipeline
+from coalesce import IdempotencyConflict, RequestCoalescer
+from drift import DriftMonitor, file_source_size
+from explain import GradCamExplainer, file_hash, render_overlay
+from jobs import JobManager, JobQueueFull
+from model_artifact import artifact_is_current, artifact_path, load_serving_model, weights_version
+from preprocessing import (IMG_SIZE, PreprocessPool, load_preprocessing_options, preprocess_bytes,
+                           preprocess_gray, preprocessing_options)
+from serving_model import PIXEL_SCALE, with_input_scaling
+from tensor_format import CONTENT_TYPE as TENSOR_CONTENT_TYPE, TensorFormatError, decode_tensors
+from tta import TestTimeAugmenter
+from upload_stream import UploadRejected, ValidatingRequest
+
 app = Flask(__name__)
+app.request_class = ValidatingRequest
 CORS(app)
 
 # Configuration
@@ -17,46 +39,347 @@ ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'bmp', 'dcm'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Streaming upload validation (see upload_stream.py)
+app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXTENSIONS
+app.config['MAX_FILE_SIZE'] = app.config['MAX_CONTENT_LENGTH']
+app.config['MAX_IMAGE_DIMENSION'] = 8192  # reject decompression bombs from the header
+app.config['UPLOAD_ABORT_ON_INVALID'] = True
+
+# Admission control for /predict (see admission.py)
+app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 4))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.environ.get('ADMISSION_MAX_QUEUE', 32))
+app.config['ADMISSION_MAX_WAIT'] = float(os.environ.get('ADMISSION_MAX_WAIT', 10.0))  # seconds
+app.config['CLIENT_RATE_LIMIT'] = float(os.environ.get('CLIENT_RATE_LIMIT', 5.0))  # requests/second
+app.config['CLIENT_RATE_BURST'] = int(os.environ.get('CLIENT_RATE_BURST', 10))
+# Proxies (comma-separated addresses or CIDR ranges) whose X-Client-ID header is
+# trusted; other callers are told apart by their remote address
+app.config['TRUSTED_PROXIES'] = trusted_proxies(
+    value.strip() for value in os.environ.get('TRUSTED_PROXIES', '').split(',') if value.strip())
+
+# Decision threshold for /predict. By default it is read from model_info.json
+# (written by evaluate_model.py); DECISION_THRESHOLD overrides it.
+app.config['DECISION_THRESHOLD'] = float(os.environ['DECISION_THRESHOLD']) if 'DECISION_THRESHOLD' in os.environ else None
+DEFAULT_THRESHOLD = 0.5
+
+# Grad-CAM explanations (see explain.py). /predict caches the feature maps of
+# each image so that a follow-up /explain skips the forward pass.
+app.config['EXPLAIN_CACHE_SIZE'] = int(os.environ.get('EXPLAIN_CACHE_SIZE', 128))
+app.config['EXPLAIN_CACHE_ON_PREDICT'] = os.environ.get('EXPLAIN_CACHE_ON_PREDICT', '1') != '0'
+
+# Test-time augmentation for /predict?tta=1 (see tta.py)
+app.config['TTA_MAX_VARIANTS'] = int(os.environ.get('TTA_MAX_VARIANTS', 8))
+app.config['TTA_DEFAULT_VARIANTS'] = int(os.environ.get('TTA_DEFAULT_VARIANTS', 4))
+app.config['TTA_MAX_OVERHEAD_MS'] = float(os.environ['TTA_MAX_OVERHEAD_MS']) if 'TTA_MAX_OVERHEAD_MS' in os.environ else None
+
+# Cascade inference (see cascade.py): cheap stages recorded in model_info.json
+# answer confident images and escalate the rest to the full model.
+# CASCADE_STAGES restricts which stages run (comma-separated names).
+app.config['CASCADE_ENABLED'] = os.environ.get('CASCADE_ENABLED', '1') != '0'
+app.config['CASCADE_STAGES'] = [name.strip() for name in os.environ['CASCADE_STAGES'].split(',') if name.strip()] \
+    if 'CASCADE_STAGES' in os.environ else None
+
+# Preprocessing worker processes (see preprocessing.py). 0 preprocesses in the
+# request thread; N > 0 decodes and enhances uploads in N separate processes.
+app.config['PREPROCESS_WORKERS'] = int(os.environ.get('PREPROCESS_WORKERS', 0))
+app.config['PREPROCESS_TIMEOUT'] = float(os.environ.get('PREPROCESS_TIMEOUT', 30.0))  # seconds
+# Decode large JPEG uploads at reduced resolution (grayscale, DCT scaling);
+# REDUCED_DECODE=0 always decodes at full resolution
+app.config['REDUCED_DECODE'] = os.environ.get('REDUCED_DECODE', '1') != '0'
+
+# Raw uint8 tensors for internal services (see tensor_format.py), scored by
+# the micro-batching predictor (see batching.py). Concurrent requests share
+# forward passes of up to BATCH_MAX_SIZE images, waiting at most
+# BATCH_MAX_WAIT_MS for others to join.
+app.config['TENSOR_MAX_IMAGES'] = int(os.environ.get('TENSOR_MAX_IMAGES', 256))  # per request
+app.config['BATCH_MAX_SIZE'] = int(os.environ.get('BATCH_MAX_SIZE', 64))
+app.config['BATCH_MAX_WAIT_MS'] = float(os.environ.get('BATCH_MAX_WAIT_MS', 2.0))
+app.config['BATCH_TIMEOUT'] = float(os.environ.get('BATCH_TIMEOUT', 30.0))  # seconds
+
+# Identical /predict uploads in flight at the same time are computed once, and
+# responses to requests with an Idempotency-Key header are kept for
+# IDEMPOTENCY_TTL seconds for retries (see coalesce.py)
+app.config['COALESCE_ENABLED'] = os.environ.get('COALESCE_ENABLED', '1') != '0'
+app.config['IDEMPOTENCY_TTL'] = float(os.environ.get('IDEMPOTENCY_TTL', 86400))  # seconds
+app.config['IDEMPOTENCY_MAX_KEYS'] = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+
+# Asynchronous prediction jobs for large studies (see jobs.py). Finished jobs
+# are kept for JOB_RESULT_TTL seconds; JOB_CALLBACK_HOSTS (comma-separated)
+# lists the hosts that callback URLs may point to. Without it, only hosts with
+# public addresses are called back.
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 2))
+app.config['JOB_MAX_QUEUED'] = int(os.environ.get('JOB_MAX_QUEUED', 100))
+app.config['JOB_MAX_IMAGES'] = int(os.environ.get('JOB_MAX_IMAGES', 1000))  # per job
+# Body limit of POST /jobs, which carries a whole study; each file is still
+# limited to MAX_FILE_SIZE
+app.config['JOB_MAX_CONTENT_LENGTH'] = int(os.environ.get('JOB_MAX_CONTENT_LENGTH', 512 * 1024 * 1024))
+app.config['JOB_RESULT_TTL'] = float(os.environ.get('JOB_RESULT_TTL', 3600))  # seconds
+app.config['JOB_MAX_RETAINED'] = int(os.environ.get('JOB_MAX_RETAINED', 1000))
+app.config['JOB_CALLBACK_TIMEOUT'] = float(os.environ.get('JOB_CALLBACK_TIMEOUT', 5.0))  # seconds
+app.config['JOB_CALLBACK_RETRIES'] = int(os.environ.get('JOB_CALLBACK_RETRIES', 3))
+app.config['JOB_CALLBACK_HOSTS'] = [host.strip() for host in os.environ.get('JOB_CALLBACK_HOSTS', '').split(',')
+                                    if host.strip()]
+JOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'jobs')
+
+# Drift monitoring (see drift.py): histograms of the inputs and scores served
+# over the last DRIFT_WINDOW seconds, compared with the training data's
+# baseline in model_info.json. No verdict below DRIFT_MIN_SAMPLES images.
+app.config['DRIFT_ENABLED'] = os.environ.get('DRIFT_ENABLED', '1') != '0'
+app.config['DRIFT_WINDOW'] = float(os.environ.get('DRIFT_WINDOW', 3600))  # seconds
+app.config['DRIFT_BUCKETS'] = int(os.environ.get('DRIFT_BUCKETS', 12))
+app.config['DRIFT_MIN_SAMPLES'] = int(os.environ.get('DRIFT_MIN_SAMPLES', 500))
+
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(JOB_FOLDER, exist_ok=True)
 os.makedirs(MODEL_FOLDER, exist_ok=True)
 
-# Global variable to store the loaded model
+# Global variables to store the loaded model, its operating threshold, explainer and cascade
 model = None
+decision_threshold = DEFAULT_THRESHOLD
+explainer = None
+cascade = None
+batch_predictor = None
+model_version = None
+preprocess_options = preprocessing_options()
+model_load = None
+preprocess_pool = None
+preprocess_pool_lock = threading.Lock()
+model_lock = threading.Lock()
+
+admission = AdmissionController(
+    max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'],
+    max_queue=app.config['ADMISSION_MAX_QUEUE'],
+    max_wait=app.config['ADMISSION_MAX_WAIT'],
+    client_rate=app.config['CLIENT_RATE_LIMIT'],
+    client_burst=app.config['CLIENT_RATE_BURST']
+)
+
+tta = TestTimeAugmenter(
+    max_variants=app.config['TTA_MAX_VARIANTS'],
+    default_variants=app.config['TTA_DEFAULT_VARIANTS'],
+    max_overhead_ms=app.config['TTA_MAX_OVERHEAD_MS']
+)
+
+coalescer = RequestCoalescer(
+    enabled=app.config['COALESCE_ENABLED'],
+    idempotency_ttl=app.config['IDEMPOTENCY_TTL'],
+    max_keys=app.config['IDEMPOTENCY_MAX_KEYS'],
+    wait_timeout=app.config['ADMISSION_MAX_WAIT'] + app.config['PREPROCESS_TIMEOUT']
+)
+
+drift_monitor = DriftMonitor(
+    enabled=app.config['DRIFT_ENABLED'],
+    window_seconds=app.config['DRIFT_WINDOW'],
+    buckets=app.config['DRIFT_BUCKETS'],
+    min_samples=app.config['DRIFT_MIN_SAMPLES']
+)
+
+def run_prediction_job(job):
+    """Score a job's images, a batch at a time, through the micro-batching predictor"""
+    load_model()
+    job.threshold = decision_threshold
+    job.model_version = model_version
+    size = app.config['BATCH_MAX_SIZE']
+    for start in range(0, len(job.items), size):
+        rows, tensors = [], []
+        for name, load in job.items[start:start + size]:
+            try:
+                tensors.append(load())
+                rows.append({'name': name})
+            except Exception as e:
+                rows.append({'name': name, 'error': str(e) or type(e).__name__})
+        if tensors:
+            batch = np.stack(tensors)
+            scores = batch_predictor.predict(batch[..., np.newaxis], timeout=app.config['BATCH_TIMEOUT'])
+            drift_monitor.observe(tensors=batch, scores=scores)
+            probabilities = iter(scores)
+            for row in rows:
+                if 'error' not in row:
+                    probability = float(next(probabilities))
+                    row['prediction'] = "Tumor Detected" if probability >= job.threshold else "No Tumor Detected"
+                    row['confidence'] = round(probability, 4)
+        job.add_results(rows)
+        job_manager.record_images(len(tensors))
+
+job_manager = JobManager(
+    run_prediction_job,
+    workers=app.config['JOB_WORKERS'],
+    max_queued=app.config['JOB_MAX_QUEUED'],
+    result_ttl=app.config['JOB_RESULT_TTL'],
+    max_retained=app.config['JOB_MAX_RETAINED'],
+    callback_timeout=app.config['JOB_CALLBACK_TIMEOUT'],
+    callback_retries=app.config['JOB_CALLBACK_RETRIES'],
+    callback_hosts=app.config['JOB_CALLBACK_HOSTS']
+)
+
+@app.before_request
+def limit_content_length():
+    """Only /jobs may exceed the regular upload size limit"""
+    if request.endpoint == 'submit_job':
+        request.max_content_length = app.config['JOB_MAX_CONTENT_LENGTH']
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def tta_requested():
+    """Parse the optional `tta` and `tta_variants` fields; returns (enabled, requested variants)"""
+    enabled = request.values.get('tta', '').lower() in ('1', 'true', 'yes', 'on')
+    variants = request.values.get('tta_variants')
+    if variants is not None:
+        try:
+            variants = int(variants)
+        except ValueError:
+            raise ValueError('tta_variants must be an integer')
+        enabled = True
+    return enabled, variants
+
+def load_decision_threshold():
+    """Operating threshold chosen by evaluate_model.py, or 0.5 if none was recorded"""
+    if app.config['DECISION_THRESHOLD'] is not None:
+        return app.config['DECISION_THRESHOLD']
+    info_path = os.path.join(MODEL_FOLDER, 'model_info.json')
+    try:
+        with open(info_path) as f:
+            threshold = json.load(f).get('decision_threshold')
+        if threshold is not None:
+            return float(threshold)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  Could not read decision threshold from {info_path}: {str(e)}")
+    return DEFAULT_THRESHOLD
+
+def load_explainer(model):
+    """Grad-CAM explainer for the model, or None if its architecture is not supported"""
+    try:
+        return GradCamExplainer(model, cache_size=app.config['EXPLAIN_CACHE_SIZE'])
+    except ValueError as e:
+        print(f"⚠️  Explanations disabled: {str(e)}")
+        return None
+
+def load_cascade(model):
+    """Cascade of cheap stages for `model` from model_info.json, or None if there are none or it is disabled"""
+    if not app.config['CASCADE_ENABLED']:
+        return None
+    info_path = os.path.join(MODEL_FOLDER, 'model_info.json')
+    try:
+        with open(info_path) as f:
+            info = json.load(f)
+        pipeline = load_pipeline(info, MODEL_FOLDER, load_keras_model, enabled=app.config['CASCADE_STAGES'],
+                                 input_shape=model.input_shape, threshold=decision_threshold)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️  Cascade disabled: {str(e)}")
+        return None
+    if pipeline is not None:
+        for stage in pipeline.stages:
+            print(f"✅ Cascade stage {stage.name}: answers p <= {stage.low} or p >= {stage.high}")
+    return pipeline
+
+def load_drift_baseline():
+    """Give the drift monitor the training data baseline from model_info.json, if there is one"""
+    if not app.config['DRIFT_ENABLED']:
+        return
+    info_path = os.path.join(MODEL_FOLDER, 'model_info.json')
+    try:
+        with open(info_path) as f:
+            baseline = json.load(f).get('drift_baseline')
+        if baseline is None:
+            print(f"⚠️  No drift baseline in {info_path}; run `python drift.py baseline` to create one")
+            return
+        drift_monitor.set_baseline(baseline)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"⚠️  Drift baseline not loaded: {str(e)}")
+        return
+    if baseline.get('model_version') not in (None, model_version):
+        print(f"⚠️  The drift baseline was computed for model {baseline['model_version']}; "
+              f"prediction score drift is measured against another model's scores")
+    print(f"✅ Drift baseline from {baseline.get('images')} training images")
+
+def load_preprocess_options(input_shape=None):
+    """
+    Input size, blur and CLAHE parameters the model was trained with, from
+    model_info.json and the model's input shape (which wins on a conflict)
+    """
+    info_path = os.path.join(MODEL_FOLDER, 'model_info.json')
+    try:
+        options = load_preprocessing_options(info_path, input_shape)
+        declared = load_preprocessing_options(info_path)['size']
+    except (OSError, ValueError, TypeError) as e:
+        print(f"⚠️  Could not read preprocessing parameters from {info_path}: {str(e)}")
+        return preprocessing_options(input_shape=input_shape)
+    if input_shape is not None and os.path.exists(info_path) and declared != options['size']:
+        print(f"⚠️  {info_path} lists input size {declared}, but the model takes {options['size']}; "
+              f"using the model's")
+    return options
+
+def load_keras_model(path):
+    """
+    A saved model, taking uint8 pixels (older models get their input scaling
+    added). Loaded from its serving artifact (model_artifact.py) when that is
+    current, which is faster and leaves out the optimizer state.
+    """
+    if artifact_is_current(path):
+        print(f"Loading {path} from its serving artifact {artifact_path(path)}")
+    return with_input_scaling(load_serving_model(path))
+
 def load_model():
-    """Load the trained brain tumor detection model"""
-    global model
-    if model is None:
+    """
+    Load the trained brain tumor detection model. Everything derived from it
+    is set up first and `model` is assigned last, under a lock, so concurrent
+    first requests never see a model without its batch predictor or
+    preprocessing parameters.
+    """
+    global model, decision_threshold, explainer, cascade, batch_predictor, model_version, preprocess_options, \
+        model_load
+    if model is not None:
+        return model
+    with model_lock:
+        if model is not None:
+            return model
         model_path = os.path.join(MODEL_FOLDER, 'brain_tumor_model.h5')
-        if os.path.exists(model_path):
+        loaded = None
+        if os.path.exists(model_path) or artifact_is_current(model_path):
             try:
-                model = tf.keras.models.load_model(model_path)
+                start = time.perf_counter()
+                source = 'artifact' if artifact_is_current(model_path) else 'h5'
+                loaded = load_keras_model(model_path)
+                model_load = {'source': source, 'seconds': round(time.perf_counter() - start, 3)}
+                decision_threshold = load_decision_threshold()
+                preprocess_options = load_preprocess_options(loaded.input_shape)
                 print(f"✅ Trained model loaded successfully from {model_path}")
-                print(f"Model input shape: {model.input_shape}")
-                print(f"Model output shape: {model.output_shape}")
+                print(f"Model input shape: {loaded.input_shape}")
+                print(f"Model output shape: {loaded.output_shape}")
+                print(f"Decision threshold: {decision_threshold}")
             except Exception as e:
                 print(f"❌ Error loading trained model: {str(e)}")
                 print("Creating dummy model for testing...")
-                model = create_dummy_model()
+                loaded = None
         else:
             print(f"⚠️  No trained model found at {model_path}")
             print("Creating dummy model for testing...")
             print("To use a real model, train one using the data upload interface at http://localhost:5001")
-            model = create_dummy_model()
+        if loaded is None:
+            preprocess_options = load_preprocess_options()
+            loaded = create_dummy_model(preprocess_options['size'])
+        print(f"Preprocessing: {preprocess_options}")
+        explainer = load_explainer(loaded)
+        cascade = load_cascade(loaded)
+        batch_predictor = BatchPredictor(loaded, max_batch_size=app.config['BATCH_MAX_SIZE'],
+                                         max_wait_ms=app.config['BATCH_MAX_WAIT_MS'])
+        model_version = weights_version(loaded)
+        print(f"Model version: {model_version}")
+        load_drift_baseline()
+        tta.warm_up(loaded)
+        model = loaded
     return model
 
-def create_dummy_model():
-    """Create a dummy model for testing purposes"""
+def create_dummy_model(size=IMG_SIZE):
+    """Create a dummy model for testing purposes, taking (width, height) images"""
     # This creates a simple CNN model that outputs random predictions
     # In production, replace this with your actual trained model
     model = tf.keras.Sequential([
-        tf.keras.layers.Input(shape=(128, 128, 1)),
+        tf.keras.layers.Input(shape=(size[1], size[0], 1)),
+        tf.keras.layers.Rescaling(PIXEL_SCALE),
         tf.keras.layers.Conv2D(32, (3, 3), activation='relu'),
         tf.keras.layers.MaxPooling2D((2, 2)),
         tf.keras.layers.Conv2D(64, (3, 3), activation='relu'),
@@ -71,55 +394,67 @@ def create_dummy_model():
     model.compile(optimizer='adam', loss='binary_crossentropy', metrics=['accuracy'])
     
     # Initialize with random weights (in production, load trained weights)
-    dummy_input = np.random.random((1, 128, 128, 1))
+    dummy_input = np.random.randint(0, 256, (1, size[1], size[0], 1), dtype=np.uint8)
     model.predict(dummy_input)
     
     print("Dummy model created for testing")
     return model
 
+def model_preprocessing():
+    """Preprocessing options of the served model (loading it first)"""
+    load_model()
+    return preprocess_options
+
 def preprocess_mri_image(image_path):
     """
-    Preprocess MRI image with the following steps:
+    Preprocess MRI image with the following steps (see preprocessing.py),
+    using the parameters of the served model:
     1. Convert to grayscale
-    2. Resize to 128x128
+    2. Resize to the model's input size (128x128 by default)
     3. Apply Gaussian blur for noise removal
     4. Apply CLAHE for contrast enhancement
-    5. Normalize pixel values to 0-1 range
-    6. Reshape to (1,128,128,1)
+    5. Reshape to (1,H,W,1) uint8 (the model scales to 0-1 itself)
     """
     try:
-        # Read the image
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError("Could not read image file")
-        
-        # Step 1: Convert to grayscale
-        if len(image.shape) == 3:
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = image
-        
-        # Step 2: Resize to 128x128
-        resized = cv2.resize(gray, (128, 128), interpolation=cv2.INTER_AREA)
-        
-        # Step 3: Apply Gaussian blur for noise removal
-        blurred = cv2.GaussianBlur(resized, (5, 5), 0)
-        
-        # Step 4: Apply CLAHE (Contrast Limited Adaptive Histogram Equalization)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(blurred)
-        
-        # Step 5: Normalize pixel values to 0-1 range
-        normalized = enhanced.astype(np.float32) / 255.0
+        options = model_preprocessing()
+        with open(image_path, 'rb') as f:
+            data = f.read()
         
-        # Step 6: Reshape to (1,128,128,1) - ready for model
-        reshaped = normalized.reshape(1, 128, 128, 1)
+        # Steps 1-4 on the raw file bytes
+        enhanced = preprocess_bytes(data, reduced_decode=app.config['REDUCED_DECODE'], **options)
         
-        return reshaped
+        # Step 5: Reshape to (1,H,W,1) - ready for model
+        return enhanced[np.newaxis, :, :, np.newaxis]
         
     except Exception as e:
         raise Exception(f"Error preprocessing image: {str(e)}")
 
+def get_preprocess_pool():
+    """The preprocessing worker pool, started on first use; None when PREPROCESS_WORKERS is 0"""
+    global preprocess_pool
+    if app.config['PREPROCESS_WORKERS'] <= 0:
+        return None
+    options = model_preprocessing()
+    with preprocess_pool_lock:
+        if preprocess_pool is None:
+            preprocess_pool = PreprocessPool(workers=app.config['PREPROCESS_WORKERS'],
+                                             reduced_decode=app.config['REDUCED_DECODE'], **options)
+            atexit.register(preprocess_pool.close)
+            print(f"✅ Started {preprocess_pool.workers} preprocessing workers")
+    return preprocess_pool
+
+def preprocess_upload(image_path):
+    """preprocess_mri_image, in a worker process when the pool is enabled"""
+    pool = get_preprocess_pool()
+    if pool is None:
+        return preprocess_mri_image(image_path)
+    try:
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        return pool.preprocess(data, timeout=app.config['PREPROCESS_TIMEOUT'])[np.newaxis, :, :, np.newaxis]
+    except Exception as e:
+        raise Exception(f"Error preprocessing image: {str(e) or type(e).__name__}")
+
 @app.route('/preprocess', methods=['POST'])
 def preprocess_image():
     """Handle image upload and preprocessing"""
@@ -139,18 +474,19 @@ def preprocess_image():
             return jsonify({'error': 'File type not allowed. Please upload PNG, JPG, JPEG, TIFF, BMP, or DCM files'}), 400
         
         # Save uploaded file
-        filename = secure_filename(file.filename)
+        # Unique name: concurrent uploads may share a filename
+        filename = f'{uuid.uuid4().hex}_{secure_filename(file.filename)}'
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
         try:
             # Preprocess the image
-            processed_image = preprocess_mri_image(filepath)
+            processed_image = preprocess_upload(filepath)
             
-            # Get image statistics
+            # Get image statistics, in the 0-1 range the model works in
             shape = processed_image.shape
-            min_val = float(np.min(processed_image))
-            max_val = float(np.max(processed_image))
+            min_val = float(np.min(processed_image)) * PIXEL_SCALE
+            max_val = float(np.max(processed_image)) * PIXEL_SCALE
             
             # Clean up uploaded file
             os.remove(filepath)
@@ -169,10 +505,68 @@ def preprocess_image():
                 os.remove(filepath)
             return jsonify({'error': str(e)}), 500
             
+    except UploadRejected as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def predict_file(filepath, digest, use_tta, tta_variants):
+    """
+    Preprocess and predict a saved upload; the JSON response of /predict.
+    `tta_variants` is the requested variant count (None for the default).
+    """
+    # Preprocess the image
+    processed_image = preprocess_upload(filepath)
+    
+    # Load the model
+    model = load_model()
+    
+    # Make prediction, optionally averaged over augmented variants
+    tta_result = None
+    stage = None
+    if use_tta:
+        # Once per computed request: variant_count also counts budget-limited requests
+        tta_result = tta.predict(model, processed_image, tta.variant_count(tta_variants))
+        prediction_prob = tta_result['mean']
+    else:
+        def full_model(tensor):
+            start = time.perf_counter()
+            if explainer is not None and app.config['EXPLAIN_CACHE_ON_PREDICT']:
+                # Same forward pass, keeping the feature maps for /explain
+                probability = explainer.predict(tensor, key=digest)
+            else:
+                probability = float(model.predict(tensor, verbose=0)[0][0])
+            tta.record_plain(time.perf_counter() - start)
+            return probability
+        
+        # Cheap stages answer confident images; uncertain ones go to the full model
+        if cascade is not None:
+            prediction_prob, stage = cascade.predict(processed_image, full_model)
+        else:
+            prediction_prob = full_model(processed_image)
+    
+    # Determine result based on the model's evaluated operating threshold
+    threshold = decision_threshold
+    if prediction_prob >= threshold:
+        result = "Tumor Detected"
+    else:
+        result = "No Tumor Detected"
+    
+    response = {
+        'prediction': result,
+        'confidence': round(prediction_prob, 4),
+        'threshold': threshold
+    }
+    if tta_result is not None:
+        response['tta'] = tta_result
+    if stage is not None:
+        response['stage'] = stage
+    drift_monitor.observe(tensors=processed_image, scores=prediction_prob,
+                          sizes=[file_source_size(filepath)])
+    return response
+
 @app.route('/predict', methods=['POST'])
+@admission_controlled(admission)
 def predict_tumor():
     """Handle image upload, preprocessing, and tumor prediction"""
     try:
@@ -190,45 +584,273 @@ def predict_tumor():
         if not allowed_file(file.filename):
             return jsonify({'error': 'File type not allowed. Please upload PNG, JPG, JPEG, TIFF, BMP, or DCM files'}), 400
         
-        # Save uploaded file
-        filename = secure_filename(file.filename)
+        try:
+            use_tta, tta_variants = tta_requested()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # Save uploaded file under a unique name: retries of the same upload
+        # arrive concurrently with the same filename
+        filename = f'{uuid.uuid4().hex}_{secure_filename(file.filename)}'
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
         try:
-            # Preprocess the image
-            processed_image = preprocess_mri_image(filepath)
-            
-            # Load the model
-            model = load_model()
-            
-            # Make prediction
-            prediction = model.predict(processed_image, verbose=0)
-            prediction_prob = float(prediction[0][0])
+            # Identical uploads (same content, model and options) share one
+            # computation; Idempotency-Key retries get the stored response
+            load_model()
+            digest = file_hash(filepath)
+            # Keyed on what the client asked for: the variant count the TTA
+            # budget allows moves with the latency estimate, and a retry must
+            # still match its Idempotency-Key
+            key = (digest, model_version, use_tta, tta_variants if use_tta else None)
+            idempotency_key = request.headers.get('Idempotency-Key')
+            if idempotency_key:
+                idempotency_key = (request_client_id(), idempotency_key)
+            try:
+                response, how = coalescer.execute(
+                    key, lambda: predict_file(filepath, digest, use_tta, tta_variants), idempotency_key)
+            except IdempotencyConflict as e:
+                return jsonify({'error': str(e)}), 422
             
-            # Determine result based on threshold (0.5 for binary classification)
-            threshold = 0.5
-            if prediction_prob >= threshold:
-                result = "Tumor Detected"
-            else:
-                result = "No Tumor Detected"
+            # Return prediction result
+            reply = jsonify(response)
+            if how == 'replayed':
+                reply.headers['Idempotent-Replayed'] = 'true'
+            elif how == 'coalesced':
+                reply.headers['X-Coalesced'] = 'true'
+            return reply, 200
             
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        finally:
             # Clean up uploaded file
+            if os.path.exists(filepath):
+                os.remove(filepath)
+            
+    except UploadRejected as e:
+        return jsonify({'error': e.description}), e.code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def tensor_batch(images, preprocessed=False):
+    """
+    (N,H,W,1) uint8 model input from decoded arrays. BGR arrays are converted
+    to grayscale; `preprocessed` arrays must already be at the model's input
+    size and are used as they are, the others go through steps 2-4 of
+    preprocess_mri_image.
+    """
+    options = model_preprocessing()
+    width, height = options['size']
+    batch = np.empty((len(images), height, width, 1), dtype=np.uint8)
+    for i, image in enumerate(images):
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        if preprocessed:
+            if image.shape != (height, width):
+                raise TensorFormatError(f"image {i} is {image.shape[1]}x{image.shape[0]}; "
+                                        f"preprocessed images must be {width}x{height}")
+            batch[i, :, :, 0] = image
+        else:
+            batch[i, :, :, 0] = preprocess_gray(image, **options)
+    return batch
+
+@app.route('/predict/tensor', methods=['POST'])
+@admission_controlled(admission)
+def predict_tensor():
+    """
+    Predict a batch of raw uint8 pixel arrays (see tensor_format.py): no file
+    upload, no image decoding. ?preprocessed=1 marks arrays that were already
+    preprocessed at the model's input size.
+    """
+    try:
+        if request.mimetype not in (TENSOR_CONTENT_TYPE, 'application/octet-stream'):
+            return jsonify({'error': f'Content-Type must be {TENSOR_CONTENT_TYPE}'}), 415
+        preprocessed = request.args.get('preprocessed', '').lower() in ('1', 'true', 'yes', 'on')
+        
+        start = time.perf_counter()
+        try:
+            images = decode_tensors(request.get_data(cache=False),
+                                    max_images=app.config['TENSOR_MAX_IMAGES'],
+                                    max_dimension=app.config['MAX_IMAGE_DIMENSION'])
+            parsed = time.perf_counter()
+            batch = tensor_batch(images, preprocessed)
+        except TensorFormatError as e:
+            return jsonify({'error': str(e)}), 400
+        prepared = time.perf_counter()
+        
+        # Shares forward passes with concurrent requests
+        probabilities = batch_predictor.predict(batch, timeout=app.config['BATCH_TIMEOUT'])
+        finished = time.perf_counter()
+        drift_monitor.observe(tensors=batch, scores=probabilities,
+                              sizes=None if preprocessed else [image.shape[1::-1] for image in images])
+        
+        threshold = decision_threshold
+        return jsonify({
+            'predictions': [{
+                'prediction': "Tumor Detected" if probability >= threshold else "No Tumor Detected",
+                'confidence': round(float(probability), 4)
+            } for probability in probabilities],
+            'threshold': threshold,
+            'count': len(images),
+            'latency_ms': {
+                'parse_ms': round((parsed - start) * 1000, 2),
+                'preprocess_ms': round((prepared - parsed) * 1000, 2),
+                'inference_ms': round((finished - prepared) * 1000, 2),
+                'total_ms': round((finished - start) * 1000, 2)
+            }
+        }), 200
+        
+    except RequestEntityTooLarge:
+        return jsonify({'error': f"Request body exceeds {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def remove_files(paths):
+    """Delete staged uploads, ignoring those already gone"""
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Start an asynchronous prediction job for a study: image files in `files`
+    (multipart) or a raw tensor body as for /predict/tensor. Returns a job ID
+    immediately; poll /jobs/<job_id>, or pass `callback_url` to have the
+    results POSTed there.
+    """
+    staged = []
+    try:
+        callback_url = request.args.get('callback_url') or None
+        if request.mimetype in (TENSOR_CONTENT_TYPE, 'application/octet-stream'):
+            preprocessed = request.args.get('preprocessed', '').lower() in ('1', 'true', 'yes', 'on')
+            images = decode_tensors(request.get_data(cache=False),
+                                    max_images=app.config['JOB_MAX_IMAGES'],
+                                    max_dimension=app.config['MAX_IMAGE_DIMENSION'])
+            items = [(f'#{i}', lambda image=image: tensor_batch([image], preprocessed)[0, :, :, 0])
+                     for i, image in enumerate(images)]
+            sizes = [] if preprocessed else [image.shape[1::-1] for image in images]
+        else:
+            callback_url = callback_url or request.form.get('callback_url') or None
+            files = [file for file in request.files.getlist('files') + request.files.getlist('file')
+                     if file and file.filename]
+            if not files:
+                return jsonify({'error': 'No files provided'}), 400
+            if len(files) > app.config['JOB_MAX_IMAGES']:
+                return jsonify({'error': f"{len(files)} files in one job; the limit is "
+                                         f"{app.config['JOB_MAX_IMAGES']}"}), 400
+            for file in files:
+                if not allowed_file(file.filename):
+                    return jsonify({'error': f'File type not allowed: {file.filename}'}), 400
+            items, sizes = [], []
+            for file in files:
+                path = os.path.join(JOB_FOLDER, f'{uuid.uuid4().hex}_{secure_filename(file.filename)}')
+                file.save(path)
+                staged.append(path)
+                items.append((file.filename, lambda path=path: preprocess_upload(path)[0, :, :, 0]))
+                sizes.append(file_source_size(path))
+        
+        job = job_manager.submit(items, callback_url,
+                                 cleanup=(lambda paths=list(staged): remove_files(paths)) if staged else None)
+        staged = []  # the job removes them when it is done
+        # Upload dimensions are known now; pixels and scores are recorded as the job runs
+        drift_monitor.observe(sizes=sizes)
+        return jsonify({
+            'job_id': job.id,
+            'status': job.status,
+            'images': len(items),
+            'status_url': f'/jobs/{job.id}'
+        }), 202
+        
+    except JobQueueFull as e:
+        response = jsonify({'error': str(e), 'retry_after': int(e.retry_after + 0.999)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(int(e.retry_after + 0.999))
+        return response
+    except ValueError as e:
+        # Malformed tensor body or a callback URL that is not allowed
+        return jsonify({'error': str(e)}), 400
+    except UploadRejected as e:
+        return jsonify({'error': e.description}), e.code
+    except RequestEntityTooLarge:
+        return jsonify({'error': f"Request body exceeds {request.max_content_length} bytes"}), 413
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        remove_files(staged)
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Status and results of an asynchronous prediction job"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown or expired job'}), 404
+    return jsonify(job.to_dict(app.config['JOB_RESULT_TTL'])), 200
+
+@app.route('/explain', methods=['POST'])
+@admission_controlled(admission)
+def explain_prediction():
+    """Grad-CAM heatmap of where the model looked, reusing cached activations from /predict"""
+    try:
+        if 'file' not in request.files:
+            return jsonify({'error': 'No file provided'}), 400
+        
+        file = request.files['file']
+        if file.filename == '':
+            return jsonify({'error': 'No file selected'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'File type not allowed. Please upload PNG, JPG, JPEG, TIFF, BMP, or DCM files'}), 400
+        
+        try:
+            alpha = float(request.values.get('alpha', 0.4))
+        except ValueError:
+            return jsonify({'error': 'alpha must be a number'}), 400
+        if not 0.0 <= alpha <= 1.0:
+            return jsonify({'error': 'alpha must be between 0 and 1'}), 400
+        
+        load_model()
+        if explainer is None:
+            return jsonify({'error': 'Explanations are not supported for the loaded model'}), 501
+        
+        # Unique name: concurrent uploads may share a filename
+        filename = f'{uuid.uuid4().hex}_{secure_filename(file.filename)}'
+        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        file.save(filepath)
+        
+        try:
+            start = time.perf_counter()
+            key = file_hash(filepath)
+            prediction_prob, heatmap, timings = explainer.explain(
+                key, lambda: preprocess_upload(filepath))
+            render_start = time.perf_counter()
+            overlay = render_overlay(filepath, heatmap, alpha=alpha)
+            finished = time.perf_counter()
             os.remove(filepath)
             
-            # Return prediction result
+            threshold = decision_threshold
+            result = "Tumor Detected" if prediction_prob >= threshold else "No Tumor Detected"
+            latency = {name: round(value, 2) for name, value in timings.items() if name != 'cache_hit'}
+            latency['render_ms'] = round((finished - render_start) * 1000, 2)
+            latency['total_ms'] = round((finished - start) * 1000, 2)
             return jsonify({
                 'prediction': result,
                 'confidence': round(prediction_prob, 4),
-                'threshold': threshold
+                'threshold': threshold,
+                'layer': explainer.layer_name,
+                'heatmap': np.round(heatmap, 3).tolist(),
+                'overlay': overlay,
+                'cache_hit': timings['cache_hit'],
+                'latency_ms': latency
             }), 200
             
         except Exception as e:
-            # Clean up uploaded file in case of error
             if os.path.exists(filepath):
                 os.remove(filepath)
             return jsonify({'error': str(e)}), 500
             
+    except UploadRejected as e:
+        return jsonify({'error': e.description}), e.code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -237,6 +859,40 @@ def health_check():
     """Health check endpoint"""
     return jsonify({'status': 'healthy', 'message': 'MRI preprocessing backend is running'}), 200
 
+@app.route('/drift', methods=['GET'])
+def drift():
+    """
+    Input and prediction statistics of the recent window (?scope=lifetime for
+    everything since startup) against the training data baseline
+    """
+    load_model()
+    try:
+        return jsonify(drift_monitor.report(request.args.get('scope', 'window'))), 200
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Operational metrics for capacity planning"""
+    return jsonify({
+        'admission': admission.stats(),
+        'tta': tta.stats(),
+        'explain': explainer.stats() if explainer is not None else None,
+        'cascade': cascade.stats() if cascade is not None else None,
+        'batching': batch_predictor.stats() if batch_predictor is not None else None,
+        'coalescing': coalescer.stats(),
+        'jobs': job_manager.stats(),
+        'drift': drift_monitor.stats(),
+        'model_load': model_load,
+        'model_input': {
+            'size': list(preprocess_options['size']),
+            'blur_kernel': preprocess_options['blur_kernel'],
+            'clahe_clip_limit': preprocess_options['clahe_clip_limit'],
+            'clahe_tile_grid': list(preprocess_options['clahe_tile_grid'])
+        },
+        'preprocess': preprocess_pool.stats() if preprocess_pool is not None else {'workers': 0}
+    }), 200
+
 @app.route('/', methods=['GET'])
 def home():
     """Home endpoint with API information"""
@@ -244,8 +900,16 @@ def home():
         'message': 'MRI Brain Tumor Detection Backend',
         'endpoints': {
             'POST /preprocess': 'Upload and preprocess MRI image',
-            'POST /predict': 'Upload MRI image and predict brain tumor',
+            'POST /predict': 'Upload MRI image and predict brain tumor (tta=1 for test-time augmentation, '
+                             'Idempotency-Key header for safe retries)',
+            'POST /predict/tensor': 'Predict a batch of raw uint8 pixel arrays (binary, see tensor_format.py)',
+            'POST /jobs': 'Start an asynchronous prediction job for a study (poll or callback_url)',
+            'GET /jobs/<job_id>': 'Status and results of a prediction job',
+            'GET /drift': 'Input and prediction score statistics and drift against the training data',
+            'POST /explain': 'Grad-CAM heatmap overlay for an MRI image',
             'GET /health': 'Health check',
+            'GET /metrics': 'Admission queue depth, shed counters, TTA latency, cascade stage hit rates, '
+                            'batch sizes, job queue latency and drift scores',
             'GET /': 'API information'
         }
     }), 200
@@ -255,11 +919,18 @@ if __name__ == '__main__':
     print("Available endpoints:")
     print("  POST /preprocess - Upload and preprocess MRI image")
     print("  POST /predict - Upload MRI image and predict brain tumor")
+    print("  POST /predict/tensor - Predict a batch of raw uint8 pixel arrays")
+    print("  POST /jobs - Start an asynchronous prediction job")
+    print("  GET /jobs/<job_id> - Prediction job status and results")
+    print("  GET /drift - Input statistics and drift scores")
+    print("  POST /explain - Grad-CAM heatmap overlay")
     print("  GET /health - Health check")
+    print("  GET /metrics - Operational metrics")
     print("  GET / - API information")
     
     # Load model on startup
     print("Loading model...")
     load_model()
+    get_preprocess_pool()
     
     app.run(debug=True, host='0.0.0.0', port=5000)
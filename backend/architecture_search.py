@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Lightweight architecture search for CPU latency targets
+
+Trains a set of candidate architectures on the local data, optionally prunes
+each one by weight magnitude and fine-tunes it, then measures every model the
+way the backend runs it (batch-1 forward pass on CPU) and reports accuracy and
+ROC AUC on the test split against latency and model size. The plot shows the
+trade-off; with --latency-budget the most accurate model within budget is
+recommended.
+
+Candidates:
+    baseline        BrainTumorDetector.create_model (5 conv blocks, 512/256/128 head)
+    dummy           the architecture from create_dummy_model.py
+    gap             baseline conv blocks with a global-average-pooling head
+    narrow_gap      half-width conv blocks with a GAP head
+    separable_gap   depthwise-separable conv blocks with a GAP head
+    tiny_separable  three narrow separable blocks with a GAP head
+
+Runs on CPU only, e.g. on the synthetic dataset:
+    python generate_sample_data.py --count 4000 --output data_search/train
+    python generate_sample_data.py --count 1000 --output data_search/test --seed 1
+    python architecture_search.py --data-dir data_search --latency-budget 5 --plot search.png
+
+With several --img-size values every candidate is trained and measured at
+each resolution (names get an @<size> suffix), e.g. to see what a 96x96
+triage model gives up against 128x128:
+    python architecture_search.py --data-dir data_search --img-size 64 96 128 --prune
+
+Magnitude pruning zeroes the smallest weights of each layer. Dense CPU kernels
+do not skip zeros, so pruning shows up in the compressed size rather than in
+latency.
+"""
+
+import os
+
+# Latency is measured on the CPU the backend is served from
+os.environ.setdefault('CUDA_VISIBLE_DEVICES', '-1')
+
+import argparse
+import json
+import statistics
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+from tensorflow.keras import layers
+
+from create_dummy_model import build_dummy_architecture
+from evaluate_model import choose_threshold, roc_auc, threshold_sweep
+from serving_model import PIXEL_SCALE
+from train_model import BrainTumorDetector
+
+PRUNABLE_LAYERS = (layers.Conv2D, layers.SeparableConv2D, layers.Dense)
+MIN_PRUNABLE_WEIGHTS = 1000
+
+
+def conv_block(filters, separable=False):
+    conv = layers.SeparableConv2D if separable else layers.Conv2D
+    return [
+        conv(filters, (3, 3), activation='relu', padding='same'),
+        layers.BatchNormalization(),
+        layers.MaxPooling2D((2, 2))
+    ]
+
+
+def gap_head(units=64):
+    return [
+        layers.GlobalAveragePooling2D(),
+        layers.Dense(units, activation='relu'),
+        layers.Dropout(0.3),
+        layers.Dense(1, activation='sigmoid')
+    ]
+
+
+def input_stack(img_size):
+    # uint8 pixels in, scaled to [0, 1] by the model
+    return [layers.Input(shape=(*img_size, 1)), layers.Rescaling(PIXEL_SCALE)]
+
+
+def build_baseline(img_size):
+    return BrainTumorDetector(img_size=img_size).create_model()
+
+
+def build_gap(img_size, widths=(32, 64, 128, 256, 512)):
+    stack = input_stack(img_size)
+    for filters in widths:
+        stack += conv_block(filters)
+    return tf.keras.Sequential(stack + gap_head())
+
+
+def build_narrow_gap(img_size):
+    return build_gap(img_size, widths=(16, 32, 64, 128))
+
+
+def build_separable_gap(img_size, widths=(32, 64, 128, 256)):
+    # A full conv first: a separable conv on one input channel is just a depthwise filter
+    stack = input_stack(img_size) + conv_block(widths[0])
+    for filters in widths[1:]:
+        stack += conv_block(filters, separable=True)
+    return tf.keras.Sequential(stack + gap_head())
+
+
+def build_tiny_separable(img_size):
+    stack = input_stack(img_size) + [layers.Conv2D(16, (3, 3), strides=2, activation='relu', padding='same')]
+    for filters in (32, 64):
+        stack += conv_block(filters, separable=True)
+    return tf.keras.Sequential(stack + gap_head(32))
+
+
+CANDIDATES = {
+    'baseline': build_baseline,
+    'dummy': build_dummy_architecture,
+    'gap': build_gap,
+    'narrow_gap': build_narrow_gap,
+    'separable_gap': build_separable_gap,
+    'tiny_separable': build_tiny_separable
+}
+
+
+def prune_by_magnitude(model, sparsity):
+    """
+    Zero the `sparsity` fraction of smallest-magnitude kernel weights in each
+    large layer. Returns (variable, mask) pairs to keep them at zero while
+    fine-tuning.
+    """
+    masks = []
+    for layer in model.layers:
+        if not isinstance(layer, PRUNABLE_LAYERS):
+            continue
+        for weight in layer.trainable_weights:
+            if 'kernel' not in weight.name:
+                continue
+            values = weight.numpy()
+            if values.size < MIN_PRUNABLE_WEIGHTS:
+                continue
+            cutoff = np.quantile(np.abs(values), sparsity)
+            mask = (np.abs(values) > cutoff).astype(values.dtype)
+            weight.assign(values * mask)
+            masks.append((weight, mask))
+    return masks
+
+
+class KeepPruned(tf.keras.callbacks.Callback):
+    """Re-apply pruning masks after every training step"""
+
+    def __init__(self, masks):
+        super().__init__()
+        self.masks = masks
+
+    def on_train_batch_end(self, batch, logs=None):
+        for weight, mask in self.masks:
+            weight.assign(weight * mask)
+
+
+def sparsity_of(model):
+    total = zeros = 0
+    for weight in model.weights:
+        if 'kernel' in weight.name:
+            values = weight.numpy()
+            total += values.size
+            zeros += int(np.sum(values == 0))
+    return zeros / total if total else 0.0
+
+
+def measure_latency(model, img_size, repeat=100, warmup=10, batch_size=32):
+    """Batch-1 latency percentiles and batched throughput of a compiled forward pass"""
+    forward = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+    single = tf.random.uniform((1, *img_size, 1), maxval=256, dtype=tf.int32)
+    batch = tf.random.uniform((batch_size, *img_size, 1), maxval=256, dtype=tf.int32)
+    single, batch = tf.cast(single, tf.uint8), tf.cast(batch, tf.uint8)
+    for _ in range(warmup):
+        forward(single).numpy()
+        forward(batch).numpy()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        forward(single).numpy()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+
+    start = time.perf_counter()
+    batch_repeat = max(3, repeat // 10)
+    for _ in range(batch_repeat):
+        forward(batch).numpy()
+    batch_seconds = (time.perf_counter() - start) / batch_repeat
+
+    return {
+        'latency_mean_ms': statistics.fmean(samples),
+        'latency_p50_ms': samples[len(samples) // 2],
+        'latency_p90_ms': samples[int(len(samples) * 0.9)],
+        'throughput_images_per_sec': batch_size / batch_seconds
+    }
+
+
+def measure_size(model):
+    """Size of the saved .h5 file, raw and zlib-compressed (where pruning shows)"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'candidate.h5')
+        model.save(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+    return {'size_bytes': len(data), 'compressed_bytes': len(zlib.compress(data, 6))}
+
+
+def score(model, X_val, y_val, X_test, y_test):
+    """
+    Test accuracy at the threshold chosen on the validation split (as
+    evaluate_model.py would), and test ROC AUC. Briefly trained models are often
+    miscalibrated, so a fixed 0.5 cut-off would understate them.
+    """
+    val_sweep = threshold_sweep(y_val, model.predict(X_val, batch_size=256, verbose=0).ravel())
+    threshold = float(val_sweep['threshold'][choose_threshold(val_sweep, 'accuracy')])
+    scores = model.predict(X_test, batch_size=256, verbose=0).ravel()
+    return {
+        'threshold': threshold,
+        'accuracy': float(np.mean((scores >= threshold) == (y_test == 1))),
+        'roc_auc': roc_auc(threshold_sweep(y_test, scores))
+    }
+
+
+def load_test_split(detector, data_dir, shard_dir, limit):
+    if shard_dir:
+        pairs = list(detector.iter_shards(shard_dir, 'test'))
+    else:
+        pairs = [(detector.preprocess_image(path), label)
+                 for path, label in detector.list_images(data_dir, 'test')]
+        pairs = [(image, label) for image, label in pairs if image is not None]
+    pairs = pairs[:limit] if limit else pairs
+    if not pairs:
+        return None, None
+    X = np.array([image for image, _ in pairs])[..., np.newaxis]
+    return X, np.array([label for _, label in pairs])
+
+
+def measure_preprocessing(detector, data_dir, limit=50):
+    """Mean ms to read and preprocess one test image at the detector's size (None without loose files)"""
+    paths = [path for path, _ in detector.list_images(data_dir, 'test')][:limit]
+    if not paths:
+        return None
+    detector.preprocess_image(paths[0])
+    start = time.perf_counter()
+    for path in paths:
+        detector.preprocess_image(path)
+    return (time.perf_counter() - start) / len(paths) * 1000
+
+
+def run_search(args):
+    """Every candidate at every input resolution in --img-size"""
+    results = []
+    for side in args.img_sizes:
+        if len(args.img_sizes) > 1:
+            print(f"\n=== {side}x{side} inputs ===")
+        train_count, test_count = search_resolution(args, side, results)
+    return results, train_count, test_count
+
+
+def search_resolution(args, side, results):
+    img_size = (side, side)
+    # Candidate names carry the resolution when several are compared
+    suffix = f'@{side}' if len(args.img_sizes) > 1 else ''
+    detector = BrainTumorDetector(img_size=img_size, batch_size=args.batch_size)
+    X, y = detector.load_data(args.data_dir, args.shard_dir)
+    if args.limit and len(X) > args.limit:
+        X, _, y, _ = train_test_split(X, y, train_size=args.limit, random_state=args.seed, stratify=y)
+    X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_state=args.seed, stratify=y)
+    X_test, y_test = load_test_split(detector, args.data_dir, args.shard_dir, args.limit)
+    if X_test is None:
+        print("No test split found; reporting validation metrics instead")
+        X_test, y_test = X_val, y_val
+    preprocess_ms = None if args.shard_dir else measure_preprocessing(detector, args.data_dir)
+
+    def record(name, model, train_seconds, base=None, sparsity=None):
+        entry = {
+            'name': name + suffix,
+            'base': base and base + suffix,
+            'img_size': side,
+            'preprocess_ms': preprocess_ms,
+            'target_sparsity': sparsity,
+            'parameters': int(model.count_params()),
+            'weight_sparsity': sparsity_of(model),
+            'train_seconds': train_seconds,
+            **score(model, X_val, y_val, X_test, y_test),
+            **measure_latency(model, img_size, args.latency_repeat),
+            **measure_size(model)
+        }
+        results.append(entry)
+        print(f"  {name}: acc {entry['accuracy']:.4f}, auc {entry['roc_auc']:.4f}, "
+              f"p50 {entry['latency_p50_ms']:.2f} ms, {entry['parameters']:,} params, "
+              f"{entry['compressed_bytes'] / 1e6:.2f} MB compressed")
+        if args.save_dir:
+            os.makedirs(args.save_dir, exist_ok=True)
+            model.save(os.path.join(args.save_dir, f"{entry['name']}.h5"))
+
+    for name in args.candidates:
+        print(f"\nTraining {name}...")
+        tf.keras.utils.set_random_seed(args.seed)
+        model = CANDIDATES[name](img_size)
+        model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate),
+                      loss='binary_crossentropy', metrics=['accuracy'])
+        start = time.perf_counter()
+        model.fit(X_train, y_train, validation_data=(X_val, y_val), epochs=args.epochs,
+                  batch_size=args.batch_size, verbose=args.verbose,
+                  callbacks=[tf.keras.callbacks.EarlyStopping(patience=3, restore_best_weights=True)])
+        record(name, model, time.perf_counter() - start)
+
+        trained_weights = model.get_weights()
+        for sparsity in args.prune:
+            model.set_weights(trained_weights)
+            masks = prune_by_magnitude(model, sparsity)
+            # A fresh optimizer: its state from the dense run does not apply to the masked weights
+            model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=args.learning_rate / 10),
+                          loss='binary_crossentropy', metrics=['accuracy'])
+            start = time.perf_counter()
+            if args.prune_epochs:
+                model.fit(X_train, y_train, validation_data=(X_val, y_val), epochs=args.prune_epochs,
+                          batch_size=args.batch_size, verbose=args.verbose, callbacks=[KeepPruned(masks)])
+            record(f'{name}_pruned{int(sparsity * 100)}', model, time.perf_counter() - start,
+                   base=name, sparsity=sparsity)
+
+    return len(X_train), len(X_test)
+
+
+def recommend(results, budget_ms):
+    """Most accurate model within the latency budget (ties go to the faster one)"""
+    eligible = [r for r in results if budget_ms is None or r['latency_p50_ms'] <= budget_ms]
+    if not eligible:
+        return None
+    return max(eligible, key=lambda r: (r['accuracy'], r['roc_auc'], -r['latency_p50_ms']))
+
+
+def plot_results(results, budget_ms, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(14, 6))
+    for ax, x_key, x_label in ((axes[0], 'latency_p50_ms', 'CPU latency, batch 1, p50 (ms)'),
+                               (axes[1], 'compressed_bytes', 'Compressed model size (bytes)')):
+        for r in results:
+            marker = 'x' if r['base'] else 'o'
+            ax.scatter(r[x_key], r['accuracy'], s=40 + 200 * r['roc_auc'], marker=marker)
+            ax.annotate(r['name'], (r[x_key], r['accuracy']), textcoords='offset points',
+                        xytext=(5, 5), fontsize=8)
+        ax.set_xlabel(x_label)
+        ax.set_ylabel('Test accuracy')
+        ax.grid(alpha=0.3)
+    axes[1].set_xscale('log')
+    if budget_ms is not None:
+        axes[0].axvline(budget_ms, color='red', linestyle='--', label=f'budget {budget_ms} ms')
+        axes[0].legend()
+    axes[0].set_title('Accuracy vs latency (marker size ~ ROC AUC, x = pruned)')
+    axes[1].set_title('Accuracy vs size')
+    plt.tight_layout()
+    plt.savefig(path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train candidate architectures and compare accuracy with CPU latency')
+    parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    parser.add_argument('--shards', dest='shard_dir', help='read the data from packed shards instead')
+    parser.add_argument('--candidates', nargs='+', choices=list(CANDIDATES), default=list(CANDIDATES))
+    parser.add_argument('--prune', type=float, nargs='*', default=[0.5, 0.8],
+                        help='magnitude pruning sparsities applied to every candidate (none to skip)')
+    parser.add_argument('--prune-epochs', type=int, default=1, help='fine-tuning epochs after pruning')
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--learning-rate', type=float, default=0.001)
+    parser.add_argument('--img-size', '--img-sizes', dest='img_sizes', type=int, nargs='+', default=[128],
+                        help='input resolutions to compare (square), e.g. 64 96 128')
+    parser.add_argument('--limit', type=int, help='use at most this many train (and test) images')
+    parser.add_argument('--latency-repeat', type=int, default=100, help='timed batch-1 forward passes')
+    parser.add_argument('--latency-budget', type=float, help='p50 latency budget in ms for the recommendation')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-dir', help='save every trained candidate here as <name>.h5')
+    parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    parser.add_argument('--plot', dest='plot_path', default='architecture_search.png')
+    parser.add_argument('--verbose', type=int, default=0, help='Keras fit verbosity')
+    args = parser.parse_args()
+
+    print("=== Architecture Search (CPU) ===")
+    print(f"TensorFlow {tf.__version__}, {os.cpu_count()} CPUs, intra-op threads "
+          f"{tf.config.threading.get_intra_op_parallelism_threads() or 'default'}")
+    results, train_count, test_count = run_search(args)
+
+    print(f"\n{'model':<32}{'params':>12}{'sparsity':>10}{'acc':>8}{'auc':>8}{'prep ms':>9}"
+          f"{'p50 ms':>9}{'p90 ms':>9}{'img/s':>9}{'MB':>8}{'MB zip':>8}")
+    for r in sorted(results, key=lambda r: r['latency_p50_ms']):
+        prep = '-' if r['preprocess_ms'] is None else f"{r['preprocess_ms']:.2f}"
+        print(f"{r['name']:<32}{r['parameters']:>12,}{r['weight_sparsity']:>10.2f}"
+              f"{r['accuracy']:>8.4f}{r['roc_auc']:>8.4f}{prep:>9}{r['latency_p50_ms']:>9.2f}"
+              f"{r['latency_p90_ms']:>9.2f}{r['throughput_images_per_sec']:>9.0f}"
+              f"{r['size_bytes'] / 1e6:>8.2f}{r['compressed_bytes'] / 1e6:>8.2f}")
+
+    best = recommend(results, args.latency_budget)
+    budget = f"within {args.latency_budget} ms" if args.latency_budget is not None else "overall"
+    if best is None:
+        print(f"\nNo candidate meets the {args.latency_budget} ms budget")
+    else:
+        print(f"\nRecommended {budget}: {best['name']} "
+              f"(accuracy {best['accuracy']:.4f}, p50 {best['latency_p50_ms']:.2f} ms)")
+
+    if args.plot_path:
+        plot_results(results, args.latency_budget, args.plot_path)
+        print(f"Plot saved to {args.plot_path}")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump({
+                'config': vars(args),
+                'train_images': train_count,
+                'test_images': test_count,
+                'recommended': best['name'] if best else None,
+                'results': results
+            }, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Micro-batching predictor
+
+A forward pass over 32 images costs far less than 32 forward passes over one
+image: the per-call overhead is paid once and the convolutions run on larger
+matrices. `BatchPredictor` collects the images submitted by concurrent
+requests and runs them through the model together:
+
+- callers hand in a (N, H, W, 1) uint8 batch and block until its
+  probabilities are ready
+- a single worker thread takes the oldest pending batch, then keeps adding
+  pending batches until BATCH_MAX_SIZE images are collected or BATCH_MAX_WAIT_MS
+  has passed since the first one arrived
+- batches larger than the limit are split and run back to back
+- the forward pass is a traced tf.function; the batch dimension is left
+  unspecified, so varying batch sizes do not retrace
+
+Queue wait, batch sizes and forward-pass time are reported by `stats()`.
+"""
+
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from metrics import LatencyWindow
+
+
+class _Pending:
+    """A submitted batch waiting for its probabilities"""
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchPredictor:
+    """Runs a Keras model on batches merged from concurrent callers"""
+
+    def __init__(self, model, max_batch_size=64, max_wait_ms=2.0):
+        import tensorflow as tf
+
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.input_shape = tuple(model.input_shape[1:])
+        signature = [tf.TensorSpec((None, *self.input_shape), tf.uint8)]
+        self._forward = tf.function(lambda x: model(x, training=False), input_signature=signature)
+        # Trace now rather than on the first request
+        self._forward(np.zeros((1, *self.input_shape), dtype=np.uint8))
+
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._worker = None
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._images = 0
+        self._batches = 0
+        self._queue_wait = LatencyWindow()
+        self._inference = LatencyWindow()
+
+    def predict(self, tensor, timeout=None):
+        """Probabilities (N,) for a (N, H, W, 1) uint8 batch"""
+        tensor = np.asarray(tensor, dtype=np.uint8)
+        if tensor.shape[1:] != self.input_shape:
+            raise ValueError(f"expected images of shape {self.input_shape}, got {tensor.shape[1:]}")
+        pending = _Pending(tensor)
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='batch-predictor', daemon=True)
+                self._worker.start()
+            self._pending.append(pending)
+            self._cond.notify()
+        if not pending.done.wait(timeout):
+            raise TimeoutError(f"prediction did not finish within {timeout} s")
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self):
+        """Pending batches for the next forward pass (blocks until there is one)"""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            taken = [self._pending.popleft()]
+            images = len(taken[0].tensor)
+            deadline = taken[0].submitted + self.max_wait
+            while images < self.max_batch_size:
+                if not self._pending:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        break
+                    continue
+                if images + len(self._pending[0].tensor) > self.max_batch_size:
+                    break
+                taken.append(self._pending.popleft())
+                images += len(taken[-1].tensor)
+            return taken
+
+    def _run(self):
+        while True:
+            taken = self._collect()
+            start = time.perf_counter()
+            try:
+                batch = taken[0].tensor if len(taken) == 1 else np.concatenate([p.tensor for p in taken])
+                probabilities = np.concatenate([
+                    self._forward(batch[i:i + self.max_batch_size]).numpy()[:, 0]
+                    for i in range(0, len(batch), self.max_batch_size)
+                ])
+            except Exception as e:
+                for pending in taken:
+                    pending.error = e
+                    pending.done.set()
+                continue
+            finished = time.perf_counter()
+
+            offset = 0
+            for pending in taken:
+                pending.result = probabilities[offset:offset + len(pending.tensor)]
+                offset += len(pending.tensor)
+                pending.done.set()
+            with self._stats_lock:
+                self._requests += len(taken)
+                self._images += len(batch)
+                self._batches += -(-len(batch) // self.max_batch_size)
+                for pending in taken:
+                    self._queue_wait.add(start - pending.submitted)
+                self._inference.add(finished - start)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': round(self.max_wait * 1000, 2),
+                'requests': self._requests,
+                'images': self._images,
+                'forward_passes': self._batches,
+                'avg_batch_size': round(self._images / self._batches, 2) if self._batches else None,
+                'queue_wait': self._queue_wait.summary(),
+                'inference': self._inference.summary()
+            }
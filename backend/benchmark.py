@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark harness for the brain tumor detection pipeline
+
+Times the individual steps of the preprocessing pipeline used by the backend
+(`app.preprocess_mri_image`) and the trainer
+(`BrainTumorDetector.preprocess_image`), as well as model inference at
+different batch sizes. All inputs are synthetic images produced by
+`generate_sample_data.create_synthetic_mri_image`.
+
+Usage:
+    python benchmark.py                          # run every group
+    python benchmark.py --groups stages clahe    # run selected groups
+    python benchmark.py --json bench.json        # also export results as JSON
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+
+from generate_sample_data import create_synthetic_mri_image
+
+GROUPS = ['stages', 'clahe', 'interpolation', 'dtype', 'end_to_end', 'inference', 'tta', 'explain', 'uploads',
+          'preprocess_pool', 'uint8', 'tensor_api', 'retries']
+
+
+def time_callable(fn, repeat=200, warmup=10):
+    """Call fn repeatedly and return the wall time of each call in seconds"""
+    for _ in range(warmup):
+        fn()
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(sorted_samples, pct):
+    """Linear-interpolated percentile of an already sorted list"""
+    if len(sorted_samples) == 1:
+        return sorted_samples[0]
+    rank = (len(sorted_samples) - 1) * pct / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_samples) - 1)
+    weight = rank - lower
+    return sorted_samples[lower] * (1 - weight) + sorted_samples[upper] * weight
+
+
+def summarize(samples, items=1):
+    """
+    Summarize timing samples (seconds) as milliseconds.
+    `items` is the number of images processed per call, used for throughput.
+    """
+    ordered = sorted(samples)
+    mean = statistics.fmean(ordered)
+    return {
+        'n': len(ordered),
+        'mean_ms': mean * 1000,
+        'stdev_ms': (statistics.stdev(ordered) if len(ordered) > 1 else 0.0) * 1000,
+        'min_ms': ordered[0] * 1000,
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p90_ms': percentile(ordered, 90) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+        'items_per_call': items,
+        'items_per_sec': items / mean if mean > 0 else float('inf')
+    }
+
+
+def bench_stages(image, image_path, args):
+    """Time each step of the backend preprocessing pipeline in isolation"""
+    color = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    resized = cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA)
+    blurred = cv2.GaussianBlur(resized, (5, 5), 0)
+    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    enhanced = clahe.apply(blurred)
+    normalized = enhanced.astype(np.float32) / 255.0
+
+    cases = {
+        'imread': lambda: cv2.imread(image_path),
+        'cvtColor_bgr2gray': lambda: cv2.cvtColor(color, cv2.COLOR_BGR2GRAY),
+        'resize_area_128': lambda: cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA),
+        'gaussian_blur_5x5': lambda: cv2.GaussianBlur(resized, (5, 5), 0),
+        'clahe_apply': lambda: clahe.apply(blurred),
+        'normalize_float32': lambda: enhanced.astype(np.float32) / 255.0,
+        'reshape': lambda: normalized.reshape(1, 128, 128, 1)
+    }
+    return {name: summarize(time_callable(fn, args.repeat, args.warmup))
+            for name, fn in cases.items()}
+
+
+def bench_clahe(image, image_path, args):
+    """Compare constructing a CLAHE object per call against reusing one"""
+    blurred = cv2.GaussianBlur(cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA), (5, 5), 0)
+    shared = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+
+    cases = {
+        'create_only': lambda: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)),
+        'create_and_apply': lambda: cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(blurred),
+        'reuse_apply': lambda: shared.apply(blurred)
+    }
+    return {name: summarize(time_callable(fn, args.repeat, args.warmup))
+            for name, fn in cases.items()}
+
+
+def bench_interpolation(image, image_path, args):
+    """Compare resize interpolation modes for the source size -> 128x128"""
+    modes = {
+        'INTER_AREA': cv2.INTER_AREA,
+        'INTER_LINEAR': cv2.INTER_LINEAR,
+        'INTER_NEAREST': cv2.INTER_NEAREST,
+        'INTER_CUBIC': cv2.INTER_CUBIC,
+        'INTER_LANCZOS4': cv2.INTER_LANCZOS4
+    }
+    return {name: summarize(time_callable(
+                lambda flag=flag: cv2.resize(image, (128, 128), interpolation=flag),
+                args.repeat, args.warmup))
+            for name, flag in modes.items()}
+
+
+def bench_dtype(image, image_path, args):
+    """Compare ways of converting the uint8 128x128 image to normalized float32"""
+    enhanced = cv2.resize(image, (128, 128), interpolation=cv2.INTER_AREA)
+    out = np.empty(enhanced.shape, dtype=np.float32)
+    scale = np.float32(1.0 / 255.0)
+
+    def multiply_into():
+        np.multiply(enhanced, scale, out=out, casting='unsafe')
+        return out
+
+    cases = {
+        'astype_div': lambda: enhanced.astype(np.float32) / 255.0,
+        'astype_mul': lambda: enhanced.astype(np.float32) * scale,
+        'multiply_preallocated': multiply_into,
+        'astype_float64_div': lambda: enhanced.astype(np.float64) / 255.0
+    }
+    return {name: summarize(time_callable(fn, args.repeat, args.warmup))
+            for name, fn in cases.items()}
+
+
+def bench_end_to_end(image, image_path, args):
+    """Time the full backend and trainer preprocessing functions from disk"""
+    from app import model_preprocessing, preprocess_mri_image
+    from train_model import BrainTumorDetector
+
+    # Both at the served model's input size and preprocessing parameters
+    options = dict(model_preprocessing())
+    detector = BrainTumorDetector(img_size=options.pop('size'), preprocessing=options)
+    cases = {
+        'app.preprocess_mri_image': lambda: preprocess_mri_image(image_path),
+        'BrainTumorDetector.preprocess_image': lambda: detector.preprocess_image(image_path)
+    }
+    return {name: summarize(time_callable(fn, args.repeat, args.warmup))
+            for name, fn in cases.items()}
+
+
+def bench_inference(image, image_path, args):
+    """Time model inference per batch size with the model the backend serves"""
+    from app import load_model, preprocess_mri_image
+
+    model = load_model()
+    sample = preprocess_mri_image(image_path)
+    results = {}
+    for batch_size in args.batch_sizes:
+        batch = np.repeat(sample, batch_size, axis=0)
+        repeat = max(3, args.repeat // max(1, batch_size // 4))
+        results[f'predict_batch_{batch_size}'] = summarize(
+            time_callable(lambda: model.predict(batch, verbose=0), repeat, args.warmup),
+            items=batch_size
+        )
+        results[f'call_batch_{batch_size}'] = summarize(
+            time_callable(lambda: model(batch, training=False), repeat, args.warmup),
+            items=batch_size
+        )
+    return results
+
+
+def bench_tta(image, image_path, args):
+    """Latency of test-time augmentation per variant count against a plain prediction"""
+    from app import load_model, preprocess_mri_image
+    from tta import MAX_VARIANTS, TestTimeAugmenter, augment_batch
+
+    model = load_model()
+    sample = preprocess_mri_image(image_path)
+    augmenter = TestTimeAugmenter(max_variants=MAX_VARIANTS)
+    repeat = max(3, args.repeat // 4)
+    results = {'plain_predict': summarize(
+        time_callable(lambda: model.predict(sample, verbose=0), repeat, args.warmup))}
+    plain_ms = results['plain_predict']['mean_ms']
+    for count in range(1, MAX_VARIANTS + 1):
+        results[f'augment_{count}'] = summarize(
+            time_callable(lambda: augment_batch(sample, count), repeat, args.warmup), items=count)
+        stats = summarize(
+            time_callable(lambda: augmenter.predict(model, sample, count), repeat, args.warmup), items=count)
+        stats['overhead_ms'] = stats['mean_ms'] - plain_ms
+        results[f'tta_{count}_variants'] = stats
+    return results
+
+
+def bench_explain(image, image_path, args):
+    """
+    Grad-CAM latency against a plain prediction: the fused forward pass that
+    caches feature maps, explanations with a warm and a cold activation cache,
+    and rendering the overlay
+    """
+    from app import load_model, preprocess_mri_image
+    from explain import GradCamExplainer, render_overlay
+
+    model = load_model()
+    explainer = GradCamExplainer(model, cache_size=1)
+    sample = preprocess_mri_image(image_path)
+    repeat = max(3, args.repeat // 4)
+    explainer.predict(sample, key='warm')
+    _, heatmap, _ = explainer.explain('warm', lambda: sample)
+    misses = iter(range(10 ** 9))
+    cases = {
+        'model.predict': lambda: model.predict(sample, verbose=0),
+        'predict_caching_activations': lambda: explainer.predict(sample, key='warm'),
+        'explain_cache_hit': lambda: explainer.explain('warm', lambda: sample),
+        'explain_cache_miss': lambda: explainer.explain(
+            f'miss-{next(misses)}', lambda: preprocess_mri_image(image_path)),
+        'render_overlay': lambda: render_overlay(image_path, heatmap)
+    }
+    return {name: summarize(time_callable(fn, repeat, args.warmup)) for name, fn in cases.items()}
+
+
+class CountingStream:
+    """Wraps a WSGI input stream and counts the bytes the application reads"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.bytes_read += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.bytes_read += len(data)
+        return data
+
+
+def rejected_upload_payloads():
+    """Uploads the backend must refuse, as (name, filename, body bytes)"""
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (2000, 2000), dtype=np.uint8)
+    wide = rng.integers(0, 256, (300, 9000), dtype=np.uint8)
+    return [
+        ('bad_magic', 'scan.png', rng.integers(0, 256, 8 * 1024 * 1024, dtype=np.uint8).tobytes()),
+        ('bad_extension', 'scan.exe', cv2.imencode('.png', noise)[1].tobytes()),
+        ('oversized_dimensions', 'scan.png', cv2.imencode('.png', wide)[1].tobytes())
+    ]
+
+
+def bench_uploads(image, image_path, args):
+    """
+    Bytes read and CPU spent on uploads that end up rejected, with the plain
+    Werkzeug request class (before) and the streaming validator (after).
+    """
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+    import app as backend
+    from upload_stream import ValidatingRequest
+
+    repeat = max(3, args.repeat // 20)
+    results = {}
+    original_class = backend.app.request_class
+    try:
+        for name, filename, body in rejected_upload_payloads():
+            for mode, request_class in (('before', Request), ('after', ValidatingRequest)):
+                backend.app.request_class = request_class
+                wall, cpu, read = [], [], []
+                for _ in range(repeat):
+                    builder = EnvironBuilder(path='/preprocess', method='POST',
+                                             data={'file': (io.BytesIO(body), filename)})
+                    environ = builder.get_environ()
+                    counter = CountingStream(environ['wsgi.input'])
+                    environ['wsgi.input'] = counter
+                    statuses = []
+
+                    wall_start, cpu_start = time.perf_counter(), time.process_time()
+                    response = backend.app(environ, lambda status, headers, exc_info=None: statuses.append(status))
+                    b''.join(response)
+                    wall.append(time.perf_counter() - wall_start)
+                    cpu.append(time.process_time() - cpu_start)
+                    read.append(counter.bytes_read)
+                    builder.close()
+
+                stats = summarize(wall)
+                stats['status'] = statuses[0]
+                stats['upload_bytes'] = len(body)
+                stats['bytes_read'] = int(statistics.fmean(read))
+                stats['wasted_fraction'] = stats['bytes_read'] / len(body)
+                stats['cpu_ms'] = statistics.fmean(cpu) * 1000
+                results[f'{name}_{mode}'] = stats
+    finally:
+        backend.app.request_class = original_class
+    return results
+
+
+def bench_preprocess_pool(image, image_path, args):
+    """
+    Concurrent requests (preprocessing plus a batch-1 forward pass) with
+    preprocessing in the request threads against the worker pool: latency,
+    throughput, and CPU used by the web process and by the workers
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    import tensorflow as tf
+    from app import load_model, model_preprocessing
+    from preprocessing import PreprocessPool, preprocess_bytes
+
+    model = load_model()
+    forward = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+    forward(tf.zeros((1, *model.input_shape[1:])))
+    options = model_preprocessing()
+    # A typical upload is larger than the synthetic source image
+    data = cv2.imencode('.png', cv2.resize(image, (512, 512), interpolation=cv2.INTER_CUBIC))[1].tobytes()
+    requests = max(50, args.repeat)
+    results = {}
+
+    with PreprocessPool(workers=args.preprocess_workers, **options) as pool:
+        modes = {
+            'in_process': lambda: preprocess_bytes(data, **options),
+            'worker_pool': lambda: pool.preprocess(data)
+        }
+        for mode, preprocess in modes.items():
+            def handle(_):
+                start = time.perf_counter()
+                forward(preprocess()[np.newaxis, :, :, np.newaxis]).numpy()
+                return time.perf_counter() - start
+
+            for concurrency in args.concurrency:
+                with ThreadPoolExecutor(concurrency) as executor:
+                    list(executor.map(handle, range(args.warmup)))
+                    worker_cpu = pool.stats()['worker_cpu_seconds']
+                    wall_start, cpu_start = time.perf_counter(), time.process_time()
+                    latencies = list(executor.map(handle, range(requests)))
+                    wall = time.perf_counter() - wall_start
+                    web_cpu = time.process_time() - cpu_start
+                worker_cpu = pool.stats()['worker_cpu_seconds'] - worker_cpu
+
+                stats = summarize(latencies)
+                stats['concurrency'] = concurrency
+                stats['throughput'] = requests / wall
+                stats['web_cpu_ms_per_request'] = web_cpu / requests * 1000
+                stats['worker_cpu_ms_per_request'] = worker_cpu / requests * 1000
+                stats['cpu_utilization'] = (web_cpu + worker_cpu) / (wall * (os.cpu_count() or 1))
+                results[f'{mode}_c{concurrency}'] = stats
+    return results
+
+
+def bench_uint8(image, image_path, args):
+    """
+    Forward pass on uint8 tensors scaled by the model's Rescaling layer against
+    float32 tensors scaled beforehand (the previous pipeline): latency, bytes
+    per batch and the largest difference in the predicted probabilities
+    """
+    import tensorflow as tf
+    from app import load_model, model_preprocessing
+    from preprocessing import preprocess_bytes
+
+    model = load_model()
+    layers = [layer for layer in model.layers if not isinstance(layer, tf.keras.layers.InputLayer)]
+    if not isinstance(model, tf.keras.Sequential) or not isinstance(layers[0], tf.keras.layers.Rescaling):
+        print("uint8: the served model is not a Sequential starting with Rescaling; skipped")
+        return {}
+    unscaled = tf.keras.Sequential([tf.keras.Input(shape=model.input_shape[1:]), *layers[1:]])
+    forward = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+    forward_unscaled = tf.function(lambda x: unscaled(x, training=False), reduce_retracing=True)
+
+    options = model_preprocessing()
+    rng = np.random.default_rng(args.seed)
+    images = []
+    for i in range(max(args.batch_sizes)):
+        source = create_synthetic_mri_image(has_tumor=bool(i % 2), size=(args.size, args.size))
+        source = np.clip(source.astype(np.int16) + rng.integers(-8, 9, source.shape), 0, 255).astype(np.uint8)
+        images.append(preprocess_bytes(cv2.imencode('.png', source)[1].tobytes(), **options))
+    pixels = np.stack(images)[..., np.newaxis]
+
+    results = {}
+    for batch_size in args.batch_sizes:
+        batch = pixels[:batch_size]
+        scaled = batch.astype(np.float32) / 255.0
+        repeat = max(3, args.repeat // max(1, batch_size // 4))
+        probabilities = forward(batch).numpy().ravel()
+        difference = float(np.max(np.abs(probabilities - forward_unscaled(scaled).numpy().ravel())))
+        for name, fn, tensor in (('uint8', forward, batch), ('float32', forward_unscaled, scaled)):
+            stats = summarize(time_callable(lambda: fn(tensor).numpy(), repeat, args.warmup), items=batch_size)
+            stats['tensor_bytes'] = tensor.nbytes
+            stats['max_abs_probability_diff'] = difference
+            results[f'{name}_batch_{batch_size}'] = stats
+    return results
+
+
+def multipart_body(filename, data, boundary='benchmark-boundary'):
+    """(body, content type) of a multipart/form-data upload with one `file` field"""
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: image/png\r\n\r\n')
+    body = head.encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class LocalServer:
+    """The backend app on a local port, for benchmarks over real HTTP, without the per-client rate limit"""
+
+    def __init__(self):
+        import logging
+        import threading
+
+        from werkzeug.serving import make_server
+
+        import app as backend
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no line per request
+        self.backend = backend
+        self.server = make_server('127.0.0.1', 0, backend.app, threaded=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        # The benchmark is a single client sending as fast as it can
+        self._client_rate, backend.admission.client_rate = backend.admission.client_rate, 0
+
+    def post(self, path, body, content_type, headers=None):
+        """POST and return (status, response headers); RuntimeError unless the status is 200"""
+        import http.client
+
+        connection = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=60)
+        try:
+            connection.request('POST', path, body=body, headers={'Content-Type': content_type, **(headers or {})})
+            response = connection.getresponse()
+            payload = response.read()
+            if response.status != 200:
+                raise RuntimeError(f"{path} returned {response.status}: {payload[:200]!r}")
+            return response.status, dict(response.getheaders())
+        finally:
+            connection.close()
+
+    def close(self):
+        self.backend.admission.client_rate = self._client_rate
+        self.server.shutdown()
+
+
+def bench_tensor_api(image, image_path, args):
+    """
+    End-to-end throughput over HTTP: one PNG per multipart /predict upload
+    against batches of raw arrays on /predict/tensor, raw and preprocessed.
+    Client-side encoding is part of every request, as it is for a service
+    that holds decoded pixels.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from preprocessing import preprocess_gray
+    from tensor_format import CONTENT_TYPE, encode_tensors
+
+    server = LocalServer()
+    options = server.backend.model_preprocessing()
+    source = cv2.resize(image, (512, 512), interpolation=cv2.INTER_CUBIC)
+    preprocessed = preprocess_gray(source, **options)
+    post = server.post
+
+    def png_request(i):
+        body, content_type = multipart_body(f'benchmark_{i}.png', cv2.imencode('.png', source)[1].tobytes())
+        post('/predict', body, content_type)
+
+    def tensor_request(batch_size, array, query=''):
+        return lambda i: post('/predict/tensor' + query, encode_tensors([array] * batch_size), CONTENT_TYPE)
+
+    cases = {'png_predict': (1, png_request)}
+    for batch_size in args.batch_sizes:
+        cases[f'tensor_batch_{batch_size}'] = (batch_size, tensor_request(batch_size, source))
+        cases[f'tensor_preprocessed_batch_{batch_size}'] = (
+            batch_size, tensor_request(batch_size, preprocessed, '?preprocessed=1'))
+
+    images = max(64, args.repeat)
+    results = {}
+    try:
+        for name, (batch_size, send) in cases.items():
+            requests = max(4, images // batch_size)
+            for concurrency in args.concurrency:
+                def handle(i):
+                    start = time.perf_counter()
+                    send(i)
+                    return time.perf_counter() - start
+
+                with ThreadPoolExecutor(concurrency) as executor:
+                    list(executor.map(handle, range(min(args.warmup, requests))))
+                    wall_start = time.perf_counter()
+                    latencies = list(executor.map(handle, range(requests)))
+                    wall = time.perf_counter() - wall_start
+                stats = summarize(latencies, items=batch_size)
+                stats['concurrency'] = concurrency
+                stats['images_per_sec'] = requests * batch_size / wall
+                results[f'{name}_c{concurrency}'] = stats
+    finally:
+        server.close()
+    return results
+
+
+def bench_retries(image, image_path, args):
+    """
+    Retry-heavy /predict load over HTTP, with request coalescing off and on:
+    every distinct upload is sent once, then `--retries` more times while the
+    first is in flight, and once more after all have answered, all with the
+    same Idempotency-Key. Counts the model invocations (pipeline runs)
+    against the requests served.
+    """
+    import uuid
+    from concurrent.futures import ThreadPoolExecutor
+
+    from coalesce import RequestCoalescer
+
+    server = LocalServer()
+    backend = server.backend
+    backend.load_model()
+    rng = np.random.default_rng(args.seed)
+    uploads = []
+    for i in range(max(8, args.repeat // 8)):
+        source = create_synthetic_mri_image(has_tumor=bool(i % 2), size=(512, 512))
+        source = np.clip(source.astype(np.int16) + rng.integers(-8, 9, source.shape), 0, 255).astype(np.uint8)
+        uploads.append(multipart_body(f'retry_{i}.png', cv2.imencode('.png', source)[1].tobytes()))
+
+    def timed_post(body, content_type, key, delay=0.0):
+        time.sleep(delay)
+        start = time.perf_counter()
+        server.post('/predict', body, content_type, headers={'Idempotency-Key': key})
+        return time.perf_counter() - start
+
+    def episode(i):
+        body, content_type = uploads[i]
+        key = uuid.uuid4().hex
+        with ThreadPoolExecutor(args.retries + 1) as executor:
+            # Retries 5 ms apart, while the first request is still running
+            latencies = list(executor.map(lambda attempt: timed_post(body, content_type, key, attempt * 0.005),
+                                          range(args.retries + 1)))
+        # A late retry: the response got lost after the server had answered
+        latencies.append(timed_post(body, content_type, key))
+        return latencies
+
+    original = backend.coalescer
+    results = {}
+    concurrency = max(args.concurrency)
+    try:
+        for enabled in (False, True):
+            backend.coalescer = RequestCoalescer(enabled=enabled, wait_timeout=original.wait_timeout)
+            wall_start = time.perf_counter()
+            with ThreadPoolExecutor(max(1, concurrency // (args.retries + 1))) as executor:
+                latencies = [latency for run in executor.map(episode, range(len(uploads))) for latency in run]
+            wall = time.perf_counter() - wall_start
+            counts = backend.coalescer.stats()
+            stats = summarize(latencies)
+            stats['requests'] = counts['requests']
+            stats['model_invocations'] = counts['computed']
+            stats['invocations_saved'] = counts['requests'] - counts['computed']
+            stats['coalesced'] = counts['coalesced']
+            stats['replayed'] = counts['replayed']
+            stats['requests_per_sec'] = counts['requests'] / wall
+            results['coalescing_on' if enabled else 'coalescing_off'] = stats
+    finally:
+        backend.coalescer = original
+        server.close()
+    return results
+
+
+BENCHMARKS = {
+    'stages': bench_stages,
+    'clahe': bench_clahe,
+    'interpolation': bench_interpolation,
+    'dtype': bench_dtype,
+    'end_to_end': bench_end_to_end,
+    'inference': bench_inference,
+    'tta': bench_tta,
+    'explain': bench_explain,
+    'uploads': bench_uploads,
+    'preprocess_pool': bench_preprocess_pool,
+    'uint8': bench_uint8,
+    'tensor_api': bench_tensor_api,
+    'retries': bench_retries
+}
+
+
+def environment_info():
+    """Describe the machine and library versions the numbers were taken on"""
+    info = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'opencv_threads': cv2.getNumThreads()
+    }
+    try:
+        import tensorflow as tf
+        info['tensorflow'] = tf.__version__
+    except ImportError:
+        info['tensorflow'] = None
+    return info
+
+
+def print_results(group, results):
+    """Print one benchmark group as a table"""
+    print(f"\n== {group} ==")
+    print(f"{'case':<38}{'mean':>10}{'stdev':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'items/s':>12}")
+    for name, stats in results.items():
+        print(f"{name:<38}"
+              f"{stats['mean_ms']:>10.4f}{stats['stdev_ms']:>10.4f}"
+              f"{stats['p50_ms']:>10.4f}{stats['p90_ms']:>10.4f}{stats['p99_ms']:>10.4f}"
+              f"{stats['items_per_sec']:>12.1f}")
+        if 'overhead_ms' in stats:
+            print(f"{'':<38}overhead vs plain predict {stats['overhead_ms']:+.2f} ms")
+        if 'cpu_utilization' in stats:
+            print(f"{'':<38}{stats['throughput']:.1f} req/s, web cpu {stats['web_cpu_ms_per_request']:.2f} ms/req, "
+                  f"worker cpu {stats['worker_cpu_ms_per_request']:.2f} ms/req, "
+                  f"utilization {stats['cpu_utilization']:.0%}")
+        if 'tensor_bytes' in stats:
+            print(f"{'':<38}{stats['tensor_bytes']:,} bytes per batch, max |probability diff| "
+                  f"uint8 vs float32 {stats['max_abs_probability_diff']:.2e}")
+        if 'images_per_sec' in stats:
+            print(f"{'':<38}{stats['images_per_sec']:.1f} images/s end to end at concurrency {stats['concurrency']}")
+        if 'model_invocations' in stats:
+            print(f"{'':<38}{stats['requests']} requests, {stats['model_invocations']} model invocations "
+                  f"({stats['invocations_saved']} saved: {stats['coalesced']} coalesced, "
+                  f"{stats['replayed']} replayed), {stats['requests_per_sec']:.1f} req/s")
+        if 'bytes_read' in stats:
+            print(f"{'':<38}status {stats['status']}, read {stats['bytes_read']:,} of "
+                  f"{stats['upload_bytes']:,} bytes, cpu {stats['cpu_ms']:.2f} ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Microbenchmarks for preprocessing and inference')
+    parser.add_argument('--groups', nargs='+', choices=GROUPS, default=GROUPS,
+                        help='benchmark groups to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=200, help='timed iterations per case')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed iterations per case')
+    parser.add_argument('--size', type=int, default=256, help='side length of the synthetic source image')
+    parser.add_argument('--tumor', action='store_true', help='use a synthetic image with a tumor')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 64],
+                        help='batch sizes for the inference, uint8 and tensor_api groups')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help='concurrent requests for the preprocess_pool and tensor_api groups')
+    parser.add_argument('--preprocess-workers', type=int, default=os.cpu_count() or 2,
+                        help='worker processes for the preprocess_pool group')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='duplicate uploads sent while the first is in flight, for the retries group')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic image')
+    parser.add_argument('--json', dest='json_path', help='write results to this JSON file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    image = create_synthetic_mri_image(has_tumor=args.tumor, size=(args.size, args.size))
+
+    report = {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'environment': environment_info(),
+        'config': {
+            'groups': args.groups,
+            'repeat': args.repeat,
+            'warmup': args.warmup,
+            'size': args.size,
+            'tumor': args.tumor,
+            'batch_sizes': args.batch_sizes,
+            'concurrency': args.concurrency,
+            'preprocess_workers': args.preprocess_workers,
+            'retries': args.retries,
+            'seed': args.seed
+        },
+        'results': {}
+    }
+
+    print("=== Brain Tumor Detection Microbenchmarks ===")
+    print(f"Synthetic image: {args.size}x{args.size}, tumor={args.tumor}, "
+          f"{args.repeat} iterations per case (times in ms)")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        image_path = os.path.join(tmp_dir, 'synthetic.png')
+        cv2.imwrite(image_path, image)
+
+        for group in args.groups:
+            results = BENCHMARKS[group](image, image_path, args)
+            report['results'][group] = results
+            print_results(group, results)
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.json_path}")
+
+    return report
+
+
+if __name__ == '__main__':
+    main()
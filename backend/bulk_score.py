@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""
+Offline bulk scoring for archived MRI slices
+
+Scores directories of images without going through HTTP /predict, with the
+backend's model loading (serving artifact, uint8 input scaling) and the
+preprocessing parameters the model was trained with:
+
+- inputs come from a directory (walked recursively in sorted order) or from a
+  manifest listing one image path per line (relative to the manifest)
+- I/O threads read and hash the files, --workers processes decode and
+  preprocess them (the backend's PreprocessPool; 0 decodes in this process),
+  and the model scores them in batches of --batch-size while the next batch
+  is being decoded
+- results are written as a Parquet dataset, one part file per --part-size
+  inputs (rounded up to whole batches), with the file path, SHA-256, tumor probability, prediction at the
+  model's decision threshold, model version (hash of the weights) and the
+  error for files that could not be read or decoded
+- after every part, _progress.json records how many inputs are done; running
+  the same command again resumes after the last complete part. The inputs
+  and the model must be unchanged (--restart starts over)
+
+Usage:
+    python bulk_score.py score --input /archive/slices --output scores/
+    python bulk_score.py score --manifest slices.txt --output scores/ --workers 4
+    python bulk_score.py bench --input /archive/slices --workers 0 1 2 4 --limit 2000
+
+The parts read back as one table:
+    pyarrow.parquet.read_table('scores/')      pandas.read_parquet('scores/')
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ingest import is_image
+
+MODEL_PATH = os.path.join('model', 'brain_tumor_model.h5')
+MODEL_INFO_PATH = os.path.join('model', 'model_info.json')
+PROGRESS_NAME = '_progress.json'  # pyarrow skips files starting with '_'
+PART_PATTERN = 'part-{:05d}.parquet'
+DEFAULT_THRESHOLD = 0.5
+
+
+def list_inputs(input_dir=None, manifest=None):
+    """Image paths under `input_dir` in sorted order, or the paths listed in `manifest`"""
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest) as f:
+            lines = [line.strip() for line in f]
+        return [os.path.join(base, line) for line in lines if line and not line.startswith('#')]
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if is_image(name))
+    return paths
+
+
+def inputs_fingerprint(paths):
+    """Identifies the input list a checkpoint belongs to"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode('utf-8', 'surrogateescape') + b'\n')
+    return digest.hexdigest()[:16]
+
+
+def load_scoring_model(model_path, info_path):
+    """(model, preprocessing options, decision threshold, model version)"""
+    from model_artifact import load_serving_model, weights_version
+    from preprocessing import load_preprocessing_options
+    from serving_model import with_input_scaling
+
+    model = with_input_scaling(load_serving_model(model_path))
+    options = load_preprocessing_options(info_path, model.input_shape)
+    threshold = DEFAULT_THRESHOLD
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            threshold = float(json.load(f).get('decision_threshold', DEFAULT_THRESHOLD))
+    return model, options, threshold, weights_version(model)
+
+
+def output_schema(threshold, options):
+    import pyarrow as pa
+
+    return pa.schema([
+        ('path', pa.string()),
+        ('sha256', pa.string()),
+        ('probability', pa.float32()),
+        ('tumor', pa.bool_()),
+        ('model_version', pa.string()),
+        ('error', pa.string())
+    ], metadata={'decision_threshold': str(threshold), 'preprocessing': json.dumps(options)})
+
+
+def write_part(output_dir, index, rows, schema):
+    """Write one part file atomically (a temp file renamed into place)"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {name: [row[name] for row in rows] for name in schema.names}
+    path = os.path.join(output_dir, PART_PATTERN.format(index))
+    pq.write_table(pa.Table.from_pydict(columns, schema=schema), path + '.tmp')
+    os.replace(path + '.tmp', path)
+    return os.path.basename(path)
+
+
+def load_progress(output_dir):
+    path = os.path.join(output_dir, PROGRESS_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_progress(output_dir, progress):
+    path = os.path.join(output_dir, PROGRESS_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def remove_parts(output_dir, keep=()):
+    """Delete part files not listed in `keep` (left over from an interrupted or earlier run)"""
+    for path in glob.glob(os.path.join(output_dir, 'part-*.parquet*')):
+        if os.path.basename(path) not in keep:
+            os.remove(path)
+
+
+def file_loader(pool, options):
+    """load(path) -> (sha256, uint8 (H, W) tensor, error); decodes in `pool` when given"""
+    from preprocessing import preprocess_bytes
+
+    def load(path):
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            return None, None, str(e)
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            tensor = pool.preprocess(data) if pool is not None else preprocess_bytes(data, **options)
+        except Exception as e:
+            return digest, None, str(e) or type(e).__name__
+        return digest, tensor, None
+    return load
+
+
+def score_batches(paths, load, predictor, batch_size, threshold, version, threads):
+    """
+    Yield lists of result rows, one per batch of `paths`, in input order.
+    Loads run up to two batches ahead of the batch being scored.
+    """
+    def score(loaded):
+        rows = []
+        tensors = []
+        for path, (digest, tensor, error) in loaded:
+            rows.append({'path': path, 'sha256': digest, 'probability': None, 'tumor': None,
+                         'model_version': version, 'error': error})
+            if tensor is not None:
+                tensors.append(tensor)
+        if tensors:
+            probabilities = iter(predictor.predict(np.stack(tensors)[..., np.newaxis]))
+            for row in rows:
+                if row['error'] is None:
+                    row['probability'] = float(next(probabilities))
+                    row['tumor'] = row['probability'] >= threshold
+        return rows
+
+    with ThreadPoolExecutor(threads) as executor:
+        pending = deque()
+        loaded = []
+        for path in paths:
+            pending.append((path, executor.submit(load, path)))
+            if len(pending) < 2 * batch_size:
+                continue
+            path, future = pending.popleft()
+            loaded.append((path, future.result()))
+            if len(loaded) == batch_size:
+                yield score(loaded)
+                loaded = []
+        while pending:
+            path, future = pending.popleft()
+            loaded.append((path, future.result()))
+            if len(loaded) == batch_size or not pending:
+                yield score(loaded)
+                loaded = []
+
+
+def run(paths, output_dir, scoring, workers, batch_size, part_size, progress, quiet=False):
+    """
+    Score `paths` from `progress['done']` on into `output_dir`, saving the
+    progress after each part; returns the throughput summary
+    """
+    from batching import BatchPredictor
+    from preprocessing import PreprocessPool
+
+    model, options, threshold, version = scoring
+    schema = output_schema(threshold, options)
+    predictor = BatchPredictor(model, max_batch_size=batch_size, max_wait_ms=0)
+
+    start = time.perf_counter()
+    pool = PreprocessPool(workers=workers, slots=workers * 16, **options) if workers > 0 else None
+    startup = time.perf_counter() - start
+    # With a pool the threads only read, hash and wait; without one a single
+    # thread decodes so that --workers 0 is a serial baseline
+    threads = 2 * workers + 2 if pool is not None else 1
+    remaining = paths[progress['done']:]
+    scored = 0
+    errors = 0
+    rows = []
+    start = time.perf_counter()
+    try:
+        load = file_loader(pool, options)
+        for batch in score_batches(remaining, load, predictor, batch_size, threshold, version, threads):
+            rows.extend(batch)
+            scored += len(batch)
+            errors += sum(row['error'] is not None for row in batch)
+            if len(rows) >= part_size or scored == len(remaining):
+                progress['parts'].append(write_part(output_dir, len(progress['parts']), rows, schema))
+                progress['done'] += len(rows)
+                progress['errors'] += sum(row['error'] is not None for row in rows)
+                save_progress(output_dir, progress)
+                rows = []
+                if not quiet:
+                    elapsed = time.perf_counter() - start
+                    print(f"{progress['done']:,}/{len(paths):,} scored "
+                          f"({scored / elapsed:,.0f} images/s, {progress['errors']:,} errors)")
+    finally:
+        if pool is not None:
+            pool.close()
+    elapsed = time.perf_counter() - start
+    return {
+        'workers': workers,
+        'images': scored,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'pool_startup_seconds': round(startup, 3),
+        'images_per_sec': round(scored / elapsed, 1) if elapsed > 0 else None,
+        'batching': predictor.stats()
+    }
+
+
+def score(args):
+    paths = list_inputs(args.input, args.manifest)
+    if not paths:
+        raise SystemExit('No images to score')
+    fingerprint = inputs_fingerprint(paths)
+    scoring = load_scoring_model(args.model, args.model_info)
+    version = scoring[3]
+    print(f"{len(paths):,} inputs, model {args.model} (version {version}), "
+          f"preprocessing {scoring[1]}, threshold {scoring[2]:.4f}")
+
+    os.makedirs(args.output, exist_ok=True)
+    progress = load_progress(args.output)
+    if progress is not None and not args.restart:
+        if progress['inputs_fingerprint'] != fingerprint:
+            raise SystemExit(f"The inputs differ from those of the run checkpointed in {args.output}; "
+                             f"use --restart to start over or a new --output")
+        if progress['model_version'] != version:
+            raise SystemExit(f"{args.output} was scored with model version {progress['model_version']}, "
+                             f"not {version}; use --restart to start over or a new --output")
+        remove_parts(args.output, keep=progress['parts'])
+        if progress['done'] >= len(paths):
+            print(f"All {len(paths):,} inputs were already scored into {args.output}")
+            return progress
+        print(f"Resuming after {progress['done']:,} scored inputs ({len(progress['parts'])} parts)")
+    else:
+        if progress is None and glob.glob(os.path.join(args.output, 'part-*.parquet')) and not args.restart:
+            raise SystemExit(f"{args.output} already holds part files; use --restart to replace them")
+        remove_parts(args.output)
+        progress = {'inputs_fingerprint': fingerprint, 'inputs': len(paths), 'model_version': version,
+                    'model': args.model, 'done': 0, 'errors': 0, 'parts': []}
+
+    result = run(paths, args.output, scoring, args.workers, args.batch_size, args.part_size, progress)
+    print(f"Scored {result['images']:,} images in {result['seconds']:.1f}s "
+          f"({result['images_per_sec']:,.1f} images/s with {args.workers} workers); "
+          f"results in {args.output}")
+    return result
+
+
+def bench(args):
+    """images/s of a full scoring run (into a scratch directory) per worker count"""
+    paths = list_inputs(args.input, args.manifest)[:args.limit]
+    if not paths:
+        raise SystemExit('No images to score')
+    scoring = load_scoring_model(args.model, args.model_info)
+    print(f"{len(paths):,} inputs, batch size {args.batch_size}, model version {scoring[3]}")
+    print(f"{'workers':>8}{'images/s':>10}{'seconds':>9}{'startup s':>11}{'batch':>7}{'errors':>8}")
+    results = []
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as output_dir:
+            progress = {'done': 0, 'errors': 0, 'parts': []}
+            result = run(paths, output_dir, scoring, workers, args.batch_size, args.part_size,
+                         progress, quiet=True)
+        results.append(result)
+        print(f"{workers:>8}{result['images_per_sec']:>10.1f}{result['seconds']:>9.2f}"
+              f"{result['pool_startup_seconds']:>11.2f}{result['batching']['avg_batch_size']:>7}"
+              f"{result['errors']:>8}")
+    return {'inputs': len(paths), 'batch_size': args.batch_size, 'cpu_count': os.cpu_count(),
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score archived MRI slices in bulk into Parquet')
+    parser.add_argument('--model', default=MODEL_PATH, help='Keras model file')
+    parser.add_argument('--model-info', default=MODEL_INFO_PATH,
+                        help='model metadata (preprocessing parameters, decision threshold)')
+    parser.add_argument('--batch-size', type=int, default=256, help='inference batch size')
+    parser.add_argument('--part-size', type=int, default=10000,
+                        help='inputs per Parquet part file (and per checkpoint)')
+    parser.add_argument('--json', dest='json_path', help='write the summary to this file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    def add_inputs(subparser):
+        source = subparser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--input', help='directory of images (searched recursively)')
+        source.add_argument('--manifest', help='file listing one image path per line')
+
+    score_parser = subparsers.add_parser('score', help='score images into a Parquet dataset')
+    add_inputs(score_parser)
+    score_parser.add_argument('--output', required=True, help='output directory for the Parquet parts')
+    score_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                              help='decode processes (0 decodes in this process)')
+    score_parser.add_argument('--restart', action='store_true', help='ignore and replace an existing checkpoint')
+
+    bench_parser = subparsers.add_parser('bench', help='images/s per worker count')
+    add_inputs(bench_parser)
+    bench_parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                              help='decode process counts to compare')
+    bench_parser.add_argument('--limit', type=int, default=2000, help='score at most this many inputs')
+    args = parser.parse_args()
+
+    result = score(args) if args.command == 'score' else bench(args)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Summary written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Multi-stage cascade inference for /predict
+
+Most slices are clearly negative, so the full CNN does not need to see every
+one. Cheap stages run first; each answers the images it is confident about
+(probability at or below its `low` threshold, or at or above its `high`
+threshold) and passes the rest on. Whatever no stage answers goes to the full
+model.
+
+Stage types:
+    statistics  logistic regression over a handful of intensity statistics of
+                the preprocessed image (well under a millisecond, no model)
+    model       a small Keras model, e.g. the student from
+                `train_model.py --distill`
+
+The stages and their thresholds live in model/model_info.json under
+`cascade.stages`, written by:
+
+    python cascade.py calibrate                      # statistics + student (if any)
+    python cascade.py calibrate --stages statistics --min-agreement 0.995
+
+Calibration fits the statistics stage on the training split, then picks each
+stage's thresholds on the validation split in order, using only the images
+the earlier stages left: a stage answers where its decisions agree with the
+full model's at least `--min-agreement` of the time. It then reports per-stage
+hit rates, accuracy and latency on the test split.
+
+Without `cascade.stages`, a distilled student recorded under `student` is
+used as the only cheap stage.
+
+The bands are only valid for the decision threshold they were calibrated
+against (`cascade.threshold`, or `student.threshold`). When the serving
+threshold differs, e.g. after evaluate_model.py picked a new operating point,
+the cascade is refused until it is recalibrated.
+"""
+
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+
+from metrics import LatencyWindow
+
+
+def image_statistics(tensor):
+    """
+    Intensity statistics of a preprocessed (1, H, W, 1) uint8 tensor, on
+    the model's 0-1 scale: mean, standard deviation, 50th/90th/99th
+    percentile, maximum and the fraction of pixels above 0.8 (bright lesions)
+    """
+    pixels = np.asarray(tensor, dtype=np.float32).ravel() / 255
+    p50, p90, p99 = np.percentile(pixels, (50, 90, 99))
+    return np.array([pixels.mean(), pixels.std(), p50, p90, p99, pixels.max(),
+                     np.count_nonzero(pixels > 0.8) / pixels.size], dtype=np.float64)
+
+
+def cascade_thresholds(probabilities, reference, threshold=0.5, min_agreement=0.99):
+    """
+    (low, high) such that answering p <= low as negative and p >= high as
+    positive agrees with the `reference` decisions at least `min_agreement` of
+    the time on each side.
+
+    Each side is pushed as far towards `threshold` as possible. A side that
+    never reaches the agreement is disabled (None).
+    """
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    reference = np.asarray(reference).astype(bool)
+
+    def furthest(values, agrees):
+        # values sorted from most to least confident; the answered set is a prefix
+        rate = np.cumsum(agrees) / np.arange(1, len(agrees) + 1)
+        # Only cut between distinct values, so ties are all answered or all escalated
+        boundary = np.append(values[1:] != values[:-1], True)
+        ok = np.flatnonzero((rate >= min_agreement) & boundary)
+        return float(values[ok[-1]]) if len(ok) else None
+
+    negative = probabilities < threshold
+    order = np.argsort(probabilities[negative], kind='stable')
+    low = furthest(probabilities[negative][order], ~reference[negative][order])
+    order = np.argsort(-probabilities[~negative], kind='stable')
+    high = furthest(probabilities[~negative][order], reference[~negative][order])
+    return low, high
+
+
+def cascade_route(probabilities, low, high):
+    """Boolean mask of the images a stage with these thresholds answers itself"""
+    probabilities = np.asarray(probabilities)
+    answered = np.zeros(probabilities.shape, dtype=bool)
+    if low is not None:
+        answered |= probabilities <= low
+    if high is not None:
+        answered |= probabilities >= high
+    return answered
+
+
+class Stage:
+    """One cheap stage: a scoring function plus its (low, high) thresholds"""
+
+    def __init__(self, name, score, low=None, high=None):
+        self.name = name
+        self.score = score
+        self.low = low
+        self.high = high
+
+    def answers(self, probability):
+        return (self.low is not None and probability <= self.low) or \
+               (self.high is not None and probability >= self.high)
+
+
+class StatisticsScorer:
+    """Logistic regression over standardized image statistics"""
+
+    def __init__(self, mean, scale, weights, bias):
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+
+    def scores(self, features):
+        z = ((np.asarray(features) - self.mean) / self.scale) @ self.weights + self.bias
+        return 1 / (1 + np.exp(-z))
+
+    def __call__(self, tensor):
+        return float(self.scores(image_statistics(tensor)))
+
+    def to_config(self):
+        return {'mean': self.mean.tolist(), 'scale': self.scale.tolist(),
+                'weights': self.weights.tolist(), 'bias': self.bias}
+
+    @classmethod
+    def fit(cls, features, labels):
+        from sklearn.linear_model import LogisticRegression
+
+        mean = features.mean(axis=0)
+        scale = np.where(features.std(axis=0) > 0, features.std(axis=0), 1.0)
+        regression = LogisticRegression(max_iter=1000).fit((features - mean) / scale, labels)
+        return cls(mean, scale, regression.coef_[0], regression.intercept_[0])
+
+
+def model_scorer(model):
+    """Batch-1 probability from a Keras model through a traced forward pass"""
+    import tensorflow as tf
+
+    forward = tf.function(lambda x: model(x, training=False), reduce_retracing=True)
+    forward(tf.zeros((1, *model.input_shape[1:]), dtype=tf.float32))
+    return lambda tensor: float(forward(tf.cast(tensor, tf.float32))[0, 0])
+
+
+class CascadePipeline:
+    """Runs the cheap stages in order and falls back to the full model"""
+
+    FINAL = 'full_model'
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self._lock = threading.Lock()
+        self._evaluated = {stage.name: 0 for stage in self.stages}
+        self._answered = {stage.name: 0 for stage in self.stages}
+        self._stage_time = {stage.name: LatencyWindow() for stage in self.stages}
+        # End-to-end latency by the stage that answered (the exit path)
+        self._paths = {name: LatencyWindow() for name in [*self._evaluated, self.FINAL]}
+
+    def predict(self, tensor, final):
+        """
+        Probability for a preprocessed tensor and the name of the stage that
+        answered. `final(tensor)` is the full model, called only if no stage
+        is confident.
+        """
+        start = time.perf_counter()
+        timings = []
+        answered_by = None
+        for stage in self.stages:
+            stage_start = time.perf_counter()
+            probability = stage.score(tensor)
+            timings.append((stage.name, time.perf_counter() - stage_start))
+            if stage.answers(probability):
+                answered_by = stage.name
+                break
+        if answered_by is None:
+            probability = final(tensor)
+            answered_by = self.FINAL
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            for name, seconds in timings:
+                self._evaluated[name] += 1
+                self._stage_time[name].add(seconds)
+            if answered_by != self.FINAL:
+                self._answered[answered_by] += 1
+            self._paths[answered_by].add(elapsed)
+        return probability, answered_by
+
+    def stats(self):
+        with self._lock:
+            stages = [{
+                'name': stage.name,
+                'low': stage.low,
+                'high': stage.high,
+                'evaluated': self._evaluated[stage.name],
+                'answered': self._answered[stage.name],
+                'hit_rate': round(self._answered[stage.name] / self._evaluated[stage.name], 4)
+                            if self._evaluated[stage.name] else None,
+                'latency': self._stage_time[stage.name].summary()
+            } for stage in self.stages]
+            paths = {name: window.summary() for name, window in self._paths.items()}
+        total = sum(path['count'] for path in paths.values())
+        return {
+            'stages': stages,
+            'requests': total,
+            'full_model_rate': round(paths[self.FINAL]['count'] / total, 4) if total else None,
+            'paths': paths
+        }
+
+
+def build_stage(config, model_folder, load_model, input_shape=None):
+    """
+    Stage from its model_info.json entry; `load_model(path)` loads Keras
+    models. Model stages are fed the full model's tensors, so with
+    `input_shape` (the full model's) they must take the same shape.
+    """
+    kind = config.get('type')
+    if kind == 'statistics':
+        score = StatisticsScorer(**config['scorer'])
+    elif kind == 'model':
+        model = load_model(os.path.join(model_folder, config['model_file']))
+        if input_shape is not None and tuple(model.input_shape[1:]) != tuple(input_shape[1:]):
+            raise ValueError(f"Cascade stage {config['name']!r} takes {tuple(model.input_shape[1:])} inputs "
+                             f"but the full model takes {tuple(input_shape[1:])}")
+        score = model_scorer(model)
+    else:
+        raise ValueError(f"Unknown cascade stage type {kind!r}")
+    return Stage(config['name'], score, config.get('low'), config.get('high'))
+
+
+def stage_configs(info):
+    """Cascade stages from model_info.json, falling back to a distilled student"""
+    if info.get('cascade', {}).get('stages'):
+        return info['cascade']['stages']
+    student = info.get('student')
+    if student:
+        return [{'name': 'student', 'type': 'model', 'model_file': student['model_file'],
+                 'low': student['cascade']['low'], 'high': student['cascade']['high']}]
+    return []
+
+
+def calibration_threshold(info):
+    """Decision threshold the stages in model_info.json were calibrated against, or None"""
+    if info.get('cascade', {}).get('stages'):
+        return info['cascade'].get('threshold')
+    return info.get('student', {}).get('threshold')
+
+
+def load_pipeline(info, model_folder, load_model, enabled=None, input_shape=None, threshold=None):
+    """
+    CascadePipeline for the stages in model_info.json (restricted to the names
+    in `enabled`, if given), or None if there are no stages. Stages without
+    any threshold would never answer and are left out. `input_shape` is the
+    full model's (see build_stage). With `threshold`, the serving decision
+    threshold, ValueError if the stages were calibrated against another one.
+    """
+    if threshold is not None and stage_configs(info):
+        calibrated = calibration_threshold(info)
+        if calibrated is None or abs(calibrated - threshold) > 1e-9:
+            raise ValueError(f"stages were calibrated for decision threshold {calibrated}, the model uses "
+                             f"{threshold}; run `python cascade.py calibrate`")
+    stages = []
+    for config in stage_configs(info):
+        if enabled is not None and config['name'] not in enabled:
+            continue
+        if config.get('low') is None and config.get('high') is None:
+            continue
+        stages.append(build_stage(config, model_folder, load_model, input_shape))
+    return CascadePipeline(stages) if stages else None
+
+
+def time_per_image(score, tensors, repeat=3):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for tensor in tensors:
+            score(tensor)
+    return (time.perf_counter() - start) / (repeat * len(tensors)) * 1000
+
+
+def calibrate(args):
+    import json
+
+    import tensorflow as tf
+    from sklearn.model_selection import train_test_split
+
+    from preprocessing import preprocessing_options
+    from serving_model import with_input_scaling
+    from train_model import (DEFAULT_THRESHOLD, MODEL_INFO_PATH, MODEL_PATH, BrainTumorDetector,
+                             merge_model_info)
+
+    info = {}
+    if os.path.exists(MODEL_INFO_PATH):
+        with open(MODEL_INFO_PATH) as f:
+            info = json.load(f)
+    threshold = info.get('decision_threshold', DEFAULT_THRESHOLD)
+    model_folder = os.path.dirname(MODEL_PATH)
+    full_model = with_input_scaling(tf.keras.models.load_model(MODEL_PATH))
+
+    # Images preprocessed as the full model was trained
+    options = preprocessing_options(info.get('preprocessing'), full_model.input_shape)
+    detector = BrainTumorDetector(img_size=options.pop('size'), preprocessing=options)
+    X, y = detector.load_data(args.data_dir, args.shard_dir)
+    # Same split as train_model.py, so the validation images were not trained on
+    X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+    try:
+        X_test, y_test = detector.load_data(args.data_dir, args.shard_dir, split='test')
+    except ValueError:
+        print("No test split found; reporting on the validation split")
+        X_test, y_test = X_val, y_val
+
+    def full_scores(images):
+        return full_model.predict(images, batch_size=256, verbose=0).ravel()
+
+    def statistics_of(images):
+        return np.array([image_statistics(image) for image in images])
+
+    val_reference = full_scores(X_val) >= threshold
+    test_full = full_scores(X_test)
+
+    # (config, probabilities on validation, probabilities on test, per-image scorer)
+    candidates = []
+    for name in args.stages:
+        if name == 'statistics':
+            scorer = StatisticsScorer.fit(statistics_of(X_train), y_train)
+            config = {'name': 'statistics', 'type': 'statistics', 'scorer': scorer.to_config()}
+            candidates.append((config, scorer.scores(statistics_of(X_val)),
+                               scorer.scores(statistics_of(X_test)), scorer))
+        elif name == 'student':
+            if not info.get('student'):
+                print("No distilled student in model_info.json; skipping the student stage "
+                      "(run `python train_model.py --distill` first)")
+                continue
+            student = with_input_scaling(
+                tf.keras.models.load_model(os.path.join(model_folder, info['student']['model_file'])))
+            if student.input_shape[1:] != full_model.input_shape[1:]:
+                print(f"The student takes {student.input_shape[1:]} inputs but the full model takes "
+                      f"{full_model.input_shape[1:]}; skipping the student stage")
+                continue
+            config = {'name': 'student', 'type': 'model', 'model_file': info['student']['model_file']}
+            candidates.append((config, student.predict(X_val, batch_size=256, verbose=0).ravel(),
+                               student.predict(X_test, batch_size=256, verbose=0).ravel(),
+                               model_scorer(student)))
+
+    remaining_val = np.ones(len(X_val), dtype=bool)
+    remaining_test = np.ones(len(X_test), dtype=bool)
+    predictions = np.array(test_full)
+    sample = [X_test[i:i + 1] for i in range(min(50, len(X_test)))]
+    stages = []
+    report = []
+    for config, val_probs, test_probs, scorer in candidates:
+        low, high = cascade_thresholds(val_probs[remaining_val], val_reference[remaining_val],
+                                       threshold=threshold, min_agreement=args.min_agreement)
+        config.update(low=low, high=high)
+        stages.append(config)
+        answered = remaining_test & cascade_route(test_probs, low, high)
+        predictions[answered] = test_probs[answered]
+        report.append({
+            'name': config['name'],
+            'low': low,
+            'high': high,
+            'evaluated': int(remaining_test.sum()),
+            'answered': int(answered.sum()),
+            'hit_rate': float(answered.sum() / max(remaining_test.sum(), 1)),
+            'latency_ms': time_per_image(scorer, sample)
+        })
+        remaining_val &= ~cascade_route(val_probs, low, high)
+        remaining_test &= ~answered
+
+    full_ms = time_per_image(model_scorer(full_model), sample)
+    full_accuracy = float(np.mean((test_full >= threshold) == (y_test == 1)))
+    cascade_accuracy = float(np.mean((predictions >= threshold) == (y_test == 1)))
+    # Every image pays for each stage it reaches, plus the full model if it gets that far
+    expected_ms = sum(stage['latency_ms'] * stage['evaluated'] for stage in report) / len(y_test) + \
+        full_ms * remaining_test.mean()
+
+    print(f"\n{'stage':<14}{'low':>9}{'high':>9}{'seen':>8}{'answered':>10}{'hit rate':>10}{'ms':>8}")
+    for stage in report:
+        low = '-' if stage['low'] is None else f"{stage['low']:.4f}"
+        high = '-' if stage['high'] is None else f"{stage['high']:.4f}"
+        print(f"{stage['name']:<14}{low:>9}{high:>9}{stage['evaluated']:>8}{stage['answered']:>10}"
+              f"{stage['hit_rate']:>10.1%}{stage['latency_ms']:>8.2f}")
+    print(f"{'full_model':<14}{'':>9}{'':>9}{int(remaining_test.sum()):>8}{int(remaining_test.sum()):>10}"
+          f"{'':>10}{full_ms:>8.2f}")
+    print(f"\nAccuracy: full model {full_accuracy:.4f}, cascade {cascade_accuracy:.4f}")
+    print(f"Expected latency per image: {expected_ms:.2f} ms vs {full_ms:.2f} ms "
+          f"({full_ms / expected_ms:.1f}x)")
+
+    if args.dry_run:
+        return
+    merge_model_info(MODEL_INFO_PATH, {'cascade': {
+        'min_agreement': args.min_agreement,
+        'threshold': threshold,
+        'stages': stages,
+        'report': {
+            'test_images': int(len(y_test)),
+            'full_model_accuracy': full_accuracy,
+            'cascade_accuracy': cascade_accuracy,
+            'full_model_latency_ms': full_ms,
+            'expected_latency_ms': expected_ms,
+            'stages': report
+        }
+    }})
+    print(f"Cascade stages written to {MODEL_INFO_PATH}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the cascade stages used by /predict')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    calibrate_parser = subparsers.add_parser('calibrate', help='fit the stages and choose their thresholds')
+    calibrate_parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    calibrate_parser.add_argument('--shards', dest='shard_dir', help='read the data from packed shards instead')
+    calibrate_parser.add_argument('--stages', nargs='+', choices=['statistics', 'student'],
+                                  default=['statistics', 'student'], help='cheap stages, in the order they run')
+    calibrate_parser.add_argument('--min-agreement', type=float, default=0.99,
+                                  help='agreement with the full model required for a stage to answer')
+    calibrate_parser.add_argument('--dry-run', action='store_true', help='do not update model_info.json')
+    args = parser.parse_args()
+
+    if args.command == 'calibrate':
+        calibrate(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Indexed dataset catalog
+
+A small SQLite database that records every image in the training data with
+its label, split, content hash, dimensions and ingest time. Uploads update it
+in the same transaction as their bookkeeping, per-(split, label) counts are
+maintained by triggers so `/stats` is a single-row lookup, and the trainer can
+query a split without listing directories.
+
+Training reads a split's file list from the catalog and does not list the
+directories. Images copied into data/ by hand are picked up with:
+    python catalog.py sync
+or `python train_model.py --sync-catalog`; generate_sample_data.py syncs the
+catalog itself after writing its images.
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+from upload_stream import read_image_header
+
+DEFAULT_DB_PATH = os.path.join('data', 'catalog.db')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+SPLITS = ('train', 'test')
+LABELS = ('no_tumor', 'tumor')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    split TEXT NOT NULL,
+    label TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    format TEXT,
+    size_bytes INTEGER,
+    ingested_at REAL NOT NULL,
+    phash TEXT
+);
+CREATE INDEX IF NOT EXISTS images_split_label ON images (split, label);
+CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256);
+
+CREATE TABLE IF NOT EXISTS counts (
+    split TEXT NOT NULL,
+    label TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (split, label)
+);
+
+CREATE TRIGGER IF NOT EXISTS images_count_insert AFTER INSERT ON images BEGIN
+    INSERT OR IGNORE INTO counts (split, label, count) VALUES (NEW.split, NEW.label, 0);
+    UPDATE counts SET count = count + 1 WHERE split = NEW.split AND label = NEW.label;
+END;
+
+CREATE TRIGGER IF NOT EXISTS images_count_delete AFTER DELETE ON images BEGIN
+    UPDATE counts SET count = count - 1 WHERE split = OLD.split AND label = OLD.label;
+END;
+"""
+
+
+def file_sha256(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetCatalog:
+    def __init__(self, db_path=DEFAULT_DB_PATH, data_dir='data'):
+        self.db_path = db_path
+        self.data_dir = data_dir
+        self._lock = threading.Lock()
+
+        is_new = not os.path.exists(db_path)
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(images)')}
+        if 'phash' not in columns:  # catalogs created before perceptual hashing
+            self._conn.execute('ALTER TABLE images ADD COLUMN phash TEXT')
+
+        if is_new:
+            self.sync()
+
+    def relative_path(self, path):
+        """Paths are stored relative to the data directory"""
+        return os.path.relpath(path, self.data_dir).replace(os.sep, '/')
+
+    def absolute_path(self, rel_path):
+        return os.path.join(self.data_dir, *rel_path.split('/'))
+
+    def add(self, path, split, label, sha256, width=None, height=None,
+            fmt=None, size_bytes=None, ingested_at=None, phash=None):
+        """
+        Record an image, replacing any previous entry for the same path.
+        `phash` is the hex perceptual hash (see dedup_index.py).
+        """
+        rel_path = self.relative_path(path)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM images WHERE path = ?', (rel_path,))
+                self._conn.execute(
+                    'INSERT INTO images (path, split, label, sha256, width, height, format, '
+                    'size_bytes, ingested_at, phash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (rel_path, split, label, sha256, width, height, fmt, size_bytes,
+                     ingested_at or time.time(), phash)
+                )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def add_file(self, path, split, label, sha256=None, header=None, phash=None):
+        """Record an image already on disk, reading its hash and header if not given"""
+        header = header or read_image_header(path)
+        self.add(path, split, label, sha256 or file_sha256(path),
+                 header['width'], header['height'], header['format'], os.path.getsize(path),
+                 phash=phash)
+
+    def set_phashes(self, updates):
+        """Store perceptual hashes for existing entries from (path, phash) pairs"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany('UPDATE images SET phash = ? WHERE path = ?',
+                                       [(phash, path) for path, phash in updates])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def remove(self, path):
+        with self._lock:
+            self._conn.execute('DELETE FROM images WHERE path = ?', (self.relative_path(path),))
+
+    def has_hash(self, sha256):
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM images WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone()
+        return row is not None
+
+    def counts(self):
+        """Image counts per split and label, as served by /stats"""
+        with self._lock:
+            rows = self._conn.execute('SELECT split, label, count FROM counts').fetchall()
+        counts = {f'{label}_{split}': 0 for split in SPLITS for label in LABELS}
+        for split, label, count in rows:
+            counts[f'{label}_{split}'] = count
+        return counts
+
+    def images(self, split, label=None):
+        """(absolute path, label) for every image in a split, in insertion order"""
+        query = 'SELECT path, label FROM images WHERE split = ?'
+        params = [split]
+        if label is not None:
+            query += ' AND label = ?'
+            params.append(label)
+        with self._lock:
+            rows = self._conn.execute(query + ' ORDER BY id', params).fetchall()
+        return [(self.absolute_path(path), label) for path, label in rows]
+
+    def records(self, split=None):
+        """Full catalog rows as dicts"""
+        query = ('SELECT path, split, label, sha256, width, height, format, size_bytes, '
+                 'ingested_at, phash FROM images')
+        params = []
+        if split is not None:
+            query += ' WHERE split = ?'
+            params.append(split)
+        with self._lock:
+            cursor = self._conn.execute(query + ' ORDER BY id', params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def sync(self):
+        """
+        Reconcile the catalog with the data directories: add images that are on
+        disk but not cataloged and drop entries whose file has disappeared.
+        Returns (added, removed).
+        """
+        with self._lock:
+            known = {path for (path,) in self._conn.execute('SELECT path FROM images')}
+
+        on_disk = set()
+        added = 0
+        for split in SPLITS:
+            for label in LABELS:
+                directory = os.path.join(self.data_dir, split, label)
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    path = os.path.join(directory, filename)
+                    rel_path = self.relative_path(path)
+                    on_disk.add(rel_path)
+                    if rel_path in known:
+                        continue
+                    try:
+                        self.add_file(path, split, label)
+                        added += 1
+                    except (OSError, ValueError) as e:
+                        print(f"Skipping {path}: {e}")
+
+        removed = 0
+        for rel_path in known - on_disk:
+            self.remove(self.absolute_path(rel_path))
+            removed += 1
+        return added, removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def sync_catalog(data_dir):
+    """Bring the catalog under `data_dir` up to date with its directories; returns (added, removed)"""
+    catalog = DatasetCatalog(os.path.join(data_dir, 'catalog.db'), data_dir=data_dir)
+    try:
+        added, removed = catalog.sync()
+    finally:
+        catalog.close()
+    if added or removed:
+        print(f"Catalog synced with {data_dir}: {added} images added, {removed} removed")
+    return added, removed
+
+
+def list_images(data_dir, split):
+    """
+    (path, label name) for every image in a split. Uses the catalog when one
+    exists and has the split, without listing the directories (see
+    sync_catalog); otherwise lists them.
+    """
+    db_path = os.path.join(data_dir, 'catalog.db')
+    if os.path.exists(db_path):
+        catalog = DatasetCatalog(db_path, data_dir=data_dir)
+        try:
+            entries = catalog.images(split)
+        finally:
+            catalog.close()
+        if entries:
+            return entries
+
+    entries = []
+    for label in LABELS:
+        directory = os.path.join(data_dir, split, label)
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    entries.append((os.path.join(directory, filename), label))
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dataset catalog maintenance')
+    parser.add_argument('command', choices=['sync', 'stats'])
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help='catalog database path')
+    parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    args = parser.parse_args()
+
+    catalog = DatasetCatalog(args.db, args.data_dir)
+    if args.command == 'sync':
+        start = time.perf_counter()
+        added, removed = catalog.sync()
+        print(f"Catalog synced in {time.perf_counter() - start:.2f}s: {added} added, {removed} removed")
+    for key, value in catalog.counts().items():
+        print(f"{key}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Idempotency keys and in-flight request coalescing for /predict
+
+Clients on flaky networks retry uploads, so the same image often arrives
+several times, some copies while the first is still being processed. Each
+copy used to run the whole pipeline (decode, preprocessing, inference).
+`RequestCoalescer` runs it once:
+
+- requests are keyed by the SHA-256 of the upload, the model version (a hash
+  of the weights) and the options that change the answer (TTA)
+- the first request for a key computes the response; identical requests that
+  arrive while it runs wait for that response instead of computing their own
+  (single flight). Nothing is cached once the flight lands
+- a request with an `Idempotency-Key` header stores its response under that
+  key (per client) for IDEMPOTENCY_TTL seconds; a retry with the same key gets
+  the stored response back without any work. Reusing a key for a different
+  upload is refused (IdempotencyConflict). Failed requests are not stored, so
+  they can be retried
+
+The two are independent: with `enabled` off, identical requests each compute
+their own response, but Idempotency-Key retries are still replayed.
+
+`stats()` counts the requests that computed and the model invocations saved.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdempotencyConflict(Exception):
+    """An idempotency key was reused for a different request"""
+
+
+class _Flight:
+    """One computation that identical requests wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class RequestCoalescer:
+    def __init__(self, enabled=True, idempotency_ttl=86400.0, max_keys=10000, wait_timeout=60.0):
+        self.enabled = enabled
+        self.idempotency_ttl = idempotency_ttl
+        self.max_keys = max_keys
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._flights = {}
+        # idempotency key -> (request key, flight, stored at); oldest first
+        self._idempotent = OrderedDict()
+        self._counts = {'requests': 0, 'computed': 0, 'coalesced': 0, 'replayed': 0, 'conflicts': 0,
+                        'errors': 0}
+
+    def _expire(self, now):
+        """Forget idempotency keys past their TTL or beyond max_keys (caller holds the lock)"""
+        while self._idempotent:
+            key, (_, flight, stored) = next(iter(self._idempotent.items()))
+            if now - stored < self.idempotency_ttl and len(self._idempotent) <= self.max_keys:
+                break
+            if not flight.done.is_set():
+                break
+            del self._idempotent[key]
+
+    def execute(self, key, compute, idempotency_key=None):
+        """
+        Result of compute() for `key`, computed at most once among concurrent
+        identical requests. Returns (result, how), `how` being 'computed',
+        'coalesced' (waited for an identical request in flight) or 'replayed'
+        (stored response for the idempotency key).
+        """
+        with self._lock:
+            self._counts['requests'] += 1
+            if not self.enabled and idempotency_key is None:
+                self._counts['computed'] += 1
+                leader, flight, how = True, None, 'computed'
+            else:
+                self._expire(time.monotonic())
+                stored = self._idempotent.get(idempotency_key) if idempotency_key is not None else None
+                if stored is not None and stored[0] != key:
+                    self._counts['conflicts'] += 1
+                    raise IdempotencyConflict('Idempotency-Key was already used for a different request')
+                if stored is not None:
+                    leader, flight = False, stored[1]
+                    how = 'replayed' if flight.done.is_set() else 'coalesced'
+                elif self.enabled and key in self._flights:
+                    leader, flight, how = False, self._flights[key], 'coalesced'
+                else:
+                    flight = _Flight()
+                    if self.enabled:
+                        self._flights[key] = flight
+                    leader, how = True, 'computed'
+                    self._counts['computed'] += 1
+                if not leader:
+                    self._counts[how] += 1
+                    flight.waiters += 1
+                if idempotency_key is not None and stored is None:
+                    self._idempotent[idempotency_key] = (key, flight, time.monotonic())
+
+        if flight is None:
+            return compute(), how
+        if not leader:
+            if not flight.done.wait(self.wait_timeout):
+                raise TimeoutError('Timed out waiting for an identical request in progress')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, how
+
+        try:
+            flight.result = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                if flight.error is not None:
+                    self._counts['errors'] += 1
+                    for stored_key in [k for k, entry in self._idempotent.items() if entry[1] is flight]:
+                        del self._idempotent[stored_key]
+            flight.done.set()
+        return flight.result, how
+
+    def stats(self):
+        with self._lock:
+            saved = self._counts['coalesced'] + self._counts['replayed']
+            return {
+                'enabled': self.enabled,
+                **self._counts,
+                'model_invocations_saved': saved,
+                'saved_fraction': round(saved / self._counts['requests'], 4) if self._counts['requests'] else None,
+                'in_flight': len(self._flights),
+                'idempotency_keys': len(self._idempotent)
+            }
@@ -7,12 +7,11 @@ import tensorflow as tf
 import numpy as np
 import os
 
-def create_dummy_brain_tumor_model():
-    """Create a dummy CNN model for brain tumor detection"""
-    
-    # Create model architecture
-    model = tf.keras.Sequential([
-        tf.keras.layers.Input(shape=(128, 128, 1)),
+def build_dummy_architecture(img_size=(128, 128)):
+    """The dummy model's layers, uncompiled (also a candidate in architecture_search.py)"""
+    return tf.keras.Sequential([
+        tf.keras.layers.Input(shape=(*img_size, 1)),
+        tf.keras.layers.Rescaling(1.0 / 255),  # uint8 pixels in
         
         # First convolutional block
         tf.keras.layers.Conv2D(32, (3, 3), activation='relu', padding='same'),
@@ -47,6 +46,12 @@ def create_dummy_brain_tumor_model():
         tf.keras.layers.Dropout(0.5),
         tf.keras.layers.Dense(1, activation='sigmoid')  # Binary classification
     ])
+
+def create_dummy_brain_tumor_model():
+    """Create a dummy CNN model for brain tumor detection"""
+    
+    # Create model architecture
+    model = build_dummy_architecture()
     
     # Compile the model
     model.compile(
@@ -61,7 +66,7 @@ def create_dummy_brain_tumor_model():
     
     # Initialize the model with dummy data to set weights
     print("Initializing model with dummy data...")
-    dummy_input = np.random.random((1, 128, 128, 1))
+    dummy_input = np.random.randint(0, 256, (1, 128, 128, 1), dtype=np.uint8)
     dummy_output = model.predict(dummy_input, verbose=0)
     
     # Create model directory if it doesn't exist
@@ -74,7 +79,7 @@ def create_dummy_brain_tumor_model():
     
     # Test the model
     print("Testing model with random input...")
-    test_input = np.random.random((1, 128, 128, 1))
+    test_input = np.random.randint(0, 256, (1, 128, 128, 1), dtype=np.uint8)
     prediction = model.predict(test_input, verbose=0)
     print(f"Test prediction: {prediction[0][0]:.4f}")
     
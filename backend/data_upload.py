@@ -7,15 +7,16 @@ for the brain tumor detection model.
 """
 
 import os
-import shutil
 from flask import Flask, request, jsonify, render_template_string
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
-import cv2
-import numpy as np
-from PIL import Image
+from catalog import DatasetCatalog
+from ingest import IngestManager, is_archive, is_image
+from upload_stream import ValidatingRequest
 
 app = Flask(__name__)
+app.request_class = ValidatingRequest
 CORS(app)
 
 # Configuration
@@ -23,7 +24,20 @@ UPLOAD_FOLDER = 'data_uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'tiff', 'bmp'}
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['UPLOAD_MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['BULK_MAX_CONTENT_LENGTH'] = 4 * 1024 * 1024 * 1024  # 4GB per bulk request
+app.config['MAX_CONTENT_LENGTH'] = app.config['UPLOAD_MAX_CONTENT_LENGTH']
+app.config['INGEST_WORKERS'] = int(os.environ.get('INGEST_WORKERS', 8))
+# Maximum perceptual-hash distance treated as a near-duplicate on ingest; -1 disables
+app.config['NEAR_DUPLICATE_DISTANCE'] = int(os.environ.get('NEAR_DUPLICATE_DISTANCE', 16))
+
+# Streaming upload validation (see upload_stream.py)
+app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXTENSIONS
+app.config['MAX_FILE_SIZE'] = app.config['UPLOAD_MAX_CONTENT_LENGTH']
+app.config['MIN_IMAGE_DIMENSION'] = 32
+app.config['MAX_IMAGE_DIMENSION'] = 2048
+app.config['UPLOAD_ABORT_ON_INVALID'] = False  # keep the valid files of a batch
+app.config['RAW_UPLOAD_ENDPOINTS'] = {'bulk_upload'}
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -32,36 +46,45 @@ os.makedirs('data/train/tumor', exist_ok=True)
 os.makedirs('data/test/no_tumor', exist_ok=True)
 os.makedirs('data/test/tumor', exist_ok=True)
 
+# Index of every image in data/, kept in step with uploads (see catalog.py)
+catalog = DatasetCatalog(os.path.join('data', 'catalog.db'), data_dir='data')
+
+ingest_manager = IngestManager(
+    catalog,
+    data_dir='data',
+    staging_dir=os.path.join(UPLOAD_FOLDER, 'bulk'),
+    workers=app.config['INGEST_WORKERS'],
+    min_dim=app.config['MIN_IMAGE_DIMENSION'],
+    max_dim=app.config['MAX_IMAGE_DIMENSION'],
+    near_duplicate_distance=(app.config['NEAR_DUPLICATE_DISTANCE']
+                             if app.config['NEAR_DUPLICATE_DISTANCE'] >= 0 else None),
+    max_file_size=app.config['MAX_FILE_SIZE']
+)
+
+@app.before_request
+def limit_content_length():
+    """
+    Only the bulk endpoint may exceed the regular upload size limit. The limit
+    is enforced on the body as it is read, so chunked requests without a
+    Content-Length are held to it as well.
+    """
+    if request.endpoint in app.config['RAW_UPLOAD_ENDPOINTS']:
+        request.max_content_length = app.config['BULK_MAX_CONTENT_LENGTH']
+        return None
+    if request.content_length and request.content_length > app.config['UPLOAD_MAX_CONTENT_LENGTH']:
+        return jsonify({'success': False, 'error': 'Request too large (maximum 16MB)'}), 413
+
+@app.errorhandler(413)
+def request_too_large(e):
+    """Bodies that turn out to be over the limit while they are read"""
+    limit = request.max_content_length or app.config['UPLOAD_MAX_CONTENT_LENGTH']
+    return jsonify({'success': False, 'error': f'Request too large (maximum {limit // (1024 * 1024)}MB)'}), 413
+
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def validate_image(image_path):
-    """Validate that the uploaded file is a valid image"""
-    try:
-        # Try to open with PIL
-        with Image.open(image_path) as img:
-            img.verify()
-        
-        # Try to read with OpenCV
-        img = cv2.imread(image_path)
-        if img is None:
-            return False, "Image could not be read by OpenCV"
-        
-        # Check image dimensions
-        height, width = img.shape[:2]
-        if height < 32 or width < 32:
-            return False, "Image too small (minimum 32x32 pixels)"
-        
-        if height > 2048 or width > 2048:
-            return False, "Image too large (maximum 2048x2048 pixels)"
-        
-        return True, "Valid image"
-        
-    except Exception as e:
-        return False, f"Invalid image: {str(e)}"
-
 @app.route('/')
 def index():
     """Main upload interface"""
@@ -137,6 +160,19 @@ def index():
             <div id="tumor-train-status"></div>
         </div>
 
+        <div class="upload-section">
+            <h3>📦 Bulk Upload (ZIP/TAR archives or many images)</h3>
+            <p>Archives may contain <code>tumor/</code> and <code>no_tumor/</code> folders; otherwise the selected label is used.</p>
+            <input type="file" id="bulk-files" multiple accept=".zip,.tar,.tgz,.gz,image/*">
+            <select id="bulk-category">
+                <option value="no-tumor">No Tumor</option>
+                <option value="tumor">Tumor</option>
+            </select>
+            <button onclick="bulkUpload('train')">Ingest to Training Set</button>
+            <button onclick="bulkUpload('test')">Ingest to Test Set</button>
+            <div id="bulk-status"></div>
+        </div>
+
         <div style="text-align: center; margin-top: 30px;">
             <button onclick="startTraining()" style="background-color: #28a745; font-size: 16px; padding: 15px 30px;">
                 🚀 Start Model Training
@@ -188,6 +224,60 @@ def index():
             });
         }
 
+        function bulkUpload(dataset) {
+            const fileInput = document.getElementById('bulk-files');
+            const statusDiv = document.getElementById('bulk-status');
+
+            if (fileInput.files.length === 0) {
+                statusDiv.innerHTML = '<div class="error">Please select files to upload</div>';
+                return;
+            }
+
+            const formData = new FormData();
+            for (let i = 0; i < fileInput.files.length; i++) {
+                formData.append('files', fileInput.files[i]);
+            }
+            formData.append('category', document.getElementById('bulk-category').value);
+            formData.append('dataset', dataset);
+
+            statusDiv.innerHTML = '<div class="info">Uploading...</div>';
+
+            fetch('/upload/bulk', {
+                method: 'POST',
+                body: formData
+            })
+            .then(response => response.json())
+            .then(data => {
+                if (data.success) {
+                    fileInput.value = '';
+                    pollJob(data.status_url, statusDiv);
+                } else {
+                    statusDiv.innerHTML = `<div class="error">${data.error}</div>`;
+                }
+            })
+            .catch(error => {
+                statusDiv.innerHTML = `<div class="error">Upload failed: ${error}</div>`;
+            });
+        }
+
+        function pollJob(url, statusDiv) {
+            fetch(url)
+            .then(response => response.json())
+            .then(job => {
+                const summary = `${job.processed}/${job.discovered} processed: ${job.accepted} added, ` +
+                    `${job.duplicates} duplicates, ${job.rejected} rejected (${job.images_per_second} images/s)`;
+                if (job.status === 'completed') {
+                    statusDiv.innerHTML = `<div class="success">Ingest completed. ${summary}</div>`;
+                    loadStats();
+                } else if (job.status === 'failed') {
+                    statusDiv.innerHTML = `<div class="error">Ingest failed. ${summary}</div>`;
+                } else {
+                    statusDiv.innerHTML = `<div class="info">Ingesting... ${summary}</div>`;
+                    setTimeout(() => pollJob(url, statusDiv), 1000);
+                }
+            });
+        }
+
         function startTraining() {
             const statusDiv = document.getElementById('training-status');
             statusDiv.innerHTML = '<div class="info">Starting model training... This may take several minutes.</div>';
@@ -237,61 +327,114 @@ def upload_files():
         category = request.form.get('category')  # 'no-tumor' or 'tumor'
         dataset = request.form.get('dataset')    # 'train' or 'test'
         
-        if not category or not dataset:
+        if category not in ('no-tumor', 'tumor') or dataset not in ('train', 'test'):
             return jsonify({'success': False, 'error': 'Missing category or dataset'})
         
+        label = 'no_tumor' if category == 'no-tumor' else 'tumor'
         uploaded_count = 0
+        duplicates = 0
         errors = []
         
         for file in files:
+            # Files that failed streaming validation were never written out
+            stream_error = getattr(file.stream, 'error', None)
+            if stream_error:
+                errors.append(f"{file.filename}: {stream_error}")
+                continue
+
             if file and file.filename and allowed_file(file.filename):
-                # Save to temporary location
+                # Same checks as bulk ingest: header, exact and near duplicates,
+                # a destination name no other image has, and the catalog entry
                 filename = secure_filename(file.filename)
-                temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(temp_path)
-                
-                # Validate image
-                is_valid, message = validate_image(temp_path)
-                if not is_valid:
-                    errors.append(f"{filename}: {message}")
-                    os.remove(temp_path)
-                    continue
-                
-                # Determine destination
-                if category == 'no-tumor':
-                    dest_dir = f'data/{dataset}/no_tumor'
+                outcome, message = ingest_manager.ingest(filename, file.read(), label, dataset)
+                if outcome == 'accepted':
+                    uploaded_count += 1
+                elif outcome == 'duplicate':
+                    duplicates += 1
                 else:
-                    dest_dir = f'data/{dataset}/tumor'
-                
-                # Move to final location
-                dest_path = os.path.join(dest_dir, filename)
-                shutil.move(temp_path, dest_path)
-                uploaded_count += 1
+                    errors.append(message)
             else:
                 errors.append(f"{file.filename}: Invalid file type")
         
         if uploaded_count > 0:
             message = f"Successfully uploaded {uploaded_count} files to {dataset} set"
+            if duplicates:
+                message += f". {duplicates} files were already in the dataset"
             if errors:
-                message += f". {len(errors)} files failed validation."
-            return jsonify({'success': True, 'message': message})
+                message += f". {len(errors)} files failed validation or were near-duplicates."
+            return jsonify({'success': True, 'message': message, 'errors': errors})
+        elif duplicates and not errors:
+            return jsonify({'success': False, 'error': 'All files are already in the dataset'})
         else:
-            return jsonify({'success': False, 'error': 'No valid files uploaded'})
+            return jsonify({'success': False, 'error': 'No valid files uploaded', 'errors': errors})
             
+    except RequestEntityTooLarge:
+        raise
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/upload/bulk', methods=['POST'])
+def bulk_upload():
+    """
+    Start a background ingest job for archives (zip/tar) and/or many images.
+    Returns a job ID immediately; poll /upload/jobs/<job_id> for progress.
+    """
+    try:
+        files = request.files.getlist('files')
+        category = request.form.get('category')  # 'no-tumor' or 'tumor'
+        dataset = request.form.get('dataset')    # 'train' or 'test'
+
+        if not files:
+            return jsonify({'success': False, 'error': 'No files provided'}), 400
+        if category not in ('no-tumor', 'tumor') or dataset not in ('train', 'test'):
+            return jsonify({'success': False, 'error': 'Missing or invalid category or dataset'}), 400
+
+        archives = []
+        images = []
+        skipped = []
+        for file in files:
+            if not file or not file.filename:
+                continue
+            if is_archive(file.filename):
+                path = ingest_manager.staging_path(file.filename)
+                file.save(path)
+                archives.append(path)
+            elif is_image(file.filename):
+                path = ingest_manager.staging_path(file.filename)
+                file.save(path)
+                images.append((file.filename, path))
+            else:
+                skipped.append(file.filename)
+
+        if not archives and not images:
+            return jsonify({'success': False, 'error': 'No archives or images in request'}), 400
+
+        job = ingest_manager.submit(category, dataset, archives=archives, files=images)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status_url': f'/upload/jobs/{job.id}',
+            'skipped': skipped
+        }), 202
+
+    except RequestEntityTooLarge:
+        raise
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/upload/jobs/<job_id>', methods=['GET'])
+def bulk_upload_status(job_id):
+    """Progress of a bulk ingest job"""
+    job = ingest_manager.get(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Unknown job'}), 404
+    return jsonify({'success': True, **job.to_dict()})
+
 @app.route('/stats', methods=['GET'])
 def get_stats():
     """Get current data statistics"""
     try:
-        stats = {
-            'no_tumor_train': len(os.listdir('data/train/no_tumor')) if os.path.exists('data/train/no_tumor') else 0,
-            'tumor_train': len(os.listdir('data/train/tumor')) if os.path.exists('data/train/tumor') else 0,
-            'no_tumor_test': len(os.listdir('data/test/no_tumor')) if os.path.exists('data/test/no_tumor') else 0,
-            'tumor_test': len(os.listdir('data/test/tumor')) if os.path.exists('data/test/tumor') else 0
-        }
-        return jsonify(stats)
+        return jsonify(catalog.counts())
     except Exception as e:
         return jsonify({'error': str(e)})
 
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+Near-duplicate and train/test leakage detection
+
+Every image gets a 256-bit perceptual hash (the signs of the 16x16 lowest
+DCT frequencies of a 64x64 grayscale thumbnail), which survives re-encoding,
+resizing and mild intensity changes. A 64-bit hash is not enough for MRI
+slices: the skull outline dominates the lowest frequencies and unrelated scans
+collide. Near-duplicates are images whose hashes differ in at most
+`max_distance` bits.
+
+`NearDuplicateIndex` finds them without comparing against every image: the
+hash is split into `max_distance + 1` bands and each band is indexed in a hash
+table. By the pigeonhole principle two hashes within `max_distance` bits agree
+exactly on at least one band, so only the images sharing a band bucket are
+compared (multi-index hashing).
+
+Usage:
+    python dedup_index.py leakage                 # report train/test leakage
+    python dedup_index.py leakage --json leak.json
+    python dedup_index.py bench --size 200000     # index throughput at scale
+"""
+
+import argparse
+import json
+import random
+import time
+from collections import defaultdict
+
+import cv2
+import numpy as np
+
+HASH_SIDE = 16
+HASH_BITS = HASH_SIDE * HASH_SIDE
+DEFAULT_MAX_DISTANCE = 16
+
+
+def perceptual_hash(gray):
+    """256-bit DCT perceptual hash of a grayscale image, as an int"""
+    thumb = cv2.resize(gray, (HASH_SIDE * 4, HASH_SIDE * 4), interpolation=cv2.INTER_AREA).astype(np.float32)
+    coefficients = cv2.dct(thumb)[:HASH_SIDE, :HASH_SIDE].flatten()
+    # The DC term only encodes mean brightness; compare against the median of the rest
+    bits = coefficients > np.median(coefficients[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def perceptual_hash_bytes(data):
+    """Perceptual hash of an encoded image, or None if it cannot be decoded"""
+    gray = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    return None if gray is None else perceptual_hash(gray)
+
+
+def perceptual_hash_file(path):
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    return None if gray is None else perceptual_hash(gray)
+
+
+def to_hex(value):
+    """Hashes are stored in the catalog as fixed-width hex strings"""
+    return format(value, f'0{HASH_BITS // 4}x')
+
+
+def from_hex(text):
+    return int(text, 16)
+
+
+class NearDuplicateIndex:
+    def __init__(self, max_distance=DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = HASH_BITS // bands
+        # (shift, mask) for each band; the last band absorbs the remainder bits
+        self._bands = []
+        for i in range(bands):
+            bits = width if i < bands - 1 else HASH_BITS - width * (bands - 1)
+            self._bands.append((width * i, (1 << bits) - 1))
+        self._tables = [defaultdict(list) for _ in self._bands]
+        self._hashes = []
+        self._keys = []
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._keys) - self._removed
+
+    def add(self, key, phash):
+        item = len(self._keys)
+        self._keys.append(key)
+        self._hashes.append(phash)
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            table[(phash >> shift) & mask].append(item)
+
+    def remove(self, key, phash):
+        """Take an image back out of the index, e.g. when storing it failed"""
+        removed = set()
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            bucket = table.get((phash >> shift) & mask, [])
+            for item in [item for item in bucket if self._keys[item] == key]:
+                bucket.remove(item)
+                removed.add(item)
+        for item in removed:
+            self._keys[item] = self._hashes[item] = None
+        self._removed += len(removed)
+
+    def query(self, phash, max_distance=None, limit=None):
+        """(key, distance) of indexed images within max_distance bits, closest first"""
+        max_distance = self.max_distance if max_distance is None else min(max_distance, self.max_distance)
+        seen = set()
+        matches = []
+        for table, (shift, mask) in zip(self._tables, self._bands):
+            for item in table.get((phash >> shift) & mask, ()):
+                if item in seen:
+                    continue
+                seen.add(item)
+                distance = hamming(self._hashes[item], phash)
+                if distance <= max_distance:
+                    matches.append((self._keys[item], distance))
+        matches.sort(key=lambda match: match[1])
+        return matches[:limit] if limit else matches
+
+
+def ensure_phashes(catalog):
+    """Compute and store perceptual hashes for cataloged images that lack one"""
+    missing = [record for record in catalog.records() if record['phash'] is None]
+    updates = []
+    for record in missing:
+        phash = perceptual_hash_file(catalog.absolute_path(record['path']))
+        if phash is not None:
+            updates.append((record['path'], to_hex(phash)))
+    catalog.set_phashes(updates)
+    return len(updates)
+
+
+def find_leakage(catalog, max_distance=DEFAULT_MAX_DISTANCE):
+    """
+    Index the train split and query every test image against it. Also reports
+    near-duplicates inside each split. Returns a report dict with timings.
+    """
+    start = time.perf_counter()
+    hashed = ensure_phashes(catalog)
+    hash_time = time.perf_counter() - start
+
+    records = [r for r in catalog.records() if r['phash'] is not None]
+    train = [r for r in records if r['split'] == 'train']
+    test = [r for r in records if r['split'] == 'test']
+
+    start = time.perf_counter()
+    train_index = NearDuplicateIndex(max_distance)
+    for record in train:
+        train_index.add(record['path'], from_hex(record['phash']))
+    build_time = time.perf_counter() - start
+
+    labels = {r['path']: r['label'] for r in records}
+    leaks = []
+    start = time.perf_counter()
+    for record in test:
+        for train_path, distance in train_index.query(from_hex(record['phash'])):
+            leaks.append({
+                'test': record['path'],
+                'train': train_path,
+                'distance': distance,
+                'label_conflict': labels[train_path] != record['label']
+            })
+    query_time = time.perf_counter() - start
+
+    within = []
+    for split_records in (train, test):
+        index = NearDuplicateIndex(max_distance)
+        for record in split_records:
+            for other, distance in index.query(from_hex(record['phash'])):
+                within.append({'a': other, 'b': record['path'], 'distance': distance})
+            index.add(record['path'], from_hex(record['phash']))
+
+    leaked_test = {leak['test'] for leak in leaks}
+    return {
+        'max_distance': max_distance,
+        'train_images': len(train),
+        'test_images': len(test),
+        'leaked_test_images': len(leaked_test),
+        'leaked_fraction': len(leaked_test) / len(test) if test else 0.0,
+        'leaks': leaks,
+        'within_split_duplicates': within,
+        'timing': {
+            'hashed_images': hashed,
+            'hash_seconds': hash_time,
+            'index_build_seconds': build_time,
+            'index_build_images_per_second': len(train) / build_time if build_time > 0 else None,
+            'query_seconds': query_time,
+            'queries_per_second': len(test) / query_time if query_time > 0 else None
+        }
+    }
+
+
+def benchmark(size, queries, max_distance, seed=0):
+    """Build and query throughput of the index on random hashes"""
+    rng = random.Random(seed)
+    hashes = [rng.getrandbits(HASH_BITS) for _ in range(size)]
+
+    start = time.perf_counter()
+    index = NearDuplicateIndex(max_distance)
+    for i, phash in enumerate(hashes):
+        index.add(i, phash)
+    build_time = time.perf_counter() - start
+
+    # Half the probes are perturbed copies of indexed hashes, half are random
+    probes = []
+    for i in range(queries):
+        if i % 2 == 0:
+            phash = hashes[rng.randrange(size)]
+            for bit in rng.sample(range(HASH_BITS), rng.randint(0, max_distance)):
+                phash ^= 1 << bit
+        else:
+            phash = rng.getrandbits(HASH_BITS)
+        probes.append(phash)
+
+    start = time.perf_counter()
+    found = sum(1 for phash in probes if index.query(phash))
+    query_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for phash in probes[:max(1, queries // 100)]:
+        [h for h in hashes if hamming(h, phash) <= max_distance]
+    linear_time = (time.perf_counter() - start) / max(1, queries // 100)
+
+    return {
+        'size': size,
+        'queries': queries,
+        'max_distance': max_distance,
+        'build_images_per_second': size / build_time,
+        'queries_per_second': queries / query_time,
+        'linear_scan_queries_per_second': 1 / linear_time,
+        'probes_with_match': found
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Near-duplicate and leakage detection')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    leakage = subparsers.add_parser('leakage', help='report train/test near-duplicate leakage')
+    leakage.add_argument('--db', default='data/catalog.db', help='catalog database path')
+    leakage.add_argument('--data-dir', default='data', help='dataset root directory')
+    leakage.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE,
+                         help='maximum Hamming distance between hashes to count as a duplicate')
+    leakage.add_argument('--json', dest='json_path', help='write the full report to this file')
+
+    bench = subparsers.add_parser('bench', help='index throughput on random hashes')
+    bench.add_argument('--size', type=int, default=200000)
+    bench.add_argument('--queries', type=int, default=10000)
+    bench.add_argument('--max-distance', type=int, default=DEFAULT_MAX_DISTANCE)
+
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        result = benchmark(args.size, args.queries, args.max_distance)
+        print(f"Index of {result['size']:,} hashes (max distance {result['max_distance']}):")
+        print(f"  build:       {result['build_images_per_second']:,.0f} images/s")
+        print(f"  query:       {result['queries_per_second']:,.0f} queries/s")
+        print(f"  linear scan: {result['linear_scan_queries_per_second']:,.1f} queries/s")
+        return
+
+    from catalog import DatasetCatalog
+
+    catalog = DatasetCatalog(args.db, args.data_dir)
+    report = find_leakage(catalog, args.max_distance)
+    timing = report['timing']
+    print(f"Hashed {timing['hashed_images']} new images in {timing['hash_seconds']:.2f}s")
+    print(f"Indexed {report['train_images']} train images in {timing['index_build_seconds'] * 1000:.1f} ms")
+    print(f"Queried {report['test_images']} test images in {timing['query_seconds'] * 1000:.1f} ms")
+    print(f"\nTest images with a near-duplicate in train: {report['leaked_test_images']} "
+          f"({report['leaked_fraction']:.1%})")
+    for leak in report['leaks'][:20]:
+        conflict = ' (LABEL CONFLICT)' if leak['label_conflict'] else ''
+        print(f"  {leak['test']} ~ {leak['train']} distance={leak['distance']}{conflict}")
+    if len(report['leaks']) > 20:
+        print(f"  ... {len(report['leaks']) - 20} more")
+    print(f"Near-duplicate pairs within a split: {len(report['within_split_duplicates'])}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,395 @@
+#!/usr/bin/env python3
+"""
+Streaming input statistics and drift monitoring
+
+A model trained on one scanner's images silently degrades when the inputs
+change: a new site, a different export setting, upscaled thumbnails. The
+backend keeps a few constant-memory sketches of what it is asked to score and
+compares them with the same sketches computed over the training data.
+
+Every sketch is a histogram with fixed bin edges (so two sketches can always
+be compared and merged, and updating one is a single counting pass):
+
+    pixel_intensity   grey levels of the preprocessed model input, 256 bins
+    mean_intensity    mean grey level per preprocessed image, 32 bins
+    image_width       width of the uploaded image, before preprocessing
+    image_height      height of the uploaded image, before preprocessing
+    prediction_score  model probability, 20 bins over 0-1
+
+Quantiles (p5, p25, p50, p75, p95) are interpolated from the histograms,
+except for the image dimensions: their bins are too coarse for interpolation
+to mean anything (uploads that are all 256x256 would report a median of 320),
+so those quantiles are the [low, high) bin they fall in.
+
+`DriftMonitor` keeps the sketches for the process lifetime and for a sliding
+window of DRIFT_WINDOW seconds, made of DRIFT_BUCKETS time buckets that are
+recycled as time moves on; memory does not grow with traffic. Each feature's
+drift score is the population stability index (PSI) of the window against the
+baseline; below 0.1 is stable, 0.1-0.25 moderate and above 0.25 significant.
+Fewer than DRIFT_MIN_SAMPLES images in the window give no verdict: with few
+images PSI mostly measures sampling noise.
+
+The baseline is written to model/model_info.json (`drift_baseline`) by
+train_model.py. For an already trained model:
+
+    python drift.py baseline --data-dir data
+    python drift.py baseline --shards data/shards
+"""
+
+import argparse
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from metrics import LatencyWindow
+from upload_stream import NeedMoreData, sniff_image_header
+
+# Upload dimensions; the last bin takes anything larger
+SIZE_EDGES = np.array([0, 64, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 4096, 8192, np.inf])
+
+FEATURES = {
+    'pixel_intensity': np.arange(257, dtype=np.float64),
+    'mean_intensity': np.linspace(0, 256, 33),
+    'image_width': SIZE_EDGES,
+    'image_height': SIZE_EDGES,
+    'prediction_score': np.linspace(0, 1, 21)
+}
+# Features whose quantiles are reported as bins rather than interpolated values
+BINNED_QUANTILES = {'image_width', 'image_height'}
+GREY_LEVELS = np.arange(256, dtype=np.float64)
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+# Probability floor for empty bins, which would make PSI infinite
+PSI_EPSILON = 1e-4
+# Enough of an upload to read the dimensions of PNG, BMP, TIFF and most JPEGs
+HEADER_BYTES = 64 * 1024
+BASELINE_CHUNK = 256
+
+
+def source_size(data):
+    """(width, height) from the leading bytes of an image file, or None if they do not tell"""
+    try:
+        header = sniff_image_header(data)
+    except (NeedMoreData, ValueError):
+        return None
+    if header['width'] is None or header['height'] is None:
+        return None
+    return header['width'], header['height']
+
+
+def file_source_size(path):
+    """source_size of an image file on disk"""
+    with open(path, 'rb') as f:
+        return source_size(f.read(HEADER_BYTES))
+
+
+def bin_counts(values, edges):
+    """Histogram of `values` over fixed `edges`; out-of-range values land in the first or last bin"""
+    bins = len(edges) - 1
+    index = np.searchsorted(edges, np.atleast_1d(np.asarray(values, dtype=np.float64)), side='right') - 1
+    return np.bincount(np.clip(index, 0, bins - 1), minlength=bins)
+
+
+def histogram_quantiles(counts, edges, quantiles=QUANTILES, interpolate=True):
+    """
+    Quantiles of a histogram, interpolated linearly within a bin; None if it
+    is empty. With `interpolate` off, each quantile is its bin as [low, high]
+    (high None for the open last bin).
+    """
+    total = counts.sum()
+    if not total:
+        return None
+    cumulative = np.cumsum(counts)
+    result = {}
+    for q in quantiles:
+        target = q * total
+        i = int(np.searchsorted(cumulative, target, side='left'))
+        i = min(i, len(counts) - 1)
+        below = cumulative[i] - counts[i]
+        low, high = edges[i], edges[i + 1]
+        if not interpolate:
+            value = [float(low), float(high) if np.isfinite(high) else None]
+            result[f'p{int(round(q * 100))}'] = value
+            continue
+        if not np.isfinite(high):
+            value = low
+        else:
+            value = low + (high - low) * ((target - below) / counts[i] if counts[i] else 0.0)
+        result[f'p{int(round(q * 100))}'] = round(float(value), 4)
+    return result
+
+
+def psi(expected, actual):
+    """Population stability index between two histograms over the same bins"""
+    p = np.maximum(expected / expected.sum(), PSI_EPSILON)
+    q = np.maximum(actual / actual.sum(), PSI_EPSILON)
+    return float(np.sum((q - p) * np.log(q / p)))
+
+
+class _Sketches:
+    """Counts and image totals of every feature"""
+
+    def __init__(self):
+        self.counts = {name: np.zeros(len(edges) - 1, dtype=np.int64) for name, edges in FEATURES.items()}
+        self.images = dict.fromkeys(FEATURES, 0)
+
+    def add(self, counts, images):
+        for name, c in counts.items():
+            self.counts[name] += c
+            self.images[name] += images[name]
+
+    def clear(self):
+        for name in FEATURES:
+            self.counts[name][:] = 0
+            self.images[name] = 0
+
+
+class DriftMonitor:
+    """Streaming sketches of the served inputs and predictions, compared with a baseline"""
+
+    def __init__(self, baseline=None, enabled=True, window_seconds=3600.0, buckets=12, min_samples=500,
+                 moderate=0.1, significant=0.25):
+        self.enabled = enabled
+        self.window_seconds = window_seconds
+        self.bucket_seconds = window_seconds / max(1, buckets)
+        self.min_samples = min_samples
+        self.moderate = moderate
+        self.significant = significant
+        self.baseline = None
+        self.baseline_info = None
+        if baseline is not None:
+            self.set_baseline(baseline)
+        self._lock = threading.Lock()
+        self._lifetime = _Sketches()
+        self._buckets = [_Sketches() for _ in range(max(1, buckets))]
+        # Time index of the period each bucket currently holds
+        self._bucket_index = [None] * len(self._buckets)
+        self._observe = LatencyWindow()
+
+    def set_baseline(self, baseline):
+        """Use a baseline dict (as written by `to_baseline`); ValueError if it does not fit the sketches"""
+        features = {}
+        for name, entry in baseline['features'].items():
+            if name not in FEATURES:
+                continue
+            counts = np.asarray(entry['counts'], dtype=np.int64)
+            if len(counts) != len(FEATURES[name]) - 1:
+                raise ValueError(f"baseline {name} has {len(counts)} bins, expected {len(FEATURES[name]) - 1}")
+            if counts.sum():
+                features[name] = counts
+        self.baseline = features
+        self.baseline_info = {key: value for key, value in baseline.items() if key != 'features'}
+
+    def observe(self, tensors=None, scores=None, sizes=None):
+        """
+        Record a batch: preprocessed uint8 images (N,H,W) or (N,H,W,1), their
+        prediction scores and/or the (width, height) of the uploads. Any of the
+        three may be left out, e.g. sizes for preprocessed tensors.
+        """
+        if not self.enabled:
+            return
+        start = time.perf_counter()
+        counts, images = {}, {}
+        if tensors is not None:
+            tensors = np.asarray(tensors, dtype=np.uint8)
+            tensors = tensors.reshape(tensors.shape[:3])
+            # One grey-level histogram per image (cv2 is about twice as fast as
+            # np.bincount here); the image means follow from it
+            histograms = np.stack([cv2.calcHist([image], [0], None, [256], [0, 256]).ravel()
+                                   for image in tensors])
+            counts['pixel_intensity'] = histograms.sum(axis=0).astype(np.int64)
+            means = histograms @ GREY_LEVELS / (tensors.shape[1] * tensors.shape[2])
+            counts['mean_intensity'] = bin_counts(means, FEATURES['mean_intensity'])
+            images['pixel_intensity'] = images['mean_intensity'] = len(tensors)
+        if scores is not None:
+            scores = np.atleast_1d(np.asarray(scores, dtype=np.float64)).ravel()
+            counts['prediction_score'] = bin_counts(scores, FEATURES['prediction_score'])
+            images['prediction_score'] = len(scores)
+        sizes = [size for size in sizes if size is not None] if sizes is not None else []
+        if sizes:
+            widths, heights = np.asarray(sizes, dtype=np.float64).T
+            counts['image_width'] = bin_counts(widths, FEATURES['image_width'])
+            counts['image_height'] = bin_counts(heights, FEATURES['image_height'])
+            images['image_width'] = images['image_height'] = len(sizes)
+        if not counts:
+            return
+
+        with self._lock:
+            self._lifetime.add(counts, images)
+            self._current_bucket(time.monotonic()).add(counts, images)
+            self._observe.add(time.perf_counter() - start)
+
+    def _current_bucket(self, now):
+        """The bucket for `now`, emptied first if it still holds an older period (caller holds the lock)"""
+        index = int(now // self.bucket_seconds)
+        slot = index % len(self._buckets)
+        if self._bucket_index[slot] != index:
+            self._buckets[slot].clear()
+            self._bucket_index[slot] = index
+        return self._buckets[slot]
+
+    def _window(self, now):
+        """Sketches summed over the buckets inside the window (caller holds the lock)"""
+        current = int(now // self.bucket_seconds)
+        window = _Sketches()
+        for index, bucket in zip(self._bucket_index, self._buckets):
+            if index is not None and current - index < len(self._buckets):
+                window.add(bucket.counts, bucket.images)
+        return window
+
+    def _status(self, score, images):
+        if images < self.min_samples:
+            return 'insufficient_data'
+        if score >= self.significant:
+            return 'significant'
+        if score >= self.moderate:
+            return 'moderate'
+        return 'stable'
+
+    def report(self, scope='window'):
+        """Quantiles and drift score of every feature over the window or the process lifetime"""
+        if scope not in ('window', 'lifetime'):
+            raise ValueError("scope must be 'window' or 'lifetime'")
+        with self._lock:
+            sketches = self._window(time.monotonic()) if scope == 'window' else self._lifetime
+            counts = {name: c.copy() for name, c in sketches.counts.items()}
+            images = dict(sketches.images)
+
+        features = {}
+        for name, edges in FEATURES.items():
+            expected = self.baseline.get(name) if self.baseline else None
+            interpolate = name not in BINNED_QUANTILES
+            score = psi(expected, counts[name]) if expected is not None and counts[name].sum() else None
+            status = self._status(score, images[name]) if expected is not None else 'no_baseline'
+            features[name] = {
+                'images': images[name],
+                'quantiles': histogram_quantiles(counts[name], edges, interpolate=interpolate),
+                'baseline_quantiles': (histogram_quantiles(expected, edges, interpolate=interpolate)
+                                       if expected is not None else None),
+                'psi': round(score, 4) if score is not None else None,
+                'status': status
+            }
+
+        order = ['no_baseline', 'insufficient_data', 'stable', 'moderate', 'significant']
+        statuses = [feature['status'] for feature in features.values()]
+        return {
+            'enabled': self.enabled,
+            'scope': scope,
+            'window_seconds': self.window_seconds if scope == 'window' else None,
+            'min_samples': self.min_samples,
+            'thresholds': {'moderate': self.moderate, 'significant': self.significant},
+            'baseline': self.baseline_info,
+            'status': max(statuses, key=order.index),
+            'features': features
+        }
+
+    def to_baseline(self, **info):
+        """The lifetime sketches as a baseline dict, with `info` (e.g. model_version) alongside"""
+        with self._lock:
+            return {
+                **info,
+                'features': {name: {'images': self._lifetime.images[name],
+                                    'counts': self._lifetime.counts[name].tolist()}
+                             for name in FEATURES}
+            }
+
+    def stats(self):
+        """Compact summary for /metrics"""
+        report = self.report()
+        with self._lock:
+            observe = self._observe.summary()
+            lifetime = self._lifetime.images['prediction_score']
+        return {
+            'enabled': self.enabled,
+            'baseline': self.baseline is not None,
+            'status': report['status'],
+            'psi': {name: feature['psi'] for name, feature in report['features'].items()},
+            'window_images': report['features']['prediction_score']['images'],
+            'lifetime_images': lifetime,
+            'observe': observe
+        }
+
+
+def build_baseline(tensors, scores, sizes, **info):
+    """
+    Baseline dict from training data: preprocessed images, prediction scores
+    (on held-out images) and upload sizes. Images are sketched in chunks so a
+    large training set does not need a second copy in memory.
+    """
+    monitor = DriftMonitor()
+    for i in range(0, len(tensors), BASELINE_CHUNK):
+        monitor.observe(tensors=tensors[i:i + BASELINE_CHUNK])
+    monitor.observe(scores=scores, sizes=sizes)
+    return monitor.to_baseline(images=int(len(tensors)), **info)
+
+
+def dataset_sizes(data_dir, shard_dir=None, split='train'):
+    """(width, height) of a split's images, read from file or shard record headers"""
+    if shard_dir:
+        from shards import ShardReader, record_size, shard_paths
+
+        sizes = []
+        for path in shard_paths(shard_dir, split):
+            with ShardReader(path) as reader:
+                sizes.extend(record_size(payload) for payload in reader.payloads())
+        return sizes
+    from catalog import list_images
+
+    return [file_source_size(path) for path, _ in list_images(data_dir, split)]
+
+
+def write_baseline(args):
+    import json
+    import os
+
+    import tensorflow as tf
+    from sklearn.model_selection import train_test_split
+
+    from model_artifact import weights_version
+    from preprocessing import preprocessing_options
+    from serving_model import with_input_scaling
+    from train_model import MODEL_INFO_PATH, MODEL_PATH, BrainTumorDetector, merge_model_info
+
+    info = {}
+    if os.path.exists(MODEL_INFO_PATH):
+        with open(MODEL_INFO_PATH) as f:
+            info = json.load(f)
+    model = with_input_scaling(tf.keras.models.load_model(MODEL_PATH, compile=False))
+    options = preprocessing_options(info.get('preprocessing'), model.input_shape)
+    detector = BrainTumorDetector(img_size=options.pop('size'), preprocessing=options)
+    X, y = detector.load_data(args.data_dir, args.shard_dir)
+    # Same split as train_model.py: scores of images the model was not trained on
+    _, X_val, _, _ = train_test_split(X, y, test_size=0.2, random_state=42, stratify=y)
+    scores = model.predict(X_val, batch_size=256, verbose=0).ravel()
+    baseline = build_baseline(X, scores, dataset_sizes(args.data_dir, args.shard_dir),
+                              model_version=weights_version(model))
+
+    monitor = DriftMonitor(baseline)
+    report = monitor.report()
+    print(f"\n{'feature':<18}{'images':>8}  quantiles")
+    for name, feature in report['features'].items():
+        quantiles = feature['baseline_quantiles'] or {}
+        print(f"{name:<18}{baseline['features'][name]['images']:>8}  "
+              + ' '.join(f"{q}={v}" for q, v in quantiles.items()))
+    if args.dry_run:
+        return
+    merge_model_info(MODEL_INFO_PATH, {'drift_baseline': baseline})
+    print(f"Drift baseline written to {MODEL_INFO_PATH}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Input statistics baseline for drift monitoring')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    baseline_parser = subparsers.add_parser('baseline', help='sketch the training data of the current model')
+    baseline_parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    baseline_parser.add_argument('--shards', dest='shard_dir', help='read the data from packed shards instead')
+    baseline_parser.add_argument('--dry-run', action='store_true', help='do not update model_info.json')
+    args = parser.parse_args()
+
+    if args.command == 'baseline':
+        write_baseline(args)
+
+
+if __name__ == '__main__':
+    main()
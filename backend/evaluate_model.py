@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Batched model evaluation and decision threshold selection
+
+Scores the test split once, in large batches, and derives everything from
+that single set of scores: ROC and precision/recall curves, their AUCs, and
+the metrics at every distinct threshold (computed at once with cumulative
+sums over the sorted scores). The recommended operating threshold is written
+to model/model_info.json as `decision_threshold`, which the backend uses for
+/predict instead of a fixed 0.5.
+
+Usage:
+    python evaluate_model.py                          # data/test, Youden's J
+    python evaluate_model.py --criterion min_recall --min-recall 0.95
+    python evaluate_model.py --shards data/shards --json eval.json --plot eval.png
+    python evaluate_model.py --dry-run                # do not update model_info.json
+"""
+
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from cascade import calibration_threshold
+from preprocessing import load_preprocessing_options
+from serving_model import with_input_scaling
+from train_model import BrainTumorDetector, merge_model_info
+
+MODEL_PATH = os.path.join('model', 'brain_tumor_model.h5')
+MODEL_INFO_PATH = os.path.join('model', 'model_info.json')
+CRITERIA = ('youden', 'f1', 'accuracy', 'min_recall')
+
+
+def threshold_sweep(y_true, scores):
+    """
+    Confusion counts and metrics at every distinct score, used as a threshold
+    (predict tumor when score >= threshold). Arrays are ordered by decreasing
+    threshold; a leading threshold of +inf (nothing predicted positive) anchors
+    the curves at the origin.
+    """
+    y_true = np.asarray(y_true).astype(bool).ravel()
+    scores = np.asarray(scores, dtype=np.float64).ravel()
+    order = np.argsort(-scores, kind='mergesort')
+    sorted_scores = scores[order]
+    sorted_true = y_true[order]
+
+    # Last index of each run of equal scores: everything up to it is >= that score
+    distinct = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(sorted_scores) - 1]
+    tp = np.r_[0, np.cumsum(sorted_true)[distinct]]
+    fp = np.r_[0, distinct + 1 - tp[1:]]
+    positives = int(y_true.sum())
+    negatives = len(y_true) - positives
+    fn = positives - tp
+    tn = negatives - fp
+
+    recall = tp / max(positives, 1)
+    fpr = fp / max(negatives, 1)
+    predicted = tp + fp
+    # Precision is 1 by convention when nothing is predicted positive
+    precision = np.where(predicted > 0, tp / np.maximum(predicted, 1), 1.0)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, np.finfo(np.float64).tiny)
+
+    return {
+        'threshold': np.r_[np.inf, sorted_scores[distinct]],
+        'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn,
+        'recall': recall,
+        'fpr': fpr,
+        'specificity': 1.0 - fpr,
+        'precision': precision,
+        'f1': f1,
+        'accuracy': (tp + tn) / max(len(y_true), 1)
+    }
+
+
+def roc_auc(sweep):
+    """Area under the ROC curve (trapezoidal, ties handled by the sweep)"""
+    fpr, recall = sweep['fpr'], sweep['recall']
+    return float(np.sum(np.diff(fpr) * (recall[1:] + recall[:-1]) / 2))
+
+
+def average_precision(sweep):
+    """Area under the precision/recall curve as a step function (sum of precision * recall gain)"""
+    return float(np.sum(np.diff(sweep['recall']) * sweep['precision'][1:]))
+
+
+def choose_threshold(sweep, criterion='youden', min_recall=0.95):
+    """Index into the sweep of the recommended operating point"""
+    candidates = np.isfinite(sweep['threshold'])
+    if criterion == 'youden':
+        objective = sweep['recall'] - sweep['fpr']
+    elif criterion == 'f1':
+        objective = sweep['f1']
+    elif criterion == 'accuracy':
+        objective = sweep['accuracy']
+    elif criterion == 'min_recall':
+        # Highest specificity among thresholds that still catch enough tumors,
+        # then the highest recall among those
+        candidates &= sweep['recall'] >= min_recall
+        if candidates.any():
+            candidates &= sweep['specificity'] == sweep['specificity'][candidates].max()
+        objective = sweep['recall']
+    else:
+        raise ValueError(f'Unknown criterion {criterion}')
+    if not candidates.any():
+        raise ValueError(f'No threshold satisfies the {criterion} criterion')
+    objective = np.where(candidates, objective, -np.inf)
+    # Ties go to the highest threshold (fewest false positives)
+    return int(np.argmax(objective))
+
+
+def operating_point(sweep, index):
+    """Metrics of one sweep entry as plain Python values"""
+    return {
+        'threshold': float(sweep['threshold'][index]),
+        'accuracy': float(sweep['accuracy'][index]),
+        'precision': float(sweep['precision'][index]),
+        'recall': float(sweep['recall'][index]),
+        'specificity': float(sweep['specificity'][index]),
+        'f1': float(sweep['f1'][index]),
+        'confusion_matrix': [[int(sweep['tn'][index]), int(sweep['fp'][index])],
+                             [int(sweep['fn'][index]), int(sweep['tp'][index])]]
+    }
+
+
+def index_for_threshold(sweep, threshold):
+    """Sweep entry equivalent to classifying with `score >= threshold`"""
+    return int(np.searchsorted(-sweep['threshold'], -threshold, side='right') - 1)
+
+
+def iter_chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def score_split(model, detector, data_dir, shard_dir=None, split='test',
+                batch_size=256, chunk_size=2048, workers=4):
+    """
+    Preprocess and score a split once. Images are preprocessed by a thread pool
+    a chunk ahead of inference, so decoding overlaps with the model. Returns
+    (labels, scores, seconds).
+    """
+    start = time.perf_counter()
+    labels = []
+    scores = []
+
+    def predict(images):
+        batch = np.asarray(images, dtype=np.uint8)[..., np.newaxis]
+        return model.predict(batch, batch_size=batch_size, verbose=0).ravel()
+
+    if shard_dir:
+        for chunk in iter_chunks(detector.iter_shards(shard_dir, split, cycle_length=workers), chunk_size):
+            scores.append(predict([image for image, _ in chunk]))
+            labels.extend(label for _, label in chunk)
+    else:
+        entries = detector.list_images(data_dir, split)
+        with ThreadPoolExecutor(max_workers=workers) as pool, \
+                ThreadPoolExecutor(max_workers=1) as loader:
+            def load(chunk):
+                images = pool.map(detector.preprocess_image, [path for path, _ in chunk])
+                return [(image, label) for image, (_, label) in zip(images, chunk) if image is not None]
+
+            def loaded_chunks():
+                # Keep the next chunk preprocessing while the current one is scored
+                pending = None
+                for chunk in iter_chunks(entries, chunk_size):
+                    future = loader.submit(load, chunk)
+                    if pending is not None:
+                        yield pending.result()
+                    pending = future
+                if pending is not None:
+                    yield pending.result()
+
+            for chunk in loaded_chunks():
+                if chunk:
+                    scores.append(predict([image for image, _ in chunk]))
+                    labels.extend(label for _, label in chunk)
+
+    if not labels:
+        raise ValueError(f"No {split} images found")
+    return np.asarray(labels), np.concatenate(scores), time.perf_counter() - start
+
+
+def update_model_info(path, threshold, evaluation):
+    """Merge the decision threshold and evaluation summary into model_info.json"""
+    merge_model_info(path, {'decision_threshold': threshold, 'evaluation': evaluation})
+
+
+def plot_curves(sweep, chosen, path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 2, figsize=(12, 5))
+    axes[0].plot(sweep['fpr'], sweep['recall'])
+    axes[0].plot([0, 1], [0, 1], linestyle='--', color='grey')
+    axes[0].scatter([sweep['fpr'][chosen]], [sweep['recall'][chosen]], color='red', zorder=3)
+    axes[0].set_title(f"ROC (AUC {roc_auc(sweep):.4f})")
+    axes[0].set_xlabel('False Positive Rate')
+    axes[0].set_ylabel('Recall')
+    axes[1].step(sweep['recall'], sweep['precision'], where='post')
+    axes[1].scatter([sweep['recall'][chosen]], [sweep['precision'][chosen]], color='red', zorder=3)
+    axes[1].set_title(f"Precision/Recall (AP {average_precision(sweep):.4f})")
+    axes[1].set_xlabel('Recall')
+    axes[1].set_ylabel('Precision')
+    plt.tight_layout()
+    plt.savefig(path, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Evaluate the model and choose its decision threshold')
+    parser.add_argument('--model', default=MODEL_PATH, help='Keras model file')
+    parser.add_argument('--model-info', default=MODEL_INFO_PATH, help='metadata file to update')
+    parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    parser.add_argument('--shards', dest='shard_dir', help='read the split from packed shards instead')
+    parser.add_argument('--split', default='test')
+    parser.add_argument('--batch-size', type=int, default=256, help='inference batch size')
+    parser.add_argument('--workers', type=int, default=4, help='preprocessing threads')
+    parser.add_argument('--criterion', choices=CRITERIA, default='youden',
+                        help='how to pick the operating threshold')
+    parser.add_argument('--min-recall', type=float, default=0.95,
+                        help='recall (sensitivity) floor for --criterion min_recall')
+    parser.add_argument('--json', dest='json_path', help='write the full sweep to this file')
+    parser.add_argument('--plot', dest='plot_path', help='save ROC and PR curves to this image')
+    parser.add_argument('--dry-run', action='store_true', help='do not update the model metadata')
+    args = parser.parse_args()
+
+    model = with_input_scaling(tf.keras.models.load_model(args.model))
+    # Preprocessed as the model was trained
+    options = load_preprocessing_options(args.model_info, model.input_shape)
+    detector = BrainTumorDetector(img_size=options.pop('size'), preprocessing=options)
+
+    labels, scores, score_time = score_split(model, detector, args.data_dir, args.shard_dir, args.split,
+                                             args.batch_size, workers=args.workers)
+    start = time.perf_counter()
+    sweep = threshold_sweep(labels, scores)
+    chosen = choose_threshold(sweep, args.criterion, args.min_recall)
+    sweep_time = time.perf_counter() - start
+
+    auc = roc_auc(sweep)
+    ap = average_precision(sweep)
+    recommended = operating_point(sweep, chosen)
+    default = operating_point(sweep, index_for_threshold(sweep, 0.5))
+    default['threshold'] = 0.5
+
+    print(f"Scored {len(labels):,} {args.split} images in {score_time:.2f}s "
+          f"({len(labels) / score_time:,.0f} images/s); sweep of {len(sweep['threshold']) - 1:,} "
+          f"thresholds in {sweep_time * 1000:.1f} ms")
+    print(f"ROC AUC: {auc:.4f}   Average precision: {ap:.4f}")
+    for name, point in (('Threshold 0.5', default), (f'Recommended ({args.criterion})', recommended)):
+        print(f"\n{name}: {point['threshold']:.4f}")
+        print(f"  accuracy {point['accuracy']:.4f}  precision {point['precision']:.4f}  "
+              f"recall {point['recall']:.4f}  specificity {point['specificity']:.4f}  f1 {point['f1']:.4f}")
+        print(f"  confusion matrix {point['confusion_matrix']}")
+
+    evaluation = {
+        'split': args.split,
+        'images': int(len(labels)),
+        'roc_auc': auc,
+        'average_precision': ap,
+        'criterion': args.criterion,
+        'min_recall': args.min_recall if args.criterion == 'min_recall' else None,
+        'at_threshold': recommended,
+        'at_0_5': default,
+        'evaluated_at': time.strftime('%Y-%m-%dT%H:%M:%S')
+    }
+    if args.json_path:
+        curve = {key: [None if not np.isfinite(v) else float(v) for v in values]
+                 for key, values in sweep.items()}
+        with open(args.json_path, 'w') as f:
+            json.dump({'evaluation': evaluation, 'sweep': curve}, f)
+        print(f"\nSweep written to {args.json_path}")
+    if args.plot_path:
+        plot_curves(sweep, chosen, args.plot_path)
+        print(f"Curves saved to {args.plot_path}")
+    if not args.dry_run:
+        update_model_info(args.model_info, recommended['threshold'], evaluation)
+        print(f"decision_threshold = {recommended['threshold']:.4f} written to {args.model_info}")
+        with open(args.model_info) as f:
+            calibrated = calibration_threshold(json.load(f))
+        if calibrated is not None and calibrated != recommended['threshold']:
+            print(f"Cascade stages were calibrated for {calibrated:.4f}; the backend disables them until "
+                  f"`python cascade.py calibrate` is run again")
+
+
+if __name__ == '__main__':
+    main()
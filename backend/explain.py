@@ -0,0 +1,211 @@
+"""
+Grad-CAM explanations with cached activations
+
+The model is split at its last convolutional layer into a trunk (image to
+feature maps) and a head (feature maps to probability). /predict runs the two
+halves back to back, which is the same forward pass as model.predict, and
+keeps the feature maps in an LRU cache keyed by the SHA-256 of the uploaded
+file. A follow-up /explain for the same image then only runs the head
+forward and backward to get the gradients, skipping preprocessing and the
+convolutional trunk.
+
+Grad-CAM: the feature maps are weighted by their spatially averaged
+gradients with respect to the tumor probability, summed, clipped at zero and
+normalized. The heatmap is upsampled onto the uploaded image.
+
+Only models that are a single chain of layers (Sequential) can be split.
+"""
+
+import base64
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+
+def file_hash(path):
+    """SHA-256 of an uploaded file, used as the activation cache key"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def chain_layers(model):
+    """The model's layers in execution order; ValueError unless they form a simple chain"""
+    if not isinstance(model, tf.keras.Sequential):
+        raise ValueError('Grad-CAM explanations need a Sequential model')
+    return [layer for layer in model.layers if not isinstance(layer, tf.keras.layers.InputLayer)]
+
+
+def last_conv_index(layers):
+    for i in range(len(layers) - 1, -1, -1):
+        if 'Conv' in type(layers[i]).__name__:
+            return i
+    raise ValueError('Model has no convolutional layer to explain')
+
+
+class ActivationCache:
+    """LRU cache of (feature maps, probability) by image hash"""
+
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class GradCamExplainer:
+    def __init__(self, model, cache_size=128):
+        layers = chain_layers(model)
+        split = last_conv_index(layers) + 1
+        self.layer_name = layers[split - 1].name
+        self._trunk_layers = layers[:split]
+        self._head_layers = layers[split:]
+        self.cache = ActivationCache(cache_size)
+        self._stats_lock = threading.Lock()
+        self._timings = {'predict': [0, 0.0], 'explain': [0, 0.0]}
+
+        self._trunk = tf.function(self._run_trunk, reduce_retracing=True)
+        self._head = tf.function(self._run_head, reduce_retracing=True)
+        self._head_gradients = tf.function(self._run_head_gradients, reduce_retracing=True)
+
+        # Trace both paths now rather than on the first request
+        features = self._trunk(tf.zeros((1, *model.input_shape[1:]), dtype=tf.float32))
+        self._head(features)
+        self._head_gradients(features)
+
+    def _run_trunk(self, x):
+        for layer in self._trunk_layers:
+            x = layer(x, training=False)
+        return x
+
+    def _run_head(self, features):
+        x = features
+        for layer in self._head_layers:
+            x = layer(x, training=False)
+        return x
+
+    def _run_head_gradients(self, features):
+        with tf.GradientTape() as tape:
+            tape.watch(features)
+            probability = self._run_head(features)[:, 0]
+        return probability, tape.gradient(probability, features)
+
+    def _record(self, kind, seconds):
+        with self._stats_lock:
+            self._timings[kind][0] += 1
+            self._timings[kind][1] += seconds
+
+    def predict(self, tensor, key=None):
+        """
+        Probability for a preprocessed (1, H, W, 1) tensor. With a key, the
+        feature maps are cached for a later explanation of the same image.
+        """
+        start = time.perf_counter()
+        features = self._trunk(tf.cast(tensor, tf.float32))
+        probability = float(self._head(features)[0, 0])
+        if key is not None:
+            self.cache.put(key, (features, probability))
+        self._record('predict', time.perf_counter() - start)
+        return probability
+
+    def explain(self, key, preprocess):
+        """
+        Grad-CAM for the image identified by `key`. `preprocess()` is only
+        called on a cache miss and must return the preprocessed tensor.
+        Returns (probability, heatmap in [0, 1] at feature-map resolution, timings).
+        """
+        start = time.perf_counter()
+        entry = self.cache.get(key)
+        timings = {'cache_hit': entry is not None}
+        if entry is None:
+            tensor = preprocess()
+            preprocessed = time.perf_counter()
+            features = self._trunk(tf.cast(tensor, tf.float32))
+            timings['preprocess_ms'] = (preprocessed - start) * 1000
+            timings['trunk_ms'] = (time.perf_counter() - preprocessed) * 1000
+        else:
+            features = entry[0]
+
+        cam_start = time.perf_counter()
+        probability, gradients = self._head_gradients(features)
+        weights = tf.reduce_mean(gradients, axis=(1, 2), keepdims=True)
+        cam = tf.nn.relu(tf.reduce_sum(weights * features, axis=-1))[0].numpy()
+        peak = cam.max()
+        heatmap = cam / peak if peak > 0 else cam
+        probability = float(probability[0])
+        if entry is None:
+            self.cache.put(key, (features, probability))
+
+        finished = time.perf_counter()
+        timings['gradcam_ms'] = (finished - cam_start) * 1000
+        self._record('explain', finished - start)
+        return probability, heatmap, timings
+
+    def stats(self):
+        with self._stats_lock:
+            timings = {kind: round(total / count * 1000, 2) if count else None
+                       for kind, (count, total) in self._timings.items()}
+        return {
+            'layer': self.layer_name,
+            'cache_entries': len(self.cache),
+            'cache_size': self.cache.max_entries,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'avg_predict_ms': timings['predict'],
+            'avg_explain_ms': timings['explain']
+        }
+
+
+def render_overlay(image_path, heatmap, alpha=0.4, max_side=512):
+    """
+    Blend the heatmap onto the uploaded image (as grayscale, longest side at
+    most `max_side`) and return it as a PNG data URL
+    """
+    gray = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise ValueError('Could not read image file')
+    scale = min(1.0, max_side / max(gray.shape))
+    if scale < 1.0:
+        gray = cv2.resize(gray, (int(gray.shape[1] * scale), int(gray.shape[0] * scale)),
+                          interpolation=cv2.INTER_AREA)
+    # The model saw the whole image stretched to its input size, so the heatmap
+    # maps back onto the full frame
+    resized = cv2.resize(heatmap.astype(np.float32), (gray.shape[1], gray.shape[0]),
+                         interpolation=cv2.INTER_CUBIC)
+    colored = cv2.applyColorMap(np.uint8(np.clip(resized, 0, 1) * 255), cv2.COLORMAP_JET)
+    overlay = cv2.addWeighted(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR), 1 - alpha, colored, alpha, 0)
+    ok, encoded = cv2.imencode('.png', overlay)
+    if not ok:
+        raise ValueError('Could not encode overlay')
+    return 'data:image/png;base64,' + base64.b64encode(encoded.tobytes()).decode('ascii')
@@ -4,14 +4,30 @@ Generate sample training data for brain tumor detection
 
 This script creates synthetic MRI-like images for testing the training pipeline.
 In production, replace these with real MRI images.
+
+Run without arguments to create the small sample dataset in data/. For scale
+and load testing, `--count` switches to the batched generator, which builds
+whole batches with vectorized masks in multiple worker processes and writes
+PNGs or packed shards (see shards.py):
+
+    python generate_sample_data.py --count 1000000 --shards 64 --workers 8 \
+        --format shards --output synthetic/
 """
 
+import argparse
 import os
+import time
+from functools import lru_cache
+from multiprocessing import Pool
+from statistics import NormalDist
+
 import numpy as np
 import cv2
 from PIL import Image
 import random
 
+from shards import SHARD_EXTENSION, ShardWriter
+
 def create_synthetic_mri_image(has_tumor=False, size=(256, 256)):
     """
     Create a synthetic MRI-like image
@@ -68,6 +84,146 @@ def create_synthetic_mri_image(has_tumor=False, size=(256, 256)):
     
     return img
 
+@lru_cache(maxsize=8)
+def coordinate_grids(size):
+    """
+    Reusable coordinate grids and the fixed brain/ventricle masks for a size.
+    Returned arrays are shared between calls and must not be modified.
+    """
+    y, x = np.ogrid[:size[0], :size[1]]
+    center = (size[0] // 2, size[1] // 2)
+    distance = (x - center[1]) ** 2 + (y - center[0]) ** 2
+    brain_mask = distance < (min(size) // 3) ** 2
+    ventricle_mask = distance < (min(size) // 6) ** 2
+    return y.astype(np.int32), x.astype(np.int32), brain_mask, ventricle_mask
+
+
+@lru_cache(maxsize=1)
+def normal_table():
+    """Standard normal quantiles at 65536 evenly spaced probabilities"""
+    dist = NormalDist()
+    return np.array([dist.inv_cdf((i + 0.5) / 65536) for i in range(65536)], dtype=np.float32)
+
+
+def fast_standard_normal(rng, shape):
+    """
+    Standard normal noise by inverse-CDF table lookup on 16-bit uniforms.
+    About twice as fast as Generator.standard_normal; the distribution is
+    quantized to 65536 levels and truncated beyond ~4.3 sigma, which is
+    irrelevant for 8-bit images.
+    """
+    return normal_table()[rng.integers(0, 65536, shape, dtype=np.uint16)]
+
+
+def create_synthetic_mri_batch(count, has_tumor, size=(256, 256), rng=None):
+    """
+    Create `count` synthetic MRI-like images at once, as a uint8 array of shape
+    (count, height, width). Same recipe as create_synthetic_mri_image, with the
+    masks, noise and blur computed for the whole batch in float32.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    size = tuple(size)
+    y, x, brain_mask, ventricle_mask = coordinate_grids(size)
+
+    # Base image with noise, brain mask and darker ventricles
+    img = fast_standard_normal(rng, (count, *size))
+    img *= 30
+    img += 128
+    np.clip(img, 0, 255, out=img)
+    np.floor(img, out=img)  # same truncation as the uint8 cast in the single-image version
+    img = np.where(ventricle_mask, np.floor(img * np.float32(0.3) + 50), img)
+    img *= brain_mask
+
+    if has_tumor:
+        # Irregular tumor: union of 5 circles around a jittered center, per image.
+        # Circles can only reach 30 + 15 + 25 pixels from the image center, so
+        # the masks are only evaluated inside that window.
+        cy, cx = size[0] // 2, size[1] // 2
+        top, left = max(cy - 70, 0), max(cx - 70, 0)
+        bottom, right = min(cy + 71, size[0]), min(cx + 71, size[1])
+        wy, wx = y[top:bottom] - top, x[:, left:right] - left
+
+        tumor_centers = np.array([cy - top, cx - left]) + rng.integers(-30, 31, (count, 1, 2))
+        offsets = rng.integers(-15, 16, (count, 5, 2))
+        radii = rng.integers(10, 26, (count, 5))
+        circle_y = (tumor_centers[..., 0] + offsets[..., 0])[:, :, None, None]
+        circle_x = (tumor_centers[..., 1] + offsets[..., 1])[:, :, None, None]
+        window_mask = ((wx - circle_x) ** 2 + (wy - circle_y) ** 2 < radii[:, :, None, None] ** 2).any(axis=1)
+
+        # Brighter, more contrasted tumor with some texture variation
+        window = img[:, top:bottom, left:right]
+        texture = fast_standard_normal(rng, window.shape) * 20
+        tumor = np.floor(np.clip(np.floor(np.clip(window * np.float32(1.5) + 50, 0, 255)) + texture, 0, 255))
+        img[:, top:bottom, left:right] = np.where(window_mask, tumor, window)
+
+    # Smooth the batch by treating images as channels (OpenCV 5 allows up to 128)
+    channels_last = np.ascontiguousarray(img.astype(np.uint8).transpose(1, 2, 0))
+    for start in range(0, count, 128):
+        chunk = np.ascontiguousarray(channels_last[:, :, start:start + 128])
+        blurred = cv2.GaussianBlur(chunk, (3, 3), 0)
+        channels_last[:, :, start:start + 128] = blurred.reshape(chunk.shape)
+    img = channels_last.transpose(2, 0, 1)
+
+    # Add some noise
+    noise = fast_standard_normal(rng, img.shape)
+    noise *= 5
+    noise += img
+    return np.clip(noise, 0, 255, out=noise).astype(np.uint8)
+
+
+def generate_shard(task):
+    """
+    Worker: generate one shard of images. The random stream depends only on
+    (seed, shard index), so a shard is reproducible regardless of worker count.
+    """
+    shard_index, count, seed, size, tumor_fraction, output_format, output_dir, batch_size = task
+    rng = np.random.default_rng([seed, shard_index])
+    tumor_count = int(round(count * tumor_fraction))
+
+    writer = None
+    if output_format == 'shards':
+        writer = ShardWriter(os.path.join(output_dir, f'synthetic-{shard_index:05d}{SHARD_EXTENSION}'))
+
+    written = 0
+    for label, total in ((1, tumor_count), (0, count - tumor_count)):
+        label_name = 'tumor' if label else 'no_tumor'
+        for start in range(0, total, batch_size):
+            batch = create_synthetic_mri_batch(min(batch_size, total - start), bool(label), size, rng)
+            for image in batch:
+                if writer is not None:
+                    writer.write(image, label)
+                else:
+                    filename = f'synthetic_{shard_index:05d}_{written:07d}.png'
+                    cv2.imwrite(os.path.join(output_dir, label_name, filename), image)
+                written += 1
+
+    if writer is not None:
+        writer.close()
+    return written
+
+
+def generate_scale_dataset(count, output_dir, shards=8, workers=None, seed=0, size=(256, 256),
+                           tumor_fraction=0.5, output_format='png', batch_size=64):
+    """
+    Generate `count` images split over `shards` deterministic shards in a pool
+    of worker processes. Returns (images written, seconds).
+    """
+    if output_format == 'png':
+        os.makedirs(os.path.join(output_dir, 'tumor'), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, 'no_tumor'), exist_ok=True)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+
+    per_shard = [count // shards + (1 if i < count % shards else 0) for i in range(shards)]
+    tasks = [(i, n, seed, tuple(size), tumor_fraction, output_format, output_dir, batch_size)
+             for i, n in enumerate(per_shard) if n > 0]
+
+    start = time.perf_counter()
+    with Pool(processes=workers) as pool:
+        written = sum(pool.imap_unordered(generate_shard, tasks))
+    return written, time.perf_counter() - start
+
+
 def generate_sample_dataset():
     """
     Generate sample training and test data
@@ -114,6 +270,11 @@ def generate_sample_dataset():
         filepath = os.path.join('data/test/tumor', filename)
         Image.fromarray(img).save(filepath)
     
+    # Catalog the new images if the upload service already created data/catalog.db
+    if os.path.exists(os.path.join('data', 'catalog.db')):
+        from catalog import sync_catalog
+        sync_catalog('data')
+
     print("✅ Sample dataset generated successfully!")
     print(f"Training data: 50 no-tumor + 50 tumor = 100 images")
     print(f"Test data: 15 no-tumor + 15 tumor = 30 images")
@@ -123,5 +284,36 @@ def generate_sample_dataset():
     print("2. Train the model: python train_model.py")
     print("3. Start the prediction backend: python app.py")
 
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic MRI-like images')
+    parser.add_argument('--count', type=int,
+                        help='number of images for the batched scale generator '
+                             '(omit to create the small sample dataset in data/)')
+    parser.add_argument('--output', default='synthetic', help='output directory for --count')
+    parser.add_argument('--format', choices=['png', 'shards'], default='png',
+                        help='write loose PNGs (tumor/, no_tumor/) or packed shards')
+    parser.add_argument('--shards', type=int, default=8, help='number of deterministic shards')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--seed', type=int, default=0, help='base seed; shard i uses (seed, i)')
+    parser.add_argument('--size', type=int, default=256, help='image side length')
+    parser.add_argument('--tumor-fraction', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=64, help='images generated per vectorized batch')
+    args = parser.parse_args()
+
+    if args.count is None:
+        generate_sample_dataset()
+        return
+
+    print(f"Generating {args.count:,} synthetic images in {args.shards} shards "
+          f"({args.format}, {args.workers or os.cpu_count()} workers)...")
+    written, elapsed = generate_scale_dataset(
+        args.count, args.output, shards=args.shards, workers=args.workers, seed=args.seed,
+        size=(args.size, args.size), tumor_fraction=args.tumor_fraction,
+        output_format=args.format, batch_size=args.batch_size
+    )
+    print(f"✅ Wrote {written:,} images to {args.output} in {elapsed:.1f}s "
+          f"({written / elapsed:,.0f} images/second)")
+
+
 if __name__ == '__main__':
-    generate_sample_dataset()
+    main()
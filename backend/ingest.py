@@ -0,0 +1,413 @@
+"""
+Bulk ingest for the training data upload service
+
+Accepts archives (zip/tar) or large batches of loose images, and processes
+them in the background:
+
+- files are read sequentially by a producer thread and handed to a worker
+  pool that hashes, validates (header only) and writes them in parallel.
+  Archive members over the per-file size limit, or compressed more than
+  MAX_COMPRESSION_RATIO to one, are rejected before they are read, and reads
+  are bounded by the limit whatever the archive claims
+- files keep their name unless another image has it (or is being written
+  under it); then the name gets a content hash prefix, so same-named members
+  from different folders are all kept
+- duplicates are skipped by SHA-256 content hash, both within the batch and
+  against images already in the dataset catalog
+- optionally, near-duplicates (re-encoded or resized copies) are skipped by
+  perceptual hash, which also keeps test images from leaking into train
+- accepted images are recorded in the catalog as they are written
+- each batch is tracked as a job that can be polled for progress and reports
+  the ingest rate in images/second
+
+`IngestManager.ingest` runs the same checks on one image synchronously; the
+regular /upload endpoint uses it, so single uploads are deduplicated too.
+"""
+
+import hashlib
+import itertools
+import os
+import tarfile
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.utils import secure_filename
+
+from dedup_index import (NearDuplicateIndex, ensure_phashes, perceptual_hash_bytes,
+                         to_hex, from_hex)
+from upload_stream import NeedMoreData, check_dimensions, sniff_image_header
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp')
+IMAGE_FORMATS = ('png', 'jpeg', 'tiff', 'bmp')
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+LABEL_DIRS = {'no_tumor': 'no_tumor', 'no-tumor': 'no_tumor', 'tumor': 'tumor'}
+DATASETS = ('train', 'test')
+MAX_REPORTED_ERRORS = 100
+MAX_FILE_SIZE = 16 * 1024 * 1024
+# Image formats are mostly compressed already; far higher ratios mean a decompression bomb
+MAX_COMPRESSION_RATIO = 200
+READ_CHUNK = 1024 * 1024
+
+
+class FileTooLarge(ValueError):
+    """An archive member or staged file is over the per-file limit"""
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def is_image(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def label_dir(category):
+    """Map an upload category ('no-tumor' or 'tumor') to its directory name"""
+    return 'no_tumor' if category in ('no-tumor', 'no_tumor') else 'tumor'
+
+
+def path_overrides(member_path, label, dataset):
+    """
+    Archive members may be organized as `[train|test/]<tumor|no_tumor>/file`;
+    such folder names take precedence over the form values.
+    """
+    for part in member_path.replace('\\', '/').split('/')[:-1]:
+        part = part.lower()
+        if part in LABEL_DIRS:
+            label = LABEL_DIRS[part]
+        elif part in DATASETS:
+            dataset = part
+    return label, dataset
+
+
+def read_bounded(stream, limit):
+    """All of `stream`, read in chunks; FileTooLarge as soon as it exceeds `limit` bytes"""
+    chunks = []
+    total = 0
+    while True:
+        chunk = stream.read(READ_CHUNK)
+        if not chunk:
+            return b''.join(chunks)
+        total += len(chunk)
+        if total > limit:
+            raise FileTooLarge(f'larger than {limit // (1024 * 1024)}MB')
+        chunks.append(chunk)
+
+
+def _read_member(open_member, size, compressed_size, limit):
+    if size > limit:
+        raise FileTooLarge(f'{size} bytes, larger than {limit // (1024 * 1024)}MB')
+    if compressed_size is not None and size > MAX_COMPRESSION_RATIO * max(compressed_size, 1):
+        raise FileTooLarge(f'compressed {size // max(compressed_size, 1)}:1, suspiciously high')
+    with open_member() as stream:
+        return read_bounded(stream, limit)
+
+
+def iter_archive(path, max_file_size=MAX_FILE_SIZE):
+    """
+    Yield (member name, bytes, error) for every image in a zip or tar archive;
+    oversized members come with an error message instead of their bytes
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not is_image(info.filename):
+                    continue
+                try:
+                    yield info.filename, _read_member(lambda: archive.open(info), info.file_size,
+                                                      info.compress_size, max_file_size), None
+                except FileTooLarge as e:
+                    yield info.filename, None, str(e)
+    else:
+        with tarfile.open(path, 'r:*') as archive:
+            for member in archive:
+                if not member.isfile() or not is_image(member.name):
+                    continue
+                try:
+                    yield member.name, _read_member(lambda: archive.extractfile(member), member.size,
+                                                    None, max_file_size), None
+                except FileTooLarge as e:
+                    yield member.name, None, str(e)
+
+
+def iter_files(paths, max_file_size=MAX_FILE_SIZE):
+    """Yield (original name, bytes, error) for staged loose image files"""
+    for original_name, path in paths:
+        try:
+            with open(path, 'rb') as f:
+                yield original_name, read_bounded(f, max_file_size), None
+        except FileTooLarge as e:
+            yield original_name, None, str(e)
+        finally:
+            os.remove(path)
+
+
+class IngestJob:
+    def __init__(self, label, dataset):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.dataset = dataset
+        self.status = 'queued'
+        self.discovered = 0
+        self.processed = 0
+        self.accepted = 0
+        self.duplicates = 0
+        self.near_duplicates = 0
+        self.rejected = 0
+        self.errors = []
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, outcome, message=None):
+        with self._lock:
+            self.processed += 1
+            if outcome == 'accepted':
+                self.accepted += 1
+            elif outcome == 'duplicate':
+                self.duplicates += 1
+            elif outcome == 'near_duplicate':
+                self.near_duplicates += 1
+                if message and len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append(message)
+            else:
+                self.rejected += 1
+                if message and len(self.errors) < MAX_REPORTED_ERRORS:
+                    self.errors.append(message)
+
+    def to_dict(self):
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started if self.started else 0.0
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'label': self.label,
+                'dataset': self.dataset,
+                'discovered': self.discovered,
+                'processed': self.processed,
+                'accepted': self.accepted,
+                'duplicates': self.duplicates,
+                'near_duplicates': self.near_duplicates,
+                'rejected': self.rejected,
+                'errors': list(self.errors),
+                'elapsed_seconds': round(elapsed, 3),
+                'images_per_second': round(self.processed / elapsed, 1) if elapsed > 0 else 0.0
+            }
+
+
+class IngestManager:
+    def __init__(self, catalog, data_dir='data', staging_dir='data_uploads/bulk', workers=8,
+                 min_dim=32, max_dim=2048, max_jobs=100, near_duplicate_distance=None,
+                 max_file_size=MAX_FILE_SIZE):
+        self.catalog = catalog
+        self.near_duplicate_distance = near_duplicate_distance
+        self.data_dir = data_dir
+        self.staging_dir = staging_dir
+        self.workers = workers
+        self.min_dim = min_dim
+        self.max_dim = max_dim
+        self.max_jobs = max_jobs
+        self.max_file_size = max_file_size
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ingest')
+        self._jobs = OrderedDict()
+        self._jobs_lock = threading.Lock()
+        self._pending_hashes = set()
+        self._hashes_lock = threading.Lock()
+        self._pending_paths = set()
+        self._paths_lock = threading.Lock()
+        self._near_index = None
+        self._near_lock = threading.Lock()
+        os.makedirs(staging_dir, exist_ok=True)
+
+    def staging_path(self, filename):
+        """Unique path in the staging directory for an incoming upload"""
+        return os.path.join(self.staging_dir, f'{uuid.uuid4().hex}_{secure_filename(filename)}')
+
+    def get(self, job_id):
+        with self._jobs_lock:
+            return self._jobs.get(job_id)
+
+    def submit(self, category, dataset, archives=(), files=()):
+        """
+        Start a job over staged archive paths and (name, path) pairs of staged
+        loose images. Returns the job immediately.
+        """
+        job = IngestJob(label_dir(category), dataset)
+        with self._jobs_lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_jobs:
+                self._jobs.popitem(last=False)
+
+        producer = threading.Thread(target=self._run, args=(job, list(archives), list(files)),
+                                    name=f'ingest-{job.id[:8]}', daemon=True)
+        producer.start()
+        return job
+
+    def _claim_hash(self, digest):
+        """
+        Reserve a content hash while its file is written; False if the image is
+        already cataloged or being ingested by another worker
+        """
+        with self._hashes_lock:
+            if digest in self._pending_hashes or self.catalog.has_hash(digest):
+                return False
+            self._pending_hashes.add(digest)
+            return True
+
+    def _release_hash(self, digest):
+        with self._hashes_lock:
+            self._pending_hashes.discard(digest)
+
+    def _reserve_path(self, dest_dir, filename, digest):
+        """
+        Destination path for a new image that no file on disk and no other
+        worker has; the original name if possible, else with a content hash
+        (or, failing that, random) prefix. Held until _release_path.
+        """
+        candidates = itertools.chain(
+            [filename, f'{digest[:12]}_{filename}'],
+            (f'{uuid.uuid4().hex[:12]}_{filename}' for _ in itertools.count()))
+        with self._paths_lock:
+            for candidate in candidates:
+                path = os.path.join(dest_dir, candidate)
+                if path not in self._pending_paths and not os.path.exists(path):
+                    self._pending_paths.add(path)
+                    return path
+
+    def _release_path(self, path):
+        with self._paths_lock:
+            self._pending_paths.discard(path)
+
+    def _claim_near_duplicate(self, path, phash):
+        """
+        Register a perceptual hash in the near-duplicate index unless a similar
+        image is already there; returns the (path, distance) match if one is.
+        """
+        with self._near_lock:
+            if self._near_index is None:
+                ensure_phashes(self.catalog)
+                self._near_index = NearDuplicateIndex(self.near_duplicate_distance)
+                for record in self.catalog.records():
+                    if record['phash'] is not None:
+                        self._near_index.add(record['path'], from_hex(record['phash']))
+            matches = self._near_index.query(phash, limit=1)
+            if matches:
+                return matches[0]
+            self._near_index.add(self.catalog.relative_path(path), phash)
+            return None
+
+    def _release_near_duplicate(self, path, phash):
+        """Undo _claim_near_duplicate for an image that was not stored after all"""
+        with self._near_lock:
+            self._near_index.remove(self.catalog.relative_path(path), phash)
+
+    def _run(self, job, archives, files):
+        job.status = 'running'
+        job.started = time.time()
+        # Bound the number of decoded-but-unwritten files held in memory
+        slots = threading.BoundedSemaphore(self.workers * 4)
+        futures = []
+
+        def sources():
+            for path in archives:
+                try:
+                    yield from iter_archive(path, self.max_file_size)
+                except (zipfile.BadZipFile, tarfile.TarError, OSError) as e:
+                    job.record('rejected', f'{os.path.basename(path)}: unreadable archive ({e})')
+                finally:
+                    if os.path.exists(path):
+                        os.remove(path)
+            yield from iter_files(files, self.max_file_size)
+
+        try:
+            for name, data, error in sources():
+                job.discovered += 1
+                if error:
+                    job.record('rejected', f'{name}: {error}')
+                    continue
+                slots.acquire()
+                future = self._pool.submit(self._ingest_one, job, name, data)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            for future in futures:
+                future.result()
+            job.status = 'completed'
+        except Exception as e:
+            job.status = 'failed'
+            job.errors.append(str(e))
+        finally:
+            job.finished = time.time()
+
+    def _ingest_one(self, job, name, data):
+        label, dataset = path_overrides(name, job.label, job.dataset)
+        job.record(*self.ingest(name, data, label, dataset))
+
+    def ingest(self, name, data, label, dataset):
+        """
+        Validate, deduplicate, store and catalog one image. Returns (outcome,
+        message): outcome is 'accepted', 'duplicate', 'near_duplicate' or
+        'rejected', with a message for the last two.
+        """
+        filename = secure_filename(os.path.basename(name))
+        if not filename or not is_image(filename):
+            return 'rejected', f'{name}: invalid file name'
+
+        try:
+            header = sniff_image_header(data)
+        except (NeedMoreData, ValueError) as e:
+            return 'rejected', f'{name}: {str(e) or "unrecognized or truncated image header"}'
+        if header['format'] not in IMAGE_FORMATS:
+            return 'rejected', f"{name}: unsupported image format {header['format']}"
+        error = check_dimensions(header, self.min_dim, self.max_dim)
+        if error:
+            return 'rejected', f'{name}: {error}'
+
+        digest = hashlib.sha256(data).hexdigest()
+        if not self._claim_hash(digest):
+            return 'duplicate', f'{name}: already in the dataset'
+
+        dest_dir = os.path.join(self.data_dir, dataset, label)
+        dest_path = self._reserve_path(dest_dir, filename, digest)
+        try:
+            phash = None
+            if self.near_duplicate_distance is not None:
+                phash = perceptual_hash_bytes(data)
+                if phash is None:
+                    return 'rejected', f'{name}: image could not be decoded'
+                match = self._claim_near_duplicate(dest_path, phash)
+                if match is not None:
+                    other_path, distance = match
+                    leak = ' (train/test leakage)' if not other_path.startswith(f'{dataset}/') else ''
+                    return 'near_duplicate', (f'{name}: near-duplicate of {other_path} '
+                                              f'(distance {distance}){leak}')
+
+            temp_path = dest_path + '.part'
+            try:
+                os.makedirs(dest_dir, exist_ok=True)
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, dest_path)
+                try:
+                    self.catalog.add(dest_path, dataset, label, digest, header['width'],
+                                     header['height'], header['format'], len(data),
+                                     phash=None if phash is None else to_hex(phash))
+                except Exception:
+                    os.remove(dest_path)
+                    raise
+            except Exception as e:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                if phash is not None:
+                    self._release_near_duplicate(dest_path, phash)
+                return 'rejected', f'{name}: {e}'
+        finally:
+            self._release_path(dest_path)
+            self._release_hash(digest)
+        return 'accepted', None
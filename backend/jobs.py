@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Asynchronous prediction jobs for large studies
+
+Sending a study of hundreds of slices to /predict one at a time, or in one
+long synchronous request, ties up connections and runs into client timeouts.
+POST /jobs accepts the whole study and returns a job ID at once:
+
+- jobs wait in a bounded queue (JOB_MAX_QUEUED) for one of JOB_WORKERS
+  worker threads, which preprocess the images and score them through the
+  backend's micro-batching predictor, so jobs and /predict/tensor requests
+  share forward passes
+- results are fetched by polling GET /jobs/<job_id>, or POSTed as JSON to the
+  job's callback URL when it finishes (retried with backoff). Callbacks go
+  only to the hosts in JOB_CALLBACK_HOSTS or, when that is empty, to hosts
+  that resolve to public addresses: never to loopback, private or link-local
+  ones such as cloud metadata services. Redirects are not followed
+- finished jobs are kept for JOB_RESULT_TTL seconds and at most
+  JOB_MAX_RETAINED of them, oldest first; evicted jobs return 404
+- `JobManager.stats()` reports queue depth, queue latency (submit to start),
+  job duration and images/s over the last minute
+
+A stub receiver prints the callbacks it gets, for trying callbacks locally
+(start the backend with JOB_CALLBACK_HOSTS=localhost):
+
+    python jobs.py receiver --port 5002
+    curl -F files=@a.png -F files=@b.png \\
+         -F callback_url=http://localhost:5002/callback http://localhost:5000/jobs
+"""
+
+import argparse
+import ipaddress
+import json
+import queue
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from metrics import LatencyWindow
+
+THROUGHPUT_WINDOW = 60.0  # seconds
+CALLBACK_BACKOFF = 0.5  # seconds before the first retry, doubled after each
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue is at JOB_MAX_QUEUED"""
+
+    def __init__(self, retry_after):
+        super().__init__('Job queue is full')
+        self.retry_after = retry_after
+
+
+def _is_public(address):
+    ip = ipaddress.ip_address(address.split('%')[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def validate_callback_url(url, allowed_hosts=None):
+    """
+    Raise ValueError unless `url` is an http(s) URL on an allowed host. With
+    an allowlist, only its hosts are allowed; without one, only hosts whose
+    every address is public (not loopback, private, link-local or reserved).
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('callback_url must be an http or https URL')
+    if allowed_hosts:
+        if parts.hostname not in allowed_hosts:
+            raise ValueError(f"callback host {parts.hostname} is not allowed")
+        return url
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, ValueError) as e:
+        raise ValueError(f"callback host {parts.hostname} could not be resolved: {e}")
+    if not addresses or not all(_is_public(address) for address in addresses):
+        raise ValueError(f"callback host {parts.hostname} is not a public address; "
+                         f"list it in JOB_CALLBACK_HOSTS to allow it")
+    return url
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as errors: a callback must not be bounced to another host"""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+_callback_opener = urllib.request.build_opener(_NoRedirect)
+
+
+class PredictionJob:
+    """
+    A study to score. `items` are (name, load) pairs; load() returns the
+    preprocessed uint8 (H, W) tensor. `cleanup` is called once the job is done.
+    """
+
+    def __init__(self, items, callback_url=None, cleanup=None):
+        self.id = uuid.uuid4().hex
+        self.items = list(items)
+        self.callback_url = callback_url
+        self.cleanup = cleanup
+        self.status = 'queued'
+        self.results = []
+        self.errors = 0
+        self.error = None
+        self.threshold = None
+        self.model_version = None
+        self.callback = None if callback_url is None else {'url': callback_url, 'status': 'pending',
+                                                           'attempts': 0}
+        self.created = time.time()
+        self.submitted = time.perf_counter()
+        self.started = None
+        self.finished = None
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    def add_results(self, rows):
+        with self._lock:
+            self.results.extend(rows)
+            self.errors += sum('error' in row for row in rows)
+
+    def to_dict(self, ttl=None):
+        with self._lock:
+            end = self.finished or time.time()
+            elapsed = end - self.started if self.started else 0.0
+            job = {
+                'job_id': self.id,
+                'status': self.status,
+                'images': len(self.items),
+                'processed': len(self.results),
+                'errors': self.errors,
+                'queue_ms': round((self._started_at - self.submitted) * 1000, 2)
+                            if self._started_at is not None else None,
+                'elapsed_seconds': round(elapsed, 3),
+                'images_per_second': round(len(self.results) / elapsed, 1) if elapsed > 0 else 0.0,
+                'threshold': self.threshold,
+                'model_version': self.model_version,
+                'callback': dict(self.callback) if self.callback is not None else None,
+                'results': list(self.results)
+            }
+            if self.error is not None:
+                job['error'] = self.error
+            if self.finished is not None and ttl is not None:
+                job['expires_in_seconds'] = round(max(0.0, self.finished + ttl - time.time()), 1)
+            return job
+
+
+class JobManager:
+    """
+    Queue and worker threads for prediction jobs. `handler(job)` does the
+    work, adding result rows to the job as it goes.
+    """
+
+    def __init__(self, handler, workers=2, max_queued=100, result_ttl=3600.0, max_retained=1000,
+                 callback_timeout=5.0, callback_retries=3, callback_hosts=None):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self.max_retained = max_retained
+        self.callback_timeout = callback_timeout
+        self.callback_retries = callback_retries
+        self.callback_hosts = set(callback_hosts or ())
+
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._finished = OrderedDict()  # job id -> finish time, oldest first
+        self._lock = threading.Lock()
+        self._threads = []
+        self._callbacks = ThreadPoolExecutor(max_workers=2, thread_name_prefix='job-callback')
+
+        self._counts = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'evicted': 0,
+                        'callbacks_delivered': 0, 'callbacks_failed': 0}
+        self._images = 0
+        self._recent = deque()  # (time, images) of finished batches, for throughput
+        self._queue_latency = LatencyWindow()
+        self._duration = LatencyWindow()
+
+    def _start_workers(self):
+        # Caller holds the lock
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, items, callback_url=None, cleanup=None):
+        """Queue a job and return it; JobQueueFull when the queue is at its limit"""
+        if callback_url is not None:
+            validate_callback_url(callback_url, self.callback_hosts)
+        job = PredictionJob(items, callback_url, cleanup)
+        with self._lock:
+            self._evict(time.time())
+            if self._queue.qsize() >= self.max_queued:
+                self._counts['rejected'] += 1
+                average = self._duration.total / self._duration.count if self._duration.count else 1.0
+                raise JobQueueFull(retry_after=max(1.0, average * self._queue.qsize() / self.workers))
+            self._jobs[job.id] = job
+            self._counts['submitted'] += 1
+            self._start_workers()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._evict(time.time())
+            return self._jobs.get(job_id)
+
+    def _evict(self, now):
+        """Drop finished jobs past their TTL or beyond max_retained (caller holds the lock)"""
+        while self._finished:
+            job_id, finished = next(iter(self._finished.items()))
+            if now - finished < self.result_ttl and len(self._finished) <= self.max_retained:
+                break
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+            self._counts['evicted'] += 1
+
+    def record_images(self, count):
+        """Count images scored by a handler, for the throughput figure"""
+        now = time.perf_counter()
+        with self._lock:
+            self._images += count
+            self._recent.append((now, count))
+            while self._recent and now - self._recent[0][0] > THROUGHPUT_WINDOW:
+                self._recent.popleft()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            started = time.perf_counter()
+            with job._lock:
+                job.status = 'running'
+                job.started = time.time()
+                job._started_at = started
+            with self._lock:
+                self._queue_latency.add(started - job.submitted)
+            try:
+                self.handler(job)
+                status = 'completed'
+            except Exception as e:
+                status = 'failed'
+                job.error = str(e) or type(e).__name__
+            finally:
+                if job.cleanup is not None:
+                    try:
+                        job.cleanup()
+                    except OSError:
+                        pass
+            with job._lock:
+                job.status = status
+                job.finished = time.time()
+            with self._lock:
+                self._counts[status] += 1
+                self._duration.add(time.perf_counter() - started)
+                self._finished[job.id] = job.finished
+            if job.callback_url is not None:
+                self._callbacks.submit(self._deliver, job)
+
+    def _deliver(self, job):
+        """POST the finished job to its callback URL, retrying with backoff"""
+        payload = job.to_dict(self.result_ttl)
+        del payload['callback']  # describes this delivery, which is still under way
+        body = json.dumps(payload).encode()
+        delay = CALLBACK_BACKOFF
+        refused = False
+        for attempt in range(1, self.callback_retries + 2):
+            request = urllib.request.Request(job.callback_url, data=body, method='POST',
+                                             headers={'Content-Type': 'application/json', 'X-Job-ID': job.id})
+            try:
+                # Checked again: the host may resolve differently than at submission
+                validate_callback_url(job.callback_url, self.callback_hosts)
+                with _callback_opener.open(request, timeout=self.callback_timeout) as response:
+                    status, error = response.status, None
+            except urllib.error.HTTPError as e:
+                status, error = e.code, f'HTTP {e.code}'
+            except ValueError as e:
+                status, error = None, str(e)
+                refused = True
+            except (urllib.error.URLError, OSError) as e:
+                status, error = None, str(getattr(e, 'reason', e))
+            delivered = status is not None and 200 <= status < 300
+            with job._lock:
+                job.callback.update(attempts=attempt, status='delivered' if delivered else 'failed',
+                                    response_status=status)
+                if error is not None:
+                    job.callback['error'] = error
+                else:
+                    job.callback.pop('error', None)
+            # Redirects, client errors and refused hosts will not go away on a retry
+            if delivered or (status is not None and 300 <= status < 500) or refused:
+                break
+            if attempt <= self.callback_retries:
+                time.sleep(delay)
+                delay *= 2
+        with self._lock:
+            self._counts['callbacks_delivered' if delivered else 'callbacks_failed'] += 1
+
+    def stats(self):
+        now = time.perf_counter()
+        with self._lock:
+            self._evict(time.time())
+            recent = sum(count for at, count in self._recent if now - at <= THROUGHPUT_WINDOW)
+            running = sum(job.status == 'running' for job in self._jobs.values())
+            return {
+                'workers': self.workers,
+                'queued': self._queue.qsize(),
+                'running': running,
+                'retained': len(self._finished),
+                'max_queued': self.max_queued,
+                'result_ttl_s': self.result_ttl,
+                **self._counts,
+                'images': self._images,
+                'images_per_second': round(recent / THROUGHPUT_WINDOW, 2),
+                'queue_latency': self._queue_latency.summary(),
+                'job_duration': self._duration.summary()
+            }
+
+
+class CallbackReceiver:
+    """
+    Stub callback endpoint: accepts POSTed job results and keeps them in
+    `received`. Runs in a background thread; `url` is its address.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, status=200, quiet=False):
+        receiver = self
+        self.received = []
+        self.status = status
+        self._arrived = threading.Condition()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    payload = {'raw': body.decode(errors='replace')}
+                with receiver._arrived:
+                    receiver.received.append(payload)
+                    receiver._arrived.notify_all()
+                if not quiet:
+                    print(f"Callback for job {payload.get('job_id')}: {payload.get('status')}, "
+                          f"{payload.get('processed')} of {payload.get('images')} images, "
+                          f"{payload.get('errors')} errors", flush=True)
+                self.send_response(receiver.status)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.url = f'http://{host}:{self.server.server_port}/callback'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def wait(self, count=1, timeout=30.0):
+        """Block until `count` callbacks have arrived; returns them"""
+        with self._arrived:
+            self._arrived.wait_for(lambda: len(self.received) >= count, timeout)
+            return list(self.received)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub receiver for /jobs callbacks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    receiver_parser = subparsers.add_parser('receiver', help='print the job callbacks POSTed to this server')
+    receiver_parser.add_argument('--host', default='127.0.0.1')
+    receiver_parser.add_argument('--port', type=int, default=5002)
+    receiver_parser.add_argument('--status', type=int, default=200, help='HTTP status to answer with')
+    args = parser.parse_args()
+
+    receiver = CallbackReceiver(args.host, args.port, status=args.status)
+    print(f"Receiving job callbacks at {receiver.url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        receiver.close()
+
+
+if __name__ == '__main__':
+    main()
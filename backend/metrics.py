@@ -0,0 +1,39 @@
+"""
+Latency bookkeeping shared by the serving components
+
+`LatencyWindow` keeps the count and total of every sample plus the most recent
+ones, so `stats()` methods can report a lifetime mean alongside percentiles
+that follow current load.
+"""
+
+from collections import deque
+
+import numpy as np
+
+LATENCY_WINDOW = 2048
+
+
+class LatencyWindow:
+    """Count and total of all samples plus the most recent ones for percentiles"""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=size)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        p50, p90, p99 = np.percentile(np.fromiter(self.recent, dtype=np.float64) * 1000, (50, 90, 99))
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total / self.count * 1000, 2),
+            'p50_ms': round(float(p50), 2),
+            'p90_ms': round(float(p90), 2),
+            'p99_ms': round(float(p99), 2)
+        }
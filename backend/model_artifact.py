@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Serving artifact: a model stored for fast loading
+
+`tf.keras.models.load_model('brain_tumor_model.h5')` goes through h5py and
+Keras' legacy HDF5 loader, restores the optimizer state that training left in
+the file (two Adam slots per weight, so the file is about three times the
+weights) and compiles the model, none of which serving needs. The serving
+artifact stores only the architecture and the weights:
+
+    brain_tumor_model.serving/
+        model.json    format version, the Keras architecture (model.to_json())
+                      and a manifest of the weights (path, dtype, shape, offset)
+        weights.bin   the raw little-endian arrays, each aligned to 64 bytes
+
+Loading builds the model from the JSON (a Sequential in one step rather than
+layer by layer, see build_model) and assigns the weights from a
+read-only memory map of weights.bin, so they are copied straight from the
+page cache into the variables with no intermediate arrays. The file pages
+are shared by every process that loads the artifact; the variables are
+still each process's own (TensorFlow variables cannot alias a mapping).
+
+`artifact_path(model_path)` names the artifact of a model file;
+`load_serving_model(path)` loads the artifact instead of the file when it is
+at least as new (so retraining that only writes the .h5 is never shadowed by
+a stale artifact). `train_model.py` writes artifacts next to the models it
+saves; existing models are converted with:
+
+    python model_artifact.py convert --model model/brain_tumor_model.h5
+    python model_artifact.py bench --workers 1 4      # load time and RSS vs .h5
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import shutil
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+ARTIFACT_SUFFIX = '.serving'
+MANIFEST_NAME = 'model.json'
+WEIGHTS_NAME = 'weights.bin'
+ALIGNMENT = 64
+
+
+def artifact_path(model_path):
+    """Serving artifact directory for a model file (model/x.h5 -> model/x.serving)"""
+    return os.path.splitext(model_path)[0] + ARTIFACT_SUFFIX
+
+
+def artifact_is_current(model_path):
+    """True if the model file has an artifact at least as new as the file itself"""
+    manifest = os.path.join(artifact_path(model_path), MANIFEST_NAME)
+    if not os.path.exists(manifest):
+        return False
+    return not os.path.exists(model_path) or os.path.getmtime(manifest) >= os.path.getmtime(model_path)
+
+
+def save_artifact(model, path):
+    """Write `model` (architecture and weights, no optimizer state) as a serving artifact"""
+    import tensorflow as tf
+
+    entries = []
+    offset = 0
+    temp_path = path + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+    os.makedirs(temp_path)
+    with open(os.path.join(temp_path, WEIGHTS_NAME), 'wb') as f:
+        for weight, value in zip(model.weights, model.get_weights()):
+            value = np.ascontiguousarray(value, dtype=value.dtype.newbyteorder('<'))
+            padding = -offset % ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            f.write(value.tobytes())
+            entries.append({'path': weight.path, 'dtype': value.dtype.str, 'shape': list(value.shape),
+                            'offset': offset})
+            offset += value.nbytes
+    manifest = {
+        'format': FORMAT_VERSION,
+        'tensorflow_version': tf.__version__,
+        'architecture': json.loads(model.to_json()),
+        'weights': entries
+    }
+    # The manifest is written last: artifact_is_current only trusts complete artifacts
+    with open(os.path.join(temp_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(temp_path, path)
+    return path
+
+
+def build_model(architecture):
+    """
+    Keras model from its to_json() structure. Sequential.from_config adds the
+    layers one at a time and rebuilds the graph after each, which dominates
+    load time for deeper models; building the Sequential from the whole layer
+    list at once rebuilds it once.
+    """
+    import tensorflow as tf
+
+    if architecture.get('class_name') == 'Sequential':
+        config = architecture['config']
+        layers = [tf.keras.layers.deserialize(layer) for layer in config['layers']]
+        if layers and not isinstance(layers[0], tf.keras.layers.InputLayer) and config.get('build_input_shape'):
+            layers.insert(0, tf.keras.layers.InputLayer(shape=config['build_input_shape'][1:]))
+        return tf.keras.Sequential(layers, name=config.get('name'), trainable=config.get('trainable', True))
+    return tf.keras.models.model_from_json(json.dumps(architecture))
+
+
+def load_artifact(path):
+    """Model from a serving artifact, weights assigned from a read-only memory map"""
+    import serving_model  # noqa: F401  (registers the custom layers)
+
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported serving artifact format {manifest.get('format')!r} in {path}")
+    model = build_model(manifest['architecture'])
+    entries = manifest['weights']
+    if len(entries) != len(model.weights):
+        raise ValueError(f"{path} has {len(entries)} weights but its architecture has {len(model.weights)}")
+
+    with open(os.path.join(path, WEIGHTS_NAME), 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    values = []
+    for entry in entries:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        values.append(np.frombuffer(mapping, dtype=dtype, count=count, offset=entry['offset'])
+                      .reshape(entry['shape']))
+    model.set_weights(values)
+    del values
+    try:
+        mapping.close()
+    except BufferError:
+        # A view is still referenced somewhere; the mapping goes with it
+        pass
+    return model
+
+
+def load_serving_model(model_path):
+    """The model at `model_path`, from its serving artifact when that is current"""
+    if artifact_is_current(model_path):
+        return load_artifact(artifact_path(model_path))
+    import tensorflow as tf
+    return tf.keras.models.load_model(model_path)
+
+
+def weights_version(model):
+    """
+    Content hash of a model's weights (first 12 hex digits of their SHA-256):
+    the same whether the model came from the .h5 file or the artifact, and
+    different after any retraining
+    """
+    digest = hashlib.sha256()
+    for value in model.get_weights():
+        digest.update(str(value.shape).encode())
+        digest.update(np.ascontiguousarray(value, dtype=value.dtype.newbyteorder('<')).tobytes())
+    return digest.hexdigest()[:12]
+
+
+def convert(args):
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(args.model, compile=False)
+    path = save_artifact(model, args.output or artifact_path(args.model))
+    weights_bytes = os.path.getsize(os.path.join(path, WEIGHTS_NAME))
+    print(f"Serving artifact written to {path} ({weights_bytes / 2 ** 20:.1f} MB of weights; "
+          f"{os.path.getsize(args.model) / 2 ** 20:.1f} MB {os.path.basename(args.model)})")
+    return {'model': args.model, 'artifact': path, 'weights_bytes': weights_bytes,
+            'model_file_bytes': os.path.getsize(args.model)}
+
+
+def _memory(fields=('Rss', 'Pss', 'Private_Clean', 'Private_Dirty', 'Shared_Clean')):
+    """This process's memory (bytes) from /proc/self/smaps_rollup (Linux)"""
+    values = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in fields:
+                values[name] = int(rest.split()[0]) * 1024
+    return values
+
+
+def _load_worker(source, path, start_barrier, connection):
+    # Runs in a fresh process; TensorFlow is imported before the clock starts
+    import tensorflow as tf
+    import serving_model  # noqa: F401
+
+    before = _memory()
+    start_barrier.wait()
+    start = time.perf_counter()
+    model = tf.keras.models.load_model(path) if source == 'h5' else load_artifact(path)
+    loaded = time.perf_counter() - start
+    model(np.zeros((1, *model.input_shape[1:]), dtype=np.float32), training=False)
+    after = _memory()
+    connection.send({
+        'load_seconds': loaded,
+        'rss_growth': after['Rss'] - before['Rss'],
+        'private_growth': (after['Private_Clean'] + after['Private_Dirty']) -
+                          (before['Private_Clean'] + before['Private_Dirty']),
+        'pss_growth': after['Pss'] - before['Pss']
+    })
+    connection.close()
+
+
+def measure_load(source, path, workers):
+    """Load `path` in `workers` fresh processes at once; per-process results"""
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(workers)
+    pipes, processes = [], []
+    for _ in range(workers):
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_load_worker, args=(source, path, barrier, sender))
+        process.start()
+        sender.close()
+        pipes.append(receiver)
+        processes.append(process)
+    results = [receiver.recv() for receiver in pipes]
+    for process in processes:
+        process.join()
+    return results
+
+
+def bench(args):
+    """Load time and per-process memory of the .h5 file against the serving artifact"""
+    path = artifact_path(args.model)
+    if not artifact_is_current(args.model):
+        print(f"No current artifact for {args.model}; converting")
+        convert(argparse.Namespace(model=args.model, output=None))
+
+    sources = {'h5': args.model, 'artifact': path}
+    results = []
+    print(f"{'format':>10}{'workers':>9}{'load s':>9}{'max s':>8}{'RSS MB':>9}{'private MB':>12}{'PSS MB':>9}")
+    for workers in args.workers:
+        for source, source_path in sources.items():
+            runs = [measure_load(source, source_path, workers) for _ in range(args.repeat)]
+            per_process = [result for run in runs for result in run]
+
+            def mean(key):
+                return sum(result[key] for result in per_process) / len(per_process)
+
+            entry = {
+                'format': source,
+                'workers': workers,
+                'load_seconds': mean('load_seconds'),
+                'max_load_seconds': max(result['load_seconds'] for result in per_process),
+                'rss_growth_bytes': mean('rss_growth'),
+                'private_growth_bytes': mean('private_growth'),
+                'pss_growth_bytes': mean('pss_growth')
+            }
+            results.append(entry)
+            print(f"{source:>10}{workers:>9}{entry['load_seconds']:>9.3f}{entry['max_load_seconds']:>8.3f}"
+                  f"{entry['rss_growth_bytes'] / 2 ** 20:>9.1f}{entry['private_growth_bytes'] / 2 ** 20:>12.1f}"
+                  f"{entry['pss_growth_bytes'] / 2 ** 20:>9.1f}")
+    return {
+        'model': args.model,
+        'model_file_bytes': os.path.getsize(args.model),
+        'weights_bytes': os.path.getsize(os.path.join(path, WEIGHTS_NAME)),
+        'results': results
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serving artifacts: convert models and compare load cost')
+    parser.add_argument('--model', default=os.path.join('model', 'brain_tumor_model.h5'))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='write the serving artifact of --model')
+    convert_parser.add_argument('--output', help='artifact directory (default: next to the model)')
+    convert_parser.add_argument('--json', dest='json_path', help='write the result to this file')
+
+    bench_parser = subparsers.add_parser('bench', help='load time and RSS per worker process, .h5 vs artifact')
+    bench_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+                              help='processes loading the model at the same time')
+    bench_parser.add_argument('--repeat', type=int, default=3)
+    bench_parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    args = parser.parse_args()
+
+    result = convert(args) if args.command == 'convert' else bench(args)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,588 @@
+#!/usr/bin/env python3
+"""
+MRI preprocessing without TensorFlow, and a worker pool that runs it
+
+`preprocess_bytes` is the backend pipeline (decode, grayscale, resize to the
+model's input size, Gaussian blur, CLAHE) applied to the raw bytes of an
+upload. The size and the blur and CLAHE parameters are whatever the model was
+trained with: `preprocessing_options` reads them from the model's input shape
+and its model_info.json (128x128, 5x5 blur, CLAHE 2.0 on 8x8 tiles by default).
+It returns uint8 pixels; scaling to [0, 1] is the model's first layer, so
+every tensor that is queued, cached or stored is a quarter of the float32
+size. It only needs OpenCV and NumPy, so it can run in processes that never
+import TensorFlow.
+
+`PreprocessPool` runs it in separate worker processes. Uploads are sent to
+the workers as bytes; each worker writes the uint8 tensor straight into a
+slot of a shared-memory block and reports back only the slot number, so
+arrays are never pickled. Decoding and CLAHE then no longer hold the request
+threads or compete with TensorFlow's thread pool in the web process, which
+is left with I/O and batching. A fixed number of slots bounds the memory and
+the work in flight: `submit` blocks while all slots are taken. A worker that
+dies (e.g. a crash in a native decoder) is replaced; the upload it was
+working on fails and its slot is returned.
+
+Decoding is the most expensive step for large uploads, and nearly all of
+the decoded pixels are discarded by the resize to the input size. `decode_image`
+therefore decodes straight to grayscale and, for JPEG, lets libjpeg decode at
+1/2, 1/4 or 1/8 scale (DCT scaling), choosing the largest reduction that still
+leaves at least twice the target resolution for the INTER_AREA resize. The
+reduction comes from the header dimensions. OpenCV's PNG, TIFF and BMP decoders
+cannot downsample while decoding (a reduced flag just decodes fully and then
+resizes without area averaging), so those are only decoded to grayscale.
+
+    python preprocessing.py parity --resize 2048 --format jpg   # reduced vs full decode
+    python preprocessing.py bench --sizes 512 1024 2048         # decode time and peak memory
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import sys
+import threading
+import time
+import types
+from concurrent.futures import Future
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from upload_stream import SNIFF_LIMIT, NeedMoreData, sniff_image_header
+
+IMG_SIZE = (128, 128)
+
+REDUCED_GRAYSCALE = {2: cv2.IMREAD_REDUCED_GRAYSCALE_2, 4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                     8: cv2.IMREAD_REDUCED_GRAYSCALE_8}
+# Formats whose decoder scales down while decoding
+REDUCED_DECODE_FORMATS = {'jpeg'}
+# Minimum decoded resolution, as a multiple of the target size
+OVERSAMPLE = 2
+
+_local = threading.local()
+
+
+def _clahe(clip_limit=2.0, tile_grid=(8, 8)):
+    # CLAHE objects keep scratch buffers, so each thread gets its own
+    cache = getattr(_local, 'clahe', None)
+    if cache is None:
+        cache = _local.clahe = {}
+    key = (float(clip_limit), tuple(tile_grid))
+    clahe = cache.get(key)
+    if clahe is None:
+        clahe = cache[key] = cv2.createCLAHE(clipLimit=key[0], tileGridSize=key[1])
+    return clahe
+
+
+def preprocess_gray(gray, size=IMG_SIZE, blur_kernel=5, clahe_clip_limit=2.0, clahe_tile_grid=(8, 8)):
+    """
+    Resize, blur and CLAHE a uint8 grayscale image; returns uint8 (H, W).
+    `size` is (width, height); a `blur_kernel` of 0 or a `clahe_clip_limit` of
+    None skips that step.
+    """
+    image = cv2.resize(gray, tuple(size), interpolation=cv2.INTER_AREA)
+    if blur_kernel:
+        image = cv2.GaussianBlur(image, (blur_kernel, blur_kernel), 0)
+    if clahe_clip_limit is not None:
+        image = _clahe(clahe_clip_limit, clahe_tile_grid).apply(image)
+    return image
+
+
+def preprocessing_section(size=IMG_SIZE, blur_kernel=5, clahe_clip_limit=2.0, clahe_tile_grid=(8, 8)):
+    """The `preprocessing` entry train_model.py writes to model_info.json"""
+    return {
+        'resize': list(size),
+        'grayscale': True,
+        'gaussian_blur': bool(blur_kernel),
+        'blur_kernel': blur_kernel,
+        'clahe': clahe_clip_limit is not None,
+        'clahe_clip_limit': clahe_clip_limit,
+        'clahe_tile_grid': list(clahe_tile_grid)
+    }
+
+
+def preprocessing_options(section=None, input_shape=None):
+    """
+    Keyword arguments for preprocess_gray / preprocess_bytes / PreprocessPool
+    from a model_info.json `preprocessing` section and the model's input shape
+    ((batch, height, width, channels)). Missing entries keep the defaults
+    (older model_info.json files only list the steps). The input shape is
+    authoritative for the size: a model_info.json left behind by another model
+    must not change what the loaded model is fed.
+    """
+    section = section or {}
+    options = {'size': IMG_SIZE, 'blur_kernel': 5, 'clahe_clip_limit': 2.0, 'clahe_tile_grid': (8, 8)}
+    if section.get('resize'):
+        options['size'] = tuple(int(side) for side in section['resize'])
+    if section.get('blur_kernel') is not None:
+        options['blur_kernel'] = int(section['blur_kernel'])
+    if section.get('gaussian_blur') is False:
+        options['blur_kernel'] = 0
+    if section.get('clahe_clip_limit') is not None:
+        options['clahe_clip_limit'] = float(section['clahe_clip_limit'])
+    if section.get('clahe_tile_grid'):
+        options['clahe_tile_grid'] = tuple(int(tiles) for tiles in section['clahe_tile_grid'])
+    if section.get('clahe') is False:
+        options['clahe_clip_limit'] = None
+    if input_shape is not None and input_shape[1] and input_shape[2]:
+        options['size'] = (int(input_shape[2]), int(input_shape[1]))
+    if options['blur_kernel'] and options['blur_kernel'] % 2 == 0:
+        raise ValueError(f"Gaussian blur kernel must be odd, got {options['blur_kernel']}")
+    return options
+
+
+def load_preprocessing_options(info_path, input_shape=None):
+    """preprocessing_options from a model_info.json file (defaults if it does not exist)"""
+    section = None
+    if info_path and os.path.exists(info_path):
+        with open(info_path) as f:
+            section = json.load(f).get('preprocessing')
+    return preprocessing_options(section, input_shape)
+
+
+def reduction_factor(header, size=IMG_SIZE):
+    """Largest decode-time reduction (1, 2, 4 or 8) for an image header and target size"""
+    if header['format'] not in REDUCED_DECODE_FORMATS or header['width'] is None:
+        return 1
+    factor = 1
+    for candidate in sorted(REDUCED_GRAYSCALE):
+        if header['width'] // candidate >= size[0] * OVERSAMPLE and \
+                header['height'] // candidate >= size[1] * OVERSAMPLE:
+            factor = candidate
+    return factor
+
+
+def decode_flags(data, size=IMG_SIZE):
+    """imdecode flags for reading an upload straight to grayscale at reduced resolution"""
+    try:
+        header = sniff_image_header(data[:SNIFF_LIMIT])
+    except (NeedMoreData, ValueError):
+        # Let the decoder have a go (and report the error)
+        return cv2.IMREAD_GRAYSCALE
+    factor = reduction_factor(header, size)
+    return REDUCED_GRAYSCALE[factor] if factor > 1 else cv2.IMREAD_GRAYSCALE
+
+
+def decode_image(data, size=None):
+    """
+    Decode upload bytes to a uint8 grayscale image. Without `size` this is the
+    full decode (as cv2.imread, then BGR2GRAY); with it, the reduced decode for
+    that target size (see decode_flags).
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    flags = cv2.IMREAD_COLOR if size is None else decode_flags(data, size)
+    image = cv2.imdecode(buffer, flags)
+    if image is None:
+        raise ValueError("Could not read image file")
+    if image.ndim == 3:
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def preprocess_bytes(data, size=IMG_SIZE, reduced_decode=True, **options):
+    """
+    Full backend preprocessing of an encoded image; returns uint8 (H, W).
+    `options` are the blur and CLAHE arguments of preprocess_gray.
+    """
+    return preprocess_gray(decode_image(data, size if reduced_decode else None), size, **options)
+
+
+@contextmanager
+def _main_module_hidden():
+    """
+    Spawned children re-import the parent's main script before running their
+    target. For the backend that is app.py, i.e. TensorFlow and the Flask app
+    in every worker, while the workers only need this module.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+IDLE = -1
+WATCH_INTERVAL = 1.0  # seconds between checks that the pool is still open
+
+
+def _worker(index, claims, shm_name, slots, size, reduced_decode, options, tasks, results):
+    # One OpenCV thread per worker: the pool supplies the parallelism
+    cv2.setNumThreads(1)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    output = np.ndarray((slots, size[1], size[0]), dtype=np.uint8, buffer=shm.buf)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, slot, data = task
+            # Lets the pool fail this task if the process dies while on it
+            claims[index] = task_id
+            started = time.monotonic()
+            cpu_start = time.process_time()
+            error = None
+            try:
+                output[slot] = preprocess_bytes(data, size, reduced_decode, **options)
+            except Exception as e:
+                error = str(e)
+            results.put((task_id, error, started, time.monotonic() - started,
+                         time.process_time() - cpu_start))
+            claims[index] = IDLE
+    finally:
+        del output
+        shm.close()
+
+
+class PreprocessPool:
+    def __init__(self, workers=2, slots=None, size=IMG_SIZE, reduced_decode=True, **options):
+        size = tuple(size)
+        self.size = size
+        self.options = options
+        self.workers = max(1, workers)
+        self.slots = slots or self.workers * 4
+        context = multiprocessing.get_context('spawn')  # never fork a process holding TensorFlow
+        self._context = context
+        self._reduced_decode = reduced_decode
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slots * size[0] * size[1])
+        self._output = np.ndarray((self.slots, size[1], size[0]), dtype=np.uint8, buffer=self._shm.buf)
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._free = queue.Queue()
+        for slot in range(self.slots):
+            self._free.put(slot)
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = {'completed': 0, 'errors': 0, 'wait_seconds': 0.0, 'worker_seconds': 0.0,
+                       'worker_cpu_seconds': 0.0, 'worker_restarts': 0}
+        # Task each worker is on, IDLE between tasks
+        self._claims = context.RawArray('q', [IDLE] * self.workers)
+
+        self.closed = False
+        self._processes = [self._start_worker(i) for i in range(self.workers)]
+        self._collector = threading.Thread(target=self._collect, name='preprocess-results', daemon=True)
+        self._collector.start()
+        self._watcher = threading.Thread(target=self._watch, name='preprocess-watch', daemon=True)
+        self._watcher.start()
+
+    def _start_worker(self, index):
+        process = self._context.Process(
+            target=_worker, args=(index, self._claims, self._shm.name, self.slots, self.size,
+                                  self._reduced_decode, self.options, self._tasks, self._results),
+            daemon=True, name=f'preprocess-{index}')
+        with _main_module_hidden():
+            process.start()
+        return process
+
+    def _watch(self):
+        """Replace workers that die, failing the task each was working on"""
+        while not self.closed:
+            sentinels = [process.sentinel for process in self._processes]
+            multiprocessing.connection.wait(sentinels, timeout=WATCH_INTERVAL)
+            if self.closed:
+                return
+            for index, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                task_id = self._claims[index]
+                self._claims[index] = IDLE
+                process.join()
+                with self._lock:
+                    pending = self._pending.pop(task_id, None) if task_id != IDLE else None
+                    self._stats['worker_restarts'] += 1
+                    if pending is not None:
+                        self._stats['completed'] += 1
+                        self._stats['errors'] += 1
+                if pending is not None:
+                    future, slot, _ = pending
+                    future.set_exception(RuntimeError(
+                        f'Preprocessing worker exited with code {process.exitcode}'))
+                    self._free.put(slot)
+                self._processes[index] = self._start_worker(index)
+
+    def _collect(self):
+        while True:
+            message = self._results.get()
+            if message is None:
+                return
+            task_id, error, started, seconds, cpu_seconds = message
+            with self._lock:
+                pending = self._pending.pop(task_id, None)
+                if pending is None:
+                    # Already failed by _watch: the worker died after reporting
+                    continue
+                future, slot, submitted = pending
+                self._stats['completed'] += 1
+                self._stats['errors'] += error is not None
+                self._stats['wait_seconds'] += max(0.0, started - submitted)
+                self._stats['worker_seconds'] += seconds
+                self._stats['worker_cpu_seconds'] += cpu_seconds
+            if error is None:
+                future.set_result(self._output[slot].copy())
+            else:
+                future.set_exception(ValueError(error))
+            self._free.put(slot)
+
+    def submit(self, data, timeout=None):
+        """
+        Queue the raw bytes of an upload; returns a Future of the uint8 (H, W)
+        tensor. Blocks while every slot is in use (queue.Empty after `timeout`).
+        """
+        if self.closed:
+            raise RuntimeError('Preprocessing pool is closed')
+        slot = self._free.get(timeout=timeout)
+        future = Future()
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (future, slot, time.monotonic())
+        self._tasks.put((task_id, slot, bytes(data)))
+        return future
+
+    def preprocess(self, data, timeout=None):
+        """Preprocess one upload in a worker and wait for the tensor"""
+        start = time.monotonic()
+        future = self.submit(data, timeout=timeout)
+        remaining = None if timeout is None else max(0.0, timeout - (time.monotonic() - start))
+        return future.result(remaining)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            in_flight = len(self._pending)
+        completed = stats['completed']
+        return {
+            'workers': self.workers,
+            'tensor_shape': [self.size[1], self.size[0]],
+            'alive_workers': sum(process.is_alive() for process in self._processes),
+            'slots': self.slots,
+            'shared_memory_bytes': self._shm.size,
+            'in_flight': in_flight,
+            'completed': completed,
+            'errors': stats['errors'],
+            'worker_restarts': stats['worker_restarts'],
+            'avg_wait_ms': round(stats['wait_seconds'] / completed * 1000, 2) if completed else None,
+            'avg_worker_ms': round(stats['worker_seconds'] / completed * 1000, 2) if completed else None,
+            'worker_cpu_seconds': round(stats['worker_cpu_seconds'], 3)
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self._processes:
+            self._tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        self._results.put(None)
+        self._collector.join(timeout=5)
+        self._watcher.join(timeout=WATCH_INTERVAL + 1)
+        del self._output
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+DECODE_MODES = ('full', 'grayscale', 'reduced')
+ENCODINGS = {'png': ('.png', []), 'jpg': ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 90]), 'tiff': ('.tiff', [])}
+
+
+def decode_with(mode, data):
+    if mode == 'full':
+        return decode_image(data)
+    if mode == 'grayscale':
+        return cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    return decode_image(data, IMG_SIZE)
+
+
+def encode(image, fmt):
+    extension, params = ENCODINGS[fmt]
+    ok, encoded = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f'Could not encode {fmt}')
+    return encoded.tobytes()
+
+
+def _memory_status(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    raise OSError(f'{field} not in /proc/self/status')
+
+
+def _peak_decode_memory(mode, data, connection):
+    # Runs in a fresh process; resetting the high-water mark (Linux) leaves
+    # the imports out of the peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        before = _memory_status('VmRSS')
+        decode_with(mode, data)
+        connection.send(_memory_status('VmHWM') - before)
+    except OSError:
+        connection.send(None)
+    connection.close()
+
+
+def peak_decode_memory(mode, data):
+    """Growth of the resident set size (bytes) at its peak while decoding once; None if not measurable"""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_peak_decode_memory, args=(mode, data, sender))
+    process.start()
+    sender.close()
+    peak = receiver.recv()
+    process.join()
+    return peak
+
+
+def bench(args):
+    """Decode time and peak memory per input size, format and decode mode"""
+    from generate_sample_data import create_synthetic_mri_image
+
+    results = []
+    print(f"{'size':>6}{'format':>8}{'file KB':>10}{'mode':>12}{'mean ms':>10}{'p50 ms':>10}"
+          f"{'decoded':>12}{'peak MB':>10}")
+    for side in args.sizes:
+        np.random.seed(args.seed)
+        # Uploads are usually exported as 3-channel images even for grayscale scans
+        image = cv2.cvtColor(create_synthetic_mri_image(has_tumor=True, size=(side, side)), cv2.COLOR_GRAY2BGR)
+        for fmt in args.formats:
+            data = encode(image, fmt)
+            for mode in DECODE_MODES:
+                decoded = decode_with(mode, data)
+                samples = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    decode_with(mode, data)
+                    samples.append(time.perf_counter() - start)
+                samples.sort()
+                entry = {
+                    'size': side,
+                    'format': fmt,
+                    'file_bytes': len(data),
+                    'mode': mode,
+                    'decoded_shape': list(decoded.shape),
+                    'mean_ms': sum(samples) / len(samples) * 1000,
+                    'p50_ms': samples[len(samples) // 2] * 1000,
+                    'peak_memory_bytes': peak_decode_memory(mode, data)
+                }
+                results.append(entry)
+                print(f"{side:>6}{fmt:>8}{len(data) / 1024:>10.0f}{mode:>12}{entry['mean_ms']:>10.2f}"
+                      f"{entry['p50_ms']:>10.2f}{'x'.join(map(str, decoded.shape[:2])):>12}"
+                      f"{(entry['peak_memory_bytes'] or 0) / 2 ** 20:>10.1f}")
+    return results
+
+
+def parity(args):
+    """
+    Preprocessed tensors (and, with a model, predictions) from the reduced
+    decode against the full decode, optionally re-encoding every image at a
+    larger size and another format to simulate oversized uploads
+    """
+    from catalog import list_images
+
+    paths = [path for path, _ in list_images(args.data_dir, args.split)]
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError(f"No {args.split} images found in {args.data_dir}")
+
+    model = None
+    options = preprocessing_options()
+    if args.model and os.path.exists(args.model):
+        import tensorflow as tf
+        from serving_model import with_input_scaling
+
+        model = with_input_scaling(tf.keras.models.load_model(args.model, compile=False))
+        info_path = os.path.join(os.path.dirname(args.model), 'model_info.json')
+        options = load_preprocessing_options(info_path, model.input_shape)
+
+    full, reduced = [], []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if args.resize or args.format:
+            image = cv2.imread(path, cv2.IMREAD_COLOR)
+            if args.resize:
+                image = cv2.resize(image, (args.resize, args.resize), interpolation=cv2.INTER_CUBIC)
+            data = encode(image, args.format or 'png')
+        full.append(preprocess_bytes(data, reduced_decode=False, **options))
+        reduced.append(preprocess_bytes(data, **options))
+    full, reduced = np.stack(full), np.stack(reduced)
+
+    # In gray levels (the tensors are uint8)
+    difference = np.abs(full.astype(np.int16) - reduced)
+    report = {
+        'images': len(paths),
+        'resize': args.resize,
+        'format': args.format,
+        'max_abs_pixel_diff': int(difference.max()),
+        'mean_abs_pixel_diff': float(difference.mean()),
+        'identical_images': int(np.sum(difference.reshape(len(paths), -1).max(axis=1) == 0))
+    }
+    print(f"{len(paths)} images: max |pixel diff| {report['max_abs_pixel_diff']} gray levels, "
+          f"mean {report['mean_abs_pixel_diff']:.4f}, identical {report['identical_images']}")
+
+    if model is not None:
+        threshold = 0.5
+        if os.path.exists(info_path):
+            with open(info_path) as f:
+                threshold = json.load(f).get('decision_threshold', threshold)
+        p_full = model.predict(full[..., np.newaxis], batch_size=256, verbose=0).ravel()
+        p_reduced = model.predict(reduced[..., np.newaxis], batch_size=256, verbose=0).ravel()
+        report.update({
+            'threshold': threshold,
+            'max_abs_probability_diff': float(np.max(np.abs(p_full - p_reduced))),
+            'mean_abs_probability_diff': float(np.mean(np.abs(p_full - p_reduced))),
+            'decision_flips': int(np.sum((p_full >= threshold) != (p_reduced >= threshold)))
+        })
+        print(f"Model {args.model}: max |probability diff| {report['max_abs_probability_diff']:.5f}, "
+              f"decision flips at {threshold:.4f}: {report['decision_flips']} of {len(paths)}")
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Reduced-resolution decode: parity check and benchmark')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parity_parser = subparsers.add_parser('parity', help='compare the reduced and the full decode')
+    parity_parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    parity_parser.add_argument('--split', default='test')
+    parity_parser.add_argument('--limit', type=int, help='compare at most this many images')
+    parity_parser.add_argument('--resize', type=int, help='re-encode every image at this side length first')
+    parity_parser.add_argument('--format', choices=list(ENCODINGS), help='re-encode every image in this format first')
+    parity_parser.add_argument('--model', default=os.path.join('model', 'brain_tumor_model.h5'),
+                               help='also compare predictions of this model (skipped if missing)')
+    parity_parser.add_argument('--json', dest='json_path', help='write the report to this file')
+
+    bench_parser = subparsers.add_parser('bench', help='decode time and peak memory by input size')
+    bench_parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024, 2048])
+    bench_parser.add_argument('--formats', nargs='+', choices=list(ENCODINGS), default=list(ENCODINGS))
+    bench_parser.add_argument('--repeat', type=int, default=20)
+    bench_parser.add_argument('--seed', type=int, default=0)
+    bench_parser.add_argument('--json', dest='json_path', help='write the results to this file')
+    args = parser.parse_args()
+
+    result = parity(args) if args.command == 'parity' else bench(args)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""
+Serving model with the preprocessing inside the graph
+
+The backend preprocesses every upload in NumPy/OpenCV (see preprocessing.py)
+and only then calls the model, so each image crosses into Python several
+times and a batch has to be assembled from separately preprocessed images.
+`build_serving_model` puts the same steps in front of the trained classifier
+as Keras layers:
+
+    Grayscale -> AreaResize -> GaussianBlur -> CLAHE -> classifier
+
+(the classifier's first layer scales the 0-255 pixels to [0, 1]; see
+`with_input_scaling` for models trained before it did).
+
+The serving model takes decoded uint8 pixels, (batch, height, width, 1 or 3)
+in OpenCV's BGR order, of any height and width, and returns the tumor
+probability. Decoding stays outside the graph (it is format specific), but a
+whole batch of decoded images goes through one compiled graph.
+
+The layers reproduce OpenCV's arithmetic (fixed-point BGR2GRAY, INTER_AREA
+including its fixed-point linear enlargement, the binomial Gaussian kernels
+up to 7x7 with reflect-101 borders, CLAHE including the clipped-count
+redistribution and bilinear LUT interpolation), rounding to uint8 between
+steps like the uint8 images in OpenCV. The output size is the classifier's
+input size, and the blur and CLAHE parameters are the ones recorded in the
+model_info.json next to it. `parity` checks the result against
+`preprocess_mri_image`. All images in one batch must have the same size.
+
+    python serving_model.py export                 # model/serving_model.keras
+    python serving_model.py parity --resize 512    # against preprocess_mri_image
+    python serving_model.py bench --size 512 --batch-sizes 1 8 32
+"""
+
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from preprocessing import IMG_SIZE, load_preprocessing_options, preprocess_bytes, preprocess_gray
+
+MODEL_FOLDER = 'model'
+MODEL_PATH = os.path.join(MODEL_FOLDER, 'brain_tumor_model.h5')
+SERVING_MODEL_PATH = os.path.join(MODEL_FOLDER, 'serving_model.keras')
+PIXEL_SCALE = 1.0 / 255
+
+register = tf.keras.utils.register_keras_serializable(package='mris')
+
+
+def _round_to_uint8(x):
+    # saturate_cast<uchar>: round to nearest and clip, kept as float32 for the next layer
+    return tf.clip_by_value(tf.round(x), 0.0, 255.0)
+
+
+def _round_half_up_to_uint8(x):
+    # OpenCV's integer-scale area resize averages in fixed point and rounds halves up,
+    # where tf.round would round them to even
+    return tf.clip_by_value(tf.floor(x + 0.5), 0.0, 255.0)
+
+
+@register
+class Grayscale(tf.keras.layers.Layer):
+    """BGR (or single-channel) uint8 pixels to one float32 channel, as cv2.COLOR_BGR2GRAY"""
+
+    def call(self, inputs):
+        pixels = tf.cast(inputs, tf.float32)
+
+        def bgr_to_gray():
+            # OpenCV's fixed-point coefficients (14 bits) for 0.114 B + 0.587 G + 0.299 R;
+            # the sums stay below 2 ** 24, so float32 is exact (and faster than int32 on CPU)
+            weights = tf.constant([1868.0, 9617.0, 4899.0], shape=[1, 1, 3, 1])
+            weighted = tf.nn.conv2d(pixels[..., :3], weights, strides=1, padding='VALID')
+            return tf.floor((weighted + 8192.0) / 16384.0)
+
+        return tf.cond(tf.shape(pixels)[-1] >= 3, bgr_to_gray, lambda: pixels[..., :1])
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (1,)
+
+
+def _upscale_coefficients(source, target):
+    # cv::resize INTER_AREA when enlarging: linear interpolation at area-aligned
+    # positions, weights in 11-bit fixed point
+    inverse_scale = tf.cast(target, tf.float64) / tf.cast(source, tf.float64)
+    index = tf.range(target, dtype=tf.float64)
+    first = tf.floor(index / inverse_scale)
+    fraction = (index + 1) - (first + 1) * inverse_scale
+    fraction = tf.cast(tf.where(fraction <= 0, tf.zeros_like(fraction), fraction - tf.floor(fraction)), tf.float32)
+    first = tf.cast(first, tf.int32)
+    last = first + 1 >= source
+    fraction = tf.where(last, tf.zeros_like(fraction), fraction)
+    first = tf.where(last, source - 1, first)
+    weight = tf.cast(tf.round((1.0 - fraction) * 2048), tf.int32)
+    return first, tf.minimum(first + 1, source - 1), weight, 2048 - weight
+
+
+def _area_upscale(pixels, target):
+    shift = tf.bitwise.right_shift
+    x0, x1, a0, a1 = _upscale_coefficients(tf.shape(pixels)[2], target[1])
+    y0, y1, b0, b1 = _upscale_coefficients(tf.shape(pixels)[1], target[0])
+    rows = tf.gather(pixels, x0, axis=2) * a0[:, tf.newaxis] + tf.gather(pixels, x1, axis=2) * a1[:, tf.newaxis]
+    b0, b1 = b0[:, tf.newaxis, tf.newaxis], b1[:, tf.newaxis, tf.newaxis]
+    # OpenCV's vectorized 8-bit path: pre-shift by 4, multiply, shift by 16, round the last 2 bits
+    top = shift(shift(tf.gather(rows, y0, axis=1), 4) * b0, 16)
+    bottom = shift(shift(tf.gather(rows, y1, axis=1), 4) * b1, 16)
+    return shift(top + bottom + 2, 2)
+
+
+@register
+class AreaResize(tf.keras.layers.Layer):
+    """Resize to a fixed size, as cv2.INTER_AREA (area averaging down, fixed-point linear up)"""
+
+    def __init__(self, size=IMG_SIZE, **kwargs):
+        super().__init__(**kwargs)
+        self.size = tuple(size)
+
+    def call(self, inputs):
+        height, width = tf.shape(inputs)[1], tf.shape(inputs)[2]
+        target = (self.size[1], self.size[0])
+        shrink = tf.logical_and(height >= target[0], width >= target[1])
+        resized = tf.cond(shrink,
+                          lambda: _round_half_up_to_uint8(tf.image.resize(inputs, target, method='area')),
+                          lambda: tf.cast(_area_upscale(tf.cast(inputs, tf.int32), target), tf.float32))
+        return tf.ensure_shape(resized, [None, target[0], target[1], 1])
+
+    def compute_output_shape(self, input_shape):
+        return (input_shape[0], self.size[1], self.size[0], 1)
+
+    def get_config(self):
+        return {**super().get_config(), 'size': list(self.size)}
+
+
+@register
+class GaussianBlur(tf.keras.layers.Layer):
+    """
+    cv2.GaussianBlur(image, (kernel, kernel), 0) for kernel sizes up to 7:
+    separable binomial kernel (1-4-6-4-1 for 5), reflect-101 borders
+    """
+
+    def __init__(self, kernel=5, **kwargs):
+        super().__init__(**kwargs)
+        if kernel not in (1, 3, 5, 7):
+            # Larger kernels are not binomial; OpenCV's 8-bit approximation of them is not reproduced
+            raise ValueError(f"In-graph Gaussian blur supports kernel sizes 1, 3, 5 and 7, got {kernel}")
+        self.kernel = kernel
+
+    def call(self, inputs):
+        k, half = self.kernel, self.kernel // 2
+        weights = tf.constant(cv2.getGaussianKernel(k, 0).ravel(), dtype=tf.float32)
+        padded = tf.pad(inputs, [[0, 0], [half, half], [half, half], [0, 0]], mode='REFLECT')
+        blurred = tf.nn.conv2d(padded, tf.reshape(weights, [k, 1, 1, 1]), strides=1, padding='VALID')
+        blurred = tf.nn.conv2d(blurred, tf.reshape(weights, [1, k, 1, 1]), strides=1, padding='VALID')
+        # OpenCV's 8-bit fixed-point filter rounds halves up; sums of 1/4096ths are exact in float32
+        return tf.clip_by_value(tf.floor(blurred + 0.5), 0.0, 255.0)
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        return {**super().get_config(), 'kernel': self.kernel}
+
+
+@register
+class CLAHE(tf.keras.layers.Layer):
+    """
+    Contrast-limited adaptive histogram equalization, as
+    cv2.createCLAHE(clip_limit, tile_grid) on a uint8 image whose sides are
+    multiples of the tile grid
+    """
+
+    def __init__(self, clip_limit=2.0, tile_grid=(8, 8), **kwargs):
+        super().__init__(**kwargs)
+        self.clip_limit = clip_limit
+        self.tile_grid = tuple(tile_grid)
+
+    def call(self, inputs):
+        tiles_x, tiles_y = self.tile_grid
+        height, width = inputs.shape[1], inputs.shape[2]
+        tile_h, tile_w = height // tiles_y, width // tiles_x
+        tile_area = tile_h * tile_w
+        pixels = tf.cast(inputs[..., 0], tf.int32)
+
+        # Histogram of every tile: (batch * tiles, 256)
+        tiles = tf.reshape(pixels, [-1, tiles_y, tile_h, tiles_x, tile_w])
+        tiles = tf.reshape(tf.transpose(tiles, [0, 1, 3, 2, 4]), [-1, tile_area])
+        histogram = tf.math.bincount(tiles, minlength=256, maxlength=256, axis=-1, dtype=tf.int32)
+
+        # Clip, spread the clipped counts evenly and the remainder every `step` bins
+        limit = max(int(self.clip_limit * tile_area / 256), 1)
+        clipped = tf.reduce_sum(tf.maximum(histogram - limit, 0), axis=-1, keepdims=True)
+        residual = clipped % 256
+        step = tf.maximum(256 // tf.maximum(residual, 1), 1)
+        bins = tf.range(256)[tf.newaxis, :]
+        extra = tf.cast(tf.logical_and(bins % step == 0, bins // step < residual), tf.int32)
+        histogram = tf.minimum(histogram, limit) + clipped // 256 + extra
+        lut = _round_to_uint8(tf.cast(tf.cumsum(histogram, axis=-1), tf.float32) * (255.0 / tile_area))
+        lut = tf.reshape(lut, [-1, tiles_y * tiles_x * 256])
+
+        # Bilinear interpolation between the LUTs of the four nearest tile centres
+        def neighbours(length, tile, count):
+            # Multiplied by the float32 reciprocal, as OpenCV does (not exact unless tile is a power of 2)
+            position = tf.range(length, dtype=tf.float32) * np.float32(1.0 / tile) - 0.5
+            first = tf.floor(position)
+            weight = position - first
+            first = tf.cast(first, tf.int32)
+            return tf.maximum(first, 0), tf.minimum(first + 1, count - 1), weight
+
+        y1, y2, wy = neighbours(height, tile_h, tiles_y)
+        x1, x2, wx = neighbours(width, tile_w, tiles_x)
+        flat_pixels = tf.reshape(pixels, [-1, height * width])
+
+        def lookup(ty, tx):
+            tile_index = ty[:, tf.newaxis] * tiles_x + tx[tf.newaxis, :]
+            index = tf.reshape(tile_index, [1, -1]) * 256 + flat_pixels
+            return tf.reshape(tf.gather(lut, index, batch_dims=1), [-1, height, width])
+
+        wx, wy = wx[tf.newaxis, tf.newaxis, :], wy[tf.newaxis, :, tf.newaxis]
+        top = lookup(y1, x1) * (1 - wx) + lookup(y1, x2) * wx
+        bottom = lookup(y2, x1) * (1 - wx) + lookup(y2, x2) * wx
+        return _round_to_uint8(top * (1 - wy) + bottom * wy)[..., tf.newaxis]
+
+    def compute_output_shape(self, input_shape):
+        return input_shape
+
+    def get_config(self):
+        return {**super().get_config(), 'clip_limit': self.clip_limit, 'tile_grid': list(self.tile_grid)}
+
+
+def rescales_input(model):
+    """True if the model's first layer scales 0-255 pixels to [0, 1] itself"""
+    for layer in model.layers:
+        if not isinstance(layer, tf.keras.layers.InputLayer):
+            return isinstance(layer, tf.keras.layers.Rescaling)
+    return False
+
+
+def with_input_scaling(model):
+    """
+    `model` as a model taking 0-255 pixels. Models trained before the scaling
+    moved into the graph expect [0, 1] floats; they get a Rescaling layer in
+    front (sharing their weights, and still a flat Sequential if they were one).
+    """
+    if rescales_input(model):
+        return model
+    scale = tf.keras.layers.Rescaling(PIXEL_SCALE, name='scale')
+    if isinstance(model, tf.keras.Sequential):
+        return tf.keras.Sequential([tf.keras.Input(shape=model.input_shape[1:]), scale, *model.layers],
+                                   name=model.name)
+    inputs = tf.keras.Input(shape=model.input_shape[1:])
+    return tf.keras.Model(inputs, model(scale(inputs)), name=model.name)
+
+
+def build_preprocessing(size=IMG_SIZE, blur_kernel=5, clahe_clip_limit=2.0, clahe_tile_grid=(8, 8)):
+    """
+    The preprocessing layers alone: uint8 pixels in, (batch, H, W, 1) float32
+    gray levels 0-255 out. Arguments as preprocessing.preprocess_gray.
+    """
+    inputs = tf.keras.Input(shape=(None, None, None), dtype='uint8', name='pixels')
+    x = Grayscale(name='grayscale')(inputs)
+    x = AreaResize(size, name='resize')(x)
+    if blur_kernel:
+        x = GaussianBlur(blur_kernel, name='blur')(x)
+    if clahe_clip_limit is not None:
+        if size[0] % clahe_tile_grid[0] or size[1] % clahe_tile_grid[1]:
+            raise ValueError(f"In-graph CLAHE needs an input size divisible by its {clahe_tile_grid[0]}x"
+                             f"{clahe_tile_grid[1]} tile grid, got {size[0]}x{size[1]}")
+        x = CLAHE(clahe_clip_limit, clahe_tile_grid, name='clahe')(x)
+    return tf.keras.Model(inputs, x, name='preprocessing')
+
+
+def model_preprocessing(model_path, classifier):
+    """Preprocessing options for a saved classifier (its input shape and its model_info.json)"""
+    info_path = os.path.join(os.path.dirname(model_path), 'model_info.json')
+    return load_preprocessing_options(info_path, classifier.input_shape)
+
+
+def build_serving_model(classifier, preprocessing=None):
+    """
+    Preprocessing layers followed by `classifier`; `preprocessing` holds the
+    blur and CLAHE arguments of build_preprocessing (its defaults if omitted)
+    """
+    classifier = with_input_scaling(classifier)
+    size = (classifier.input_shape[2], classifier.input_shape[1])
+    preprocessing = build_preprocessing(size, **(preprocessing or {}))
+    outputs = classifier(preprocessing.output)
+    return tf.keras.Model(preprocessing.input, outputs, name='serving_model')
+
+
+def serving_function(model):
+    """Compiled forward pass taking uint8 batches of any image size, without retracing"""
+    return tf.function(lambda pixels: model(pixels, training=False),
+                       input_signature=[tf.TensorSpec([None, None, None, None], tf.uint8)])
+
+
+def load_threshold(model_path):
+    info_path = os.path.join(os.path.dirname(model_path), 'model_info.json')
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            return json.load(f).get('decision_threshold', 0.5)
+    return 0.5
+
+
+def export(args):
+    classifier = tf.keras.models.load_model(args.model, compile=False)
+    options = model_preprocessing(args.model, classifier)
+    size = options.pop('size')
+    model = build_serving_model(classifier, options)
+    model.save(args.output)
+    print(f"Serving model written to {args.output} (input: uint8 pixels, any size, resized to "
+          f"{size[0]}x{size[1]}; output: probability)")
+    return {'model': args.model, 'output': args.output, 'size': list(size), 'preprocessing': options}
+
+
+def parity(args):
+    """Graph preprocessing and predictions against preprocess_mri_image (full decode)"""
+    from catalog import list_images
+    from preprocessing import encode
+
+    paths = [path for path, _ in list_images(args.data_dir, args.split)]
+    if args.limit:
+        paths = paths[:args.limit]
+    if not paths:
+        raise ValueError(f"No {args.split} images found in {args.data_dir}")
+
+    classifier = with_input_scaling(tf.keras.models.load_model(args.model, compile=False))
+    options = model_preprocessing(args.model, classifier)
+    preprocessing = serving_function(build_preprocessing(**options))
+    forward = tf.function(lambda x: classifier(x, training=False))
+
+    reference, graph = [], []
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if args.resize:
+            image = cv2.resize(cv2.imread(path, cv2.IMREAD_COLOR), (args.resize, args.resize),
+                               interpolation=cv2.INTER_CUBIC)
+            data = encode(image, 'png')
+        reference.append(preprocess_bytes(data, reduced_decode=False, **options))
+        pixels = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        graph.append(preprocessing(pixels[np.newaxis]).numpy()[0, ..., 0])
+    reference, graph = np.stack(reference), np.stack(graph)
+
+    levels = np.abs(reference.astype(np.int32) - graph.astype(np.int32))
+    p_reference = np.concatenate([forward(batch[..., np.newaxis]).numpy().ravel()
+                                  for batch in np.array_split(reference, max(len(paths) // 256, 1))])
+    p_graph = np.concatenate([forward(batch[..., np.newaxis]).numpy().ravel()
+                              for batch in np.array_split(graph, max(len(paths) // 256, 1))])
+    threshold = load_threshold(args.model)
+    report = {
+        'images': len(paths),
+        'resize': args.resize,
+        'max_abs_pixel_diff_levels': int(levels.max()),
+        'mean_abs_pixel_diff_levels': float(levels.mean()),
+        'pixels_identical': float(np.mean(levels == 0)),
+        'pixels_within_one_level': float(np.mean(levels <= 1)),
+        'threshold': threshold,
+        'max_abs_probability_diff': float(np.max(np.abs(p_reference - p_graph))),
+        'mean_abs_probability_diff': float(np.mean(np.abs(p_reference - p_graph))),
+        'decision_flips': int(np.sum((p_reference >= threshold) != (p_graph >= threshold)))
+    }
+    print(f"{len(paths)} images: {report['pixels_identical']:.2%} of pixels identical, "
+          f"{report['pixels_within_one_level']:.2%} within one gray level, max diff "
+          f"{report['max_abs_pixel_diff_levels']} levels")
+    print(f"Model {args.model}: max |probability diff| {report['max_abs_probability_diff']:.5f}, "
+          f"decision flips at {threshold:.4f}: {report['decision_flips']} of {len(paths)}")
+    return report
+
+
+def bench(args):
+    """Images/second: OpenCV preprocessing + batched model call against the serving graph"""
+    from generate_sample_data import create_synthetic_mri_image
+
+    classifier = with_input_scaling(tf.keras.models.load_model(args.model, compile=False))
+    options = model_preprocessing(args.model, classifier)
+    size = options.pop('size')
+    forward = tf.function(lambda x: classifier(x, training=False))
+    serve = serving_function(build_serving_model(classifier, options))
+
+    np.random.seed(args.seed)
+    images = [cv2.cvtColor(create_synthetic_mri_image(has_tumor=bool(i % 2), size=(args.size, args.size)),
+                           cv2.COLOR_GRAY2BGR) for i in range(max(args.batch_sizes))]
+
+    def opencv(batch):
+        tensors = np.stack([preprocess_gray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), size, **options)
+                            for image in batch])
+        return forward(tensors[..., np.newaxis]).numpy()
+
+    def graph(batch):
+        return serve(np.stack(batch)).numpy()
+
+    results = []
+    print(f"{'batch':>6}{'pipeline':>10}{'ms/batch':>10}{'images/s':>10}")
+    for batch_size in args.batch_sizes:
+        batch = images[:batch_size]
+        for name, run in (('opencv', opencv), ('graph', graph)):
+            run(batch)  # trace and warm up
+            samples = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                run(batch)
+                samples.append(time.perf_counter() - start)
+            mean = sum(samples) / len(samples)
+            results.append({'size': args.size, 'batch_size': batch_size, 'pipeline': name,
+                            'ms_per_batch': mean * 1000, 'images_per_sec': batch_size / mean})
+            print(f"{batch_size:>6}{name:>10}{mean * 1000:>10.2f}{batch_size / mean:>10.1f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serving model with in-graph preprocessing')
+    parser.add_argument('--model', default=MODEL_PATH, help='trained classifier')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='write the serving model')
+    export_parser.add_argument('--output', default=SERVING_MODEL_PATH)
+
+    parity_parser = subparsers.add_parser('parity', help='compare with preprocess_mri_image')
+    parity_parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    parity_parser.add_argument('--split', default='test')
+    parity_parser.add_argument('--limit', type=int, help='compare at most this many images')
+    parity_parser.add_argument('--resize', type=int, help='re-encode every image at this side length first')
+
+    bench_parser = subparsers.add_parser('bench', help='throughput of both pipelines by batch size')
+    bench_parser.add_argument('--size', type=int, default=512, help='side length of the input images')
+    bench_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    bench_parser.add_argument('--repeat', type=int, default=20)
+    bench_parser.add_argument('--seed', type=int, default=0)
+
+    for subparser in (export_parser, parity_parser, bench_parser):
+        subparser.add_argument('--json', dest='json_path', help='write the report to this file')
+    args = parser.parse_args()
+
+    result = {'export': export, 'parity': parity, 'bench': bench}[args.command](args)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(result, f, indent=2)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == '__main__':
+    main()
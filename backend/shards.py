@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+"""
+Packed shard format for training images
+
+Thousands of small PNG files are dominated by open/stat overhead. A shard packs
+many images into one file that can be read sequentially, with an index at the
+end for random access.
+
+Convert the dataset directories and compare read throughput:
+    python shards.py convert --data-dir data --output data/shards
+    python shards.py bench --data-dir data --shard-dir data/shards
+
+`python train_model.py --shards data/shards` then trains from the shards.
+
+Layout (all integers little-endian):
+
+    record*   uint32 payload length
+              payload: uint8 label, uint8 encoding, uint16 height, uint16 width,
+                       uint8 channels, uint32 crc32(data), data
+    index     uint64 offset of each record
+    footer    uint64 index offset, uint64 record count, 8-byte magic
+
+`encoding` is ENCODING_RAW (uint8 pixels, row-major) or ENCODING_FILE (the
+original encoded PNG/JPEG/... file, decoded on read).
+"""
+
+import argparse
+import glob
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+MAGIC = b'BTSHARD1'
+SHARD_EXTENSION = '.shard'
+ENCODING_RAW = 0
+ENCODING_FILE = 1
+DEFAULT_IMAGES_PER_SHARD = 1024
+
+_LENGTH = struct.Struct('<I')
+_RECORD_HEADER = struct.Struct('<BBHHBI')
+_FOOTER = struct.Struct('<QQ8s')
+
+
+class ShardWriter:
+    """Append images to a shard; the file only appears once close() succeeds"""
+
+    def __init__(self, path):
+        self.path = path
+        self._temp_path = path + '.tmp'
+        self._file = open(self._temp_path, 'wb')
+        self._offsets = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._temp_path)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def write(self, image, label):
+        """Store a uint8 image of shape (H, W) or (H, W, C) as raw pixels"""
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        height, width = image.shape[:2]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        self._append(label, ENCODING_RAW, height, width, channels, image.tobytes())
+
+    def write_encoded(self, data, label, height, width, channels=1):
+        """Store an already encoded image file without re-encoding it"""
+        self._append(label, ENCODING_FILE, height, width, channels, bytes(data))
+
+    def _append(self, label, encoding, height, width, channels, data):
+        self._offsets.append(self._file.tell())
+        header = _RECORD_HEADER.pack(label, encoding, height, width, channels, zlib.crc32(data))
+        self._file.write(_LENGTH.pack(len(header) + len(data)))
+        self._file.write(header)
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        index_offset = self._file.tell()
+        self._file.write(np.asarray(self._offsets, dtype='<u8').tobytes())
+        self._file.write(_FOOTER.pack(index_offset, len(self._offsets), MAGIC))
+        self._file.close()
+        os.replace(self._temp_path, self.path)
+
+
+def decode_record(payload, flags=cv2.IMREAD_UNCHANGED):
+    """Turn a record payload into (uint8 image, label); `flags` apply to encoded files"""
+    label, encoding, height, width, channels, crc = _RECORD_HEADER.unpack_from(payload)
+    data = memoryview(payload)[_RECORD_HEADER.size:]
+    if zlib.crc32(data) != crc:
+        raise ValueError('Shard record failed its checksum')
+    if encoding == ENCODING_RAW:
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        image = np.frombuffer(data, dtype=np.uint8).reshape(shape)
+    elif encoding == ENCODING_FILE:
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+        if image is None:
+            raise ValueError('Shard record could not be decoded')
+    else:
+        raise ValueError(f'Unknown shard record encoding {encoding}')
+    return image, label
+
+
+def record_size(payload):
+    """(width, height) of a record's image, from its header without decoding it"""
+    _, _, height, width, _, _ = _RECORD_HEADER.unpack_from(payload)
+    return width, height
+
+
+class ShardReader:
+    """Random and sequential access to the records of one shard"""
+
+    def __init__(self, path, flags=cv2.IMREAD_UNCHANGED):
+        self.path = path
+        self.flags = flags
+        self._file = open(path, 'rb')
+        self._file.seek(-_FOOTER.size, os.SEEK_END)
+        index_offset, count, magic = _FOOTER.unpack(self._file.read(_FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not a shard file')
+        self._file.seek(index_offset)
+        self._offsets = np.frombuffer(self._file.read(count * 8), dtype='<u8')
+        self._index_offset = index_offset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def _read_payload(self):
+        (length,) = _LENGTH.unpack(self._file.read(_LENGTH.size))
+        return self._file.read(length)
+
+    def __getitem__(self, i):
+        self._file.seek(int(self._offsets[i]))
+        return decode_record(self._read_payload(), self.flags)
+
+    def payloads(self):
+        """Sequential scan of the undecoded record payloads"""
+        self._file.seek(0)
+        for _ in range(len(self._offsets)):
+            yield self._read_payload()
+
+    def __iter__(self):
+        """Sequential scan; one seek, then buffered reads"""
+        for payload in self.payloads():
+            yield decode_record(payload, self.flags)
+
+    def close(self):
+        self._file.close()
+
+
+def shard_paths(shard_dir, prefix):
+    """Shards named `<prefix>-NNNNN.shard` in a directory, in order"""
+    return sorted(glob.glob(os.path.join(shard_dir, f'{prefix}-*{SHARD_EXTENSION}')))
+
+
+def _read_shard(path, map_fn, flags, block_length, out, stop):
+    """Interleave worker: read one shard sequentially into its queue in blocks"""
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    try:
+        block = []
+        with ShardReader(path, flags) as reader:
+            for image, label in reader:
+                block.append(map_fn(image, label) if map_fn else (image, label))
+                if len(block) == block_length:
+                    if not put(block):
+                        return
+                    block = []
+        if block:
+            put(block)
+        put(None)
+    except Exception as e:
+        put(e)
+
+
+def interleave(paths, map_fn=None, cycle_length=4, block_length=16, buffer_blocks=8,
+               flags=cv2.IMREAD_UNCHANGED):
+    """
+    Stream the records of several shards with parallel interleave.
+
+    Up to `cycle_length` shards are read at once, each sequentially by its own
+    worker thread, which also runs `map_fn(image, label)` (decode and
+    preprocessing release the GIL). Records are yielded round-robin,
+    `block_length` at a time from each open shard in order, so the output order
+    is deterministic for a given set of shards and parameters.
+    """
+    paths = list(paths)
+    if not paths:
+        return
+    cycle_length = max(1, min(cycle_length, len(paths)))
+    queues = [queue.Queue(maxsize=buffer_blocks) for _ in paths]
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=cycle_length, thread_name_prefix='shard-reader')
+    try:
+        # Workers pick up shards in order, matching the order they enter the cycle
+        for i, path in enumerate(paths):
+            pool.submit(_read_shard, path, map_fn, flags, block_length, queues[i], stop)
+
+        active = list(range(cycle_length))
+        next_shard = cycle_length
+        slot = 0
+        while active:
+            current = active[slot]
+            block = queues[current].get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                if next_shard < len(paths):
+                    active[slot] = next_shard
+                    next_shard += 1
+                else:
+                    del active[slot]
+                    if not active:
+                        break
+                    slot %= len(active)
+                continue
+            yield from block
+            slot = (slot + 1) % len(active)
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def convert_directory(data_dir, output_dir, split, images_per_shard=DEFAULT_IMAGES_PER_SHARD,
+                      encoding='file', seed=0, workers=4):
+    """
+    Pack one split of the `data/<split>/<label>/` layout into shards named
+    `<split>-NNNNN.shard`. Images are shuffled (deterministically) so every
+    shard holds a mix of both labels. With encoding='file' the original bytes
+    are stored; 'raw' stores decoded grayscale pixels, trading disk space for
+    not having to decode during training. Returns (images written, shards).
+    """
+    from catalog import list_images
+    from upload_stream import read_image_header
+
+    entries = list_images(data_dir, split)
+    random.Random(seed).shuffle(entries)
+    os.makedirs(output_dir, exist_ok=True)
+    for stale in shard_paths(output_dir, split):
+        os.remove(stale)
+    chunks = [entries[i:i + images_per_shard] for i in range(0, len(entries), images_per_shard)]
+
+    def write_shard(task):
+        index, chunk = task
+        written = 0
+        with ShardWriter(os.path.join(output_dir, f'{split}-{index:05d}{SHARD_EXTENSION}')) as writer:
+            for path, label_name in chunk:
+                label = 1 if label_name == 'tumor' else 0
+                try:
+                    if encoding == 'raw':
+                        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+                        if image is None:
+                            raise ValueError('could not be decoded')
+                        writer.write(image, label)
+                    else:
+                        header = read_image_header(path)
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                        writer.write_encoded(data, label, header['height'] or 0, header['width'] or 0)
+                    written += 1
+                except (OSError, ValueError) as e:
+                    print(f"Skipping {path}: {e}")
+        return written
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        written = sum(pool.map(write_shard, enumerate(chunks)))
+    return written, len(chunks)
+
+
+def benchmark(data_dir, shard_dir, split, cycle_length, workers):
+    """
+    Images/second for one split from loose files and from shards: reading the
+    bytes only (the storage layout) and reading plus decoding (training input)
+    """
+    from catalog import list_images
+
+    def run(name, fn):
+        start = time.perf_counter()
+        count = fn()
+        seconds = time.perf_counter() - start
+        print(f"  {name:<32} {count:>8,} images  {seconds:7.2f}s  {count / seconds:10,.0f} images/s")
+
+    def read_bytes(path):
+        with open(path, 'rb') as f:
+            return len(f.read()) > 0
+
+    def read_image(path):
+        return cv2.imread(path, cv2.IMREAD_GRAYSCALE) is not None
+
+    def scan_shards(decode):
+        count = 0
+        for path in shards:
+            with ShardReader(path, cv2.IMREAD_GRAYSCALE) as reader:
+                count += sum(1 for _ in (reader if decode else reader.payloads()))
+        return count
+
+    paths = [path for path, _ in list_images(data_dir, split)]
+    shards = shard_paths(shard_dir, split)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for title, read_file, decode in (('Read bytes', read_bytes, False),
+                                         ('Read + decode', read_image, True)):
+            print(f"{title}, split '{split}':")
+            run('loose files, sequential', lambda: sum(read_file(p) for p in paths))
+            run(f'loose files, {workers} threads', lambda: sum(pool.map(read_file, paths, chunksize=64)))
+            run('shards, sequential', lambda: scan_shards(decode))
+            if decode:
+                run(f'shards, interleave x{cycle_length}',
+                    lambda: sum(1 for _ in interleave(shards, cycle_length=cycle_length,
+                                                      flags=cv2.IMREAD_GRAYSCALE)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Packed training data shards')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help='pack data/<split>/<label>/ into shards')
+    convert.add_argument('--data-dir', default='data', help='dataset root directory')
+    convert.add_argument('--output', default=os.path.join('data', 'shards'), help='shard directory')
+    convert.add_argument('--splits', nargs='+', default=['train', 'test'])
+    convert.add_argument('--images-per-shard', type=int, default=DEFAULT_IMAGES_PER_SHARD)
+    convert.add_argument('--encoding', choices=['file', 'raw'], default='file',
+                         help='store the original encoded files or decoded grayscale pixels')
+    convert.add_argument('--seed', type=int, default=0, help='shuffle seed')
+
+    bench = subparsers.add_parser('bench', help='compare read throughput of loose files and shards')
+    bench.add_argument('--data-dir', default='data', help='dataset root directory')
+    bench.add_argument('--shard-dir', default=os.path.join('data', 'shards'))
+    bench.add_argument('--split', default='train')
+    bench.add_argument('--cycle-length', type=int, default=4, help='shards read in parallel')
+    bench.add_argument('--workers', type=int, default=4, help='threads for the loose-file reader')
+
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        benchmark(args.data_dir, args.shard_dir, args.split, args.cycle_length, args.workers)
+        return
+
+    for split in args.splits:
+        start = time.perf_counter()
+        written, shards = convert_directory(args.data_dir, args.output, split,
+                                            args.images_per_shard, args.encoding, args.seed)
+        seconds = time.perf_counter() - start
+        print(f"{split}: packed {written:,} images into {shards} shards in {seconds:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Raw tensor wire format for POST /predict/tensor
+
+Internal services (PACS bridges, bulk scorers) already hold decoded pixel
+arrays. Encoding them as PNG only for the backend to decode them again costs
+more CPU than the model itself, so /predict/tensor accepts the pixels as they
+are, many images per request:
+
+    header   4s  magic b'MRT1'
+             I   number of images
+    image    H   height
+             H   width
+             B   channels (1 = grayscale, 3 = BGR)
+             x   padding
+             height * width * channels bytes of uint8 pixels, row-major
+
+All integers are little-endian. Every image carries its own shape, so one
+request may mix sizes; the byte count of each image follows from its shape,
+which is how the body is split without delimiters. Images are parsed as
+read-only views into the request body (no copies).
+
+`encode_tensors(images)` builds a body from a list of uint8 arrays;
+`decode_tensors(body)` is its inverse and raises TensorFormatError for
+anything malformed.
+"""
+
+import struct
+
+import numpy as np
+
+MAGIC = b'MRT1'
+HEADER = struct.Struct('<4sI')
+IMAGE_HEADER = struct.Struct('<HHBx')
+CHANNELS = (1, 3)
+CONTENT_TYPE = 'application/x-mri-tensor'
+
+
+class TensorFormatError(ValueError):
+    """The request body is not a valid tensor batch"""
+
+
+def encode_tensors(images):
+    """Request body for a list of uint8 (H, W) or (H, W, channels) arrays"""
+    parts = [HEADER.pack(MAGIC, len(images))]
+    for image in images:
+        image = np.asarray(image)
+        if image.dtype != np.uint8:
+            raise TensorFormatError(f"images must be uint8, got {image.dtype}")
+        channels = 1 if image.ndim == 2 else image.shape[2] if image.ndim == 3 else 0
+        if channels not in CHANNELS:
+            raise TensorFormatError(f"unsupported image shape {image.shape}")
+        parts.append(IMAGE_HEADER.pack(image.shape[0], image.shape[1], channels))
+        parts.append(np.ascontiguousarray(image).tobytes())
+    return b''.join(parts)
+
+
+def decode_tensors(body, max_images=None, max_dimension=None):
+    """
+    uint8 arrays from a request body: (H, W) for grayscale images, (H, W, 3)
+    for BGR ones. `max_images` and `max_dimension` reject oversized batches
+    before any pixels are looked at.
+    """
+    view = memoryview(body)
+    if len(view) < HEADER.size:
+        raise TensorFormatError('body is shorter than the tensor header')
+    magic, count = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise TensorFormatError(f"bad magic {bytes(magic)!r}, expected {MAGIC!r}")
+    if count == 0:
+        raise TensorFormatError('no images in the request')
+    if max_images is not None and count > max_images:
+        raise TensorFormatError(f"{count} images in one request; the limit is {max_images}")
+
+    images = []
+    offset = HEADER.size
+    for index in range(count):
+        if offset + IMAGE_HEADER.size > len(view):
+            raise TensorFormatError(f"image {index}: body ends inside its header")
+        height, width, channels = IMAGE_HEADER.unpack_from(view, offset)
+        offset += IMAGE_HEADER.size
+        if channels not in CHANNELS:
+            raise TensorFormatError(f"image {index}: {channels} channels; expected 1 or 3")
+        if not height or not width:
+            raise TensorFormatError(f"image {index}: empty image {height}x{width}")
+        if max_dimension is not None and max(height, width) > max_dimension:
+            raise TensorFormatError(f"image {index}: {width}x{height} exceeds {max_dimension} pixels")
+        length = height * width * channels
+        if offset + length > len(view):
+            raise TensorFormatError(f"image {index}: expected {length} bytes, body has {len(view) - offset}")
+        shape = (height, width) if channels == 1 else (height, width, channels)
+        images.append(np.frombuffer(view, dtype=np.uint8, count=length, offset=offset).reshape(shape))
+        offset += length
+    if offset != len(view):
+        raise TensorFormatError(f"{len(view) - offset} trailing bytes after the last image")
+    return images
@@ -0,0 +1,96 @@
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from admission import (AdmissionController, AdmissionRejected, TokenBucket, request_client_id,
+                       trusted_proxies)
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_token_bucket_burst_and_refill():
+    bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == pytest.approx(0.5)
+    assert bucket.take(0.5) == 0.0
+    assert bucket.take(100.0) == 0.0
+    assert bucket.tokens == 2  # capped at the burst
+
+
+def test_rate_limit_rejects_with_retry_after():
+    controller = AdmissionController(client_rate=1.0, client_burst=2)
+    for _ in range(2):
+        controller.acquire('a')
+        controller.release()
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire('a')
+    assert rejected.value.status == 429 and rejected.value.retry_after >= 1
+    controller.acquire('b')  # other clients have their own bucket
+    assert controller.stats()['shed']['rate_limited'] == 1
+
+
+def test_tracked_clients_are_capped():
+    controller = AdmissionController(client_rate=0.001, client_burst=10, max_clients=3)
+    for client in range(10):
+        controller.acquire(f'client-{client}')
+        controller.release()
+    assert controller.stats()['tracked_clients'] == 3
+    assert list(controller._buckets) == ['client-7', 'client-8', 'client-9']
+
+
+def test_full_queue_rejects_and_urgent_preempts_routine():
+    controller = AdmissionController(max_in_flight=1, max_queue=1, max_wait=5.0, client_rate=0)
+    controller.acquire('holder')
+    outcome = {}
+
+    def wait(name, priority):
+        try:
+            controller.acquire(name, priority)
+            outcome[name] = 'admitted'
+            controller.release()
+        except AdmissionRejected as e:
+            outcome[name] = e.reason
+
+    routine = threading.Thread(target=wait, args=('routine', 'routine'))
+    routine.start()
+    wait_until(lambda: controller.stats()['queue_depth'] >= 1)
+    with pytest.raises(AdmissionRejected, match='queue is full'):
+        controller.acquire('late', 'routine')
+
+    urgent = threading.Thread(target=wait, args=('urgent', 'urgent'))
+    urgent.start()
+    routine.join(5)
+    controller.release()
+    urgent.join(5)
+
+    assert outcome == {'routine': 'Server busy, preempted by an urgent request', 'urgent': 'admitted'}
+    stats = controller.stats()
+    assert stats['shed']['queue_full'] == 1 and stats['shed']['preempted'] == 1
+    assert stats['in_flight'] == 0 and stats['queue_depth'] == 0
+
+
+def test_unreachable_deadline_is_rejected_up_front():
+    controller = AdmissionController(max_in_flight=1, client_rate=0)
+    controller.acquire('holder')
+    with pytest.raises(AdmissionRejected, match='before its deadline'):
+        controller.acquire('impatient', deadline=0.1)
+    controller.release()
+
+
+def test_client_id_header_is_trusted_only_from_proxies():
+    app = Flask(__name__)
+    app.config['TRUSTED_PROXIES'] = trusted_proxies(['10.0.0.0/8'])
+    headers = {'X-Client-ID': 'clinic-7'}
+    with app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '203.0.113.5'}):
+        assert request_client_id() == '203.0.113.5'
+    with app.test_request_context(headers=headers, environ_base={'REMOTE_ADDR': '10.1.2.3'}):
+        assert request_client_id() == 'clinic-7'
+    with app.test_request_context(environ_base={'REMOTE_ADDR': '10.1.2.3'}):
+        assert request_client_id() == '10.1.2.3'
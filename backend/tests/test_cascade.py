@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from cascade import calibration_threshold, load_pipeline
+
+STATISTICS = {'name': 'statistics', 'type': 'statistics', 'low': 0.05, 'high': 0.95,
+              'scorer': {'mean': [0.0] * 7, 'scale': [1.0] * 7, 'weights': [0.0] * 7, 'bias': 0.0}}
+
+
+def no_models(path):
+    raise AssertionError(f'unexpected model load: {path}')
+
+
+def test_calibration_threshold_of_stages_and_student():
+    assert calibration_threshold({'cascade': {'threshold': 0.3, 'stages': [STATISTICS]}}) == 0.3
+    assert calibration_threshold({'student': {'threshold': 0.4, 'cascade': {}}}) == 0.4
+    assert calibration_threshold({}) is None
+
+
+def test_pipeline_loads_at_its_calibration_threshold():
+    info = {'cascade': {'threshold': 0.311, 'stages': [STATISTICS]}}
+    pipeline = load_pipeline(info, 'model', no_models, threshold=0.311)
+    assert [stage.name for stage in pipeline.stages] == ['statistics']
+    assert load_pipeline(info, 'model', no_models) is not None
+
+
+@pytest.mark.parametrize('info', [{'cascade': {'threshold': 0.5, 'stages': [STATISTICS]}},
+                                  {'cascade': {'stages': [STATISTICS]}}])
+def test_pipeline_is_refused_at_another_threshold(info):
+    with pytest.raises(ValueError, match='calibrate'):
+        load_pipeline(info, 'model', no_models, threshold=0.311)
+
+
+def test_no_stages_needs_no_calibration():
+    assert load_pipeline({}, 'model', no_models, threshold=np.float64(0.311)) is None
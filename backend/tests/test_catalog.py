@@ -0,0 +1,84 @@
+import os
+
+import pytest
+from PIL import Image
+
+from catalog import DatasetCatalog, list_images, sync_catalog
+
+
+def write_image(data_dir, split, label, name, size=(16, 16)):
+    directory = os.path.join(data_dir, split, label)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name)
+    Image.new('L', size).save(path)
+    return path
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    write_image(tmp_path, 'train', 'tumor', 'a.png')
+    write_image(tmp_path, 'train', 'no_tumor', 'b.png')
+    write_image(tmp_path, 'test', 'tumor', 'c.png')
+    return str(tmp_path)
+
+
+def open_catalog(data_dir):
+    return DatasetCatalog(os.path.join(data_dir, 'catalog.db'), data_dir=data_dir)
+
+
+def test_new_catalog_indexes_the_directories(data_dir):
+    catalog = open_catalog(data_dir)
+    counts = catalog.counts()
+    assert counts['tumor_train'] == 1 and counts['no_tumor_train'] == 1 and counts['tumor_test'] == 1
+    assert counts['no_tumor_test'] == 0
+    record, = catalog.records('test')
+    assert (record['path'], record['width'], record['format']) == ('test/tumor/c.png', 16, 'png')
+    catalog.close()
+
+
+def test_triggers_keep_counts_in_step(data_dir):
+    catalog = open_catalog(data_dir)
+    path = write_image(data_dir, 'train', 'tumor', 'd.png')
+    catalog.add_file(path, 'train', 'tumor')
+    assert catalog.counts()['tumor_train'] == 2
+    catalog.add_file(path, 'train', 'no_tumor')  # relabelled: replaces the old entry
+    assert catalog.counts()['tumor_train'] == 1
+    assert catalog.counts()['no_tumor_train'] == 2
+    catalog.remove(path)
+    assert catalog.counts()['no_tumor_train'] == 1
+    catalog.close()
+
+
+def test_sync_reconciles_with_the_disk(data_dir):
+    catalog = open_catalog(data_dir)
+    write_image(data_dir, 'test', 'no_tumor', 'e.png')
+    os.remove(os.path.join(data_dir, 'train', 'tumor', 'a.png'))
+    assert catalog.sync() == (1, 1)
+    assert catalog.sync() == (0, 0)
+    assert catalog.counts()['tumor_train'] == 0
+    assert catalog.has_hash(catalog.records('test')[-1]['sha256'])
+    catalog.close()
+
+
+def test_list_images_reads_the_catalog_until_synced(data_dir):
+    open_catalog(data_dir).close()
+    added = write_image(data_dir, 'train', 'tumor', 'late.png')
+    assert len(list_images(data_dir, 'train')) == 2
+    assert sync_catalog(data_dir) == (1, 0)
+    images = list_images(data_dir, 'train')
+    assert (added, 'tumor') in images
+    assert len(images) == 3
+
+
+def test_list_images_lists_a_split_missing_from_the_catalog(data_dir):
+    catalog = open_catalog(data_dir)
+    for path, _ in catalog.images('test'):
+        catalog.remove(path)
+    catalog.close()
+    assert list_images(data_dir, 'test') == [(os.path.join(data_dir, 'test', 'tumor', 'c.png'), 'tumor')]
+
+
+def test_list_images_without_a_catalog(tmp_path):
+    path = write_image(tmp_path, 'train', 'tumor', 'a.png')
+    assert list_images(str(tmp_path), 'train') == [(path, 'tumor')]
+    assert not os.path.exists(os.path.join(tmp_path, 'catalog.db'))
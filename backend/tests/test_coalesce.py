@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from coalesce import IdempotencyConflict, RequestCoalescer
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def test_concurrent_identical_requests_compute_once():
+    coalescer = RequestCoalescer()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(coalescer.execute('k', compute)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(coalescer.execute('k', compute)))
+                 for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    wait_until(lambda: coalescer.stats()['coalesced'] >= 3)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert sorted(how for _, how in results) == ['coalesced'] * 3 + ['computed']
+    assert all(result == 'result' for result, _ in results)
+    assert coalescer.stats()['in_flight'] == 0
+
+
+def test_nothing_is_cached_after_the_flight_lands():
+    coalescer = RequestCoalescer()
+    assert coalescer.execute('k', lambda: 1) == (1, 'computed')
+    assert coalescer.execute('k', lambda: 2) == (2, 'computed')
+
+
+def test_idempotency_key_replays_and_detects_conflicts():
+    coalescer = RequestCoalescer()
+    assert coalescer.execute('k', lambda: 1, 'id') == (1, 'computed')
+    assert coalescer.execute('k', lambda: 2, 'id') == (1, 'replayed')
+    with pytest.raises(IdempotencyConflict):
+        coalescer.execute('other', lambda: 3, 'id')
+    stats = coalescer.stats()
+    assert stats['replayed'] == 1 and stats['conflicts'] == 1
+
+
+def test_failures_are_not_stored():
+    coalescer = RequestCoalescer()
+
+    def fail():
+        raise RuntimeError('boom')
+
+    with pytest.raises(RuntimeError):
+        coalescer.execute('k', fail, 'id')
+    assert coalescer.execute('k', lambda: 1, 'id') == (1, 'computed')
+    assert coalescer.stats()['errors'] == 1
+
+
+def test_idempotency_keys_expire():
+    coalescer = RequestCoalescer(idempotency_ttl=0)
+    coalescer.execute('k', lambda: 1, 'id')
+    assert coalescer.execute('k', lambda: 2, 'id') == (2, 'computed')
+
+
+def test_disabled_still_replays_idempotent_retries():
+    coalescer = RequestCoalescer(enabled=False)
+    assert coalescer.execute('k', lambda: 1, 'id') == (1, 'computed')
+    assert coalescer.execute('k', lambda: 2, 'id') == (1, 'replayed')
+    assert coalescer.execute('k', lambda: 3) == (3, 'computed')
+    assert coalescer.stats()['in_flight'] == 0
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from drift import FEATURES, DriftMonitor, bin_counts, build_baseline, histogram_quantiles, psi
+
+
+def test_psi_of_identical_histograms_is_zero():
+    counts = np.array([10, 20, 30, 40])
+    assert psi(counts, counts * 3) == pytest.approx(0.0)
+
+
+def test_psi_grows_with_the_shift_and_tolerates_empty_bins():
+    expected = np.array([25, 25, 25, 25])
+    small = psi(expected, np.array([30, 25, 25, 20]))
+    large = psi(expected, np.array([0, 0, 0, 100]))
+    assert 0 < small < 0.1 < large
+    assert np.isfinite(large)
+
+
+def test_bin_counts_clips_out_of_range_values():
+    edges = np.array([0.0, 1.0, 2.0, 3.0])
+    np.testing.assert_array_equal(bin_counts([-5, 0.5, 1.0, 2.5, 99], edges), [2, 1, 2])
+    np.testing.assert_array_equal(bin_counts(1.5, edges), [0, 1, 0])
+
+
+def test_histogram_quantiles_interpolate_within_bins():
+    edges = np.array([0.0, 10.0, 20.0])
+    quantiles = histogram_quantiles(np.array([50, 50]), edges, quantiles=(0.25, 0.5, 0.75))
+    assert quantiles == {'p25': 5.0, 'p50': 10.0, 'p75': 15.0}
+    assert histogram_quantiles(np.array([0, 0]), edges) is None
+
+
+def test_size_quantiles_are_reported_as_bins():
+    edges = FEATURES['image_width']
+    counts = bin_counts([256] * 10 + [10000], edges)
+    quantiles = histogram_quantiles(counts, edges, quantiles=(0.5, 0.99), interpolate=False)
+    assert quantiles == {'p50': [256.0, 384.0], 'p99': [8192.0, None]}
+
+
+def test_monitor_reports_stable_and_shifted_inputs():
+    rng = np.random.default_rng(0)
+    dark = rng.integers(0, 100, size=(200, 16, 16), dtype=np.uint8)
+    baseline = build_baseline(dark, rng.uniform(0, 0.3, 200), [(256, 256)] * 200)
+
+    same = DriftMonitor(baseline, min_samples=100)
+    same.observe(rng.integers(0, 100, size=(200, 16, 16), dtype=np.uint8))
+    assert same.report()['features']['pixel_intensity']['status'] == 'stable'
+
+    shifted = DriftMonitor(baseline, min_samples=100)
+    shifted.observe(rng.integers(150, 256, size=(200, 16, 16), dtype=np.uint8), sizes=[(512, 512)] * 200)
+    report = shifted.report('lifetime')
+    assert report['status'] == 'significant'
+    assert report['features']['image_width']['quantiles']['p50'] == [512.0, 768.0]
+    assert report['features']['prediction_score']['status'] == 'insufficient_data'
+
+
+def test_monitor_without_baseline_and_bad_scope():
+    monitor = DriftMonitor()
+    monitor.observe(scores=[0.2, 0.9])
+    report = monitor.report()
+    assert report['status'] == 'no_baseline'
+    assert report['features']['prediction_score']['images'] == 2
+    with pytest.raises(ValueError):
+        monitor.report('yesterday')
+
+
+def test_baseline_with_wrong_bins_is_refused():
+    baseline = DriftMonitor().to_baseline()
+    baseline['features']['mean_intensity']['counts'] = [1, 2, 3]
+    with pytest.raises(ValueError):
+        DriftMonitor(baseline)
@@ -0,0 +1,86 @@
+import io
+import os
+import time
+import zipfile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from catalog import DatasetCatalog
+from dedup_index import NearDuplicateIndex
+from ingest import IngestManager, iter_archive
+
+
+def png(seed, size=(64, 64)):
+    pixels = np.random.default_rng(seed).integers(0, 256, size=size, dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def write_zip(path, members):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return str(path)
+
+
+@pytest.fixture
+def manager(tmp_path):
+    data_dir = str(tmp_path / 'data')
+    catalog = DatasetCatalog(os.path.join(data_dir, 'catalog.db'), data_dir=data_dir)
+    yield IngestManager(catalog, data_dir=data_dir, staging_dir=str(tmp_path / 'staging'),
+                        near_duplicate_distance=16, max_file_size=1024 * 1024)
+    catalog.close()
+
+
+def finish(job):
+    deadline = time.monotonic() + 30
+    while job.status in ('queued', 'running'):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return job.to_dict()
+
+
+def test_same_named_members_are_all_kept(manager, tmp_path):
+    archive = write_zip(tmp_path / 'batch.zip', {f'patient{p}/slice1.png': png(i) for i, p in enumerate('ABCD')})
+    result = finish(manager.submit('tumor', 'train', archives=[archive]))
+    assert result['accepted'] == 4, result['errors']
+    stored = os.listdir(os.path.join(manager.data_dir, 'train', 'tumor'))
+    assert len(stored) == 4 and 'slice1.png' in stored
+    assert manager.catalog.counts()['tumor_train'] == 4
+
+
+def test_duplicates_and_oversized_members_are_rejected(manager, tmp_path):
+    bomb = b'BM' + bytes(2 * 1024 * 1024)
+    archive = write_zip(tmp_path / 'batch.zip', {'a.png': png(0), 'copy/a.png': png(0), 'big.bmp': bomb})
+    result = finish(manager.submit('tumor', 'train', archives=[archive]))
+    assert (result['accepted'], result['duplicates'], result['rejected']) == (1, 1, 1)
+    assert 'big.bmp' in result['errors'][0]
+
+
+def test_iter_archive_rejects_high_compression_ratios(tmp_path):
+    archive = write_zip(tmp_path / 'batch.zip', {'flat.bmp': b'BM' + bytes(512 * 1024), 'ok.png': png(0)})
+    members = {name: (data, error) for name, data, error in iter_archive(archive)}
+    assert members['flat.bmp'][0] is None and 'compressed' in members['flat.bmp'][1]
+    assert members['ok.png'][1] is None
+
+
+def test_near_duplicate_index_remove():
+    index = NearDuplicateIndex(4)
+    index.add('a', 0b1011)
+    index.add('b', 0b1011 << 100)
+    index.remove('a', 0b1011)
+    assert len(index) == 1
+    assert index.query(0b1011) == []
+    assert index.query(0b1011 << 100) == [('b', 0)]
+
+
+def test_single_image_ingest_deduplicates(manager):
+    assert manager.ingest('scan.png', png(0), 'tumor', 'train') == ('accepted', None)
+    assert manager.ingest('scan.png', png(0), 'tumor', 'test')[0] == 'duplicate'
+    assert manager.ingest('scan.png', png(1), 'tumor', 'train') == ('accepted', None)
+    outcome, message = manager.ingest('scan.dcm.png', bytes(128) + b'DICM' + bytes(64), 'tumor', 'train')
+    assert outcome == 'rejected' and 'dicom' in message
+    assert len(os.listdir(os.path.join(manager.data_dir, 'train', 'tumor'))) == 2
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from generate_sample_data import create_synthetic_mri_image  # noqa: E402
+from preprocessing import preprocess_gray  # noqa: E402
+from serving_model import build_preprocessing  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def graph():
+    model = build_preprocessing((128, 128))
+    return lambda gray: model(gray[np.newaxis, ..., np.newaxis]).numpy()[0, ..., 0].astype(np.uint8)
+
+
+# 256 is an exact 2x downscale, where half-level averages are common
+@pytest.mark.parametrize('side', [256, 300, 384, 100])
+def test_graph_preprocessing_matches_opencv(graph, side):
+    np.random.seed(side)
+    gray = create_synthetic_mri_image(has_tumor=True, size=(side, side))
+    np.testing.assert_array_equal(graph(gray), preprocess_gray(gray, (128, 128)))
+
+
+def test_exact_downscale_rounds_halves_up(graph):
+    # Every 2x2 block averages to 100.5, which OpenCV rounds to 101
+    gray = np.tile(np.array([[100, 101], [101, 100]], dtype=np.uint8), (128, 128))
+    no_filters = build_preprocessing((128, 128), blur_kernel=0, clahe_clip_limit=None)
+    resized = no_filters(gray[np.newaxis, ..., np.newaxis]).numpy()[0, ..., 0]
+    assert np.all(resized == 101)
+    np.testing.assert_array_equal(graph(gray), preprocess_gray(gray, (128, 128)))
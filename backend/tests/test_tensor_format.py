@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from tensor_format import HEADER, IMAGE_HEADER, MAGIC, TensorFormatError, decode_tensors, encode_tensors
+
+
+def test_round_trip_mixed_shapes():
+    grey = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    colour = np.arange(2 * 5 * 3, dtype=np.uint8).reshape(2, 5, 3)
+    decoded = decode_tensors(encode_tensors([grey, colour]))
+    assert len(decoded) == 2
+    np.testing.assert_array_equal(decoded[0], grey)
+    np.testing.assert_array_equal(decoded[1], colour)
+
+
+def test_decoded_images_are_read_only_views():
+    body = encode_tensors([np.zeros((2, 2), dtype=np.uint8)])
+    image, = decode_tensors(body)
+    assert not image.flags.writeable
+
+
+@pytest.mark.parametrize('image', [np.zeros((2, 2), dtype=np.float32),
+                                   np.zeros((2, 2, 2), dtype=np.uint8),
+                                   np.zeros(4, dtype=np.uint8)])
+def test_encode_rejects_unsupported_images(image):
+    with pytest.raises(TensorFormatError):
+        encode_tensors([image])
+
+
+def test_malformed_bodies():
+    body = encode_tensors([np.zeros((4, 4), dtype=np.uint8)])
+    cases = [
+        b'',
+        b'XXXX' + body[4:],
+        HEADER.pack(MAGIC, 0),
+        body[:HEADER.size + 2],
+        body[:-1],
+        body + b'\x00',
+        HEADER.pack(MAGIC, 1) + IMAGE_HEADER.pack(4, 4, 2) + bytes(32),
+        HEADER.pack(MAGIC, 1) + IMAGE_HEADER.pack(0, 4, 1)
+    ]
+    for case in cases:
+        with pytest.raises(TensorFormatError):
+            decode_tensors(case)
+
+
+def test_limits_are_checked():
+    body = encode_tensors([np.zeros((4, 8), dtype=np.uint8)] * 3)
+    with pytest.raises(TensorFormatError, match='limit is 2'):
+        decode_tensors(body, max_images=2)
+    with pytest.raises(TensorFormatError, match='exceeds 6'):
+        decode_tensors(body, max_dimension=6)
+    assert len(decode_tensors(body, max_images=3, max_dimension=8)) == 3
@@ -0,0 +1,53 @@
+import time
+
+import numpy as np
+
+import tta as augmentation
+from tta import MAX_VARIANTS, augment_batch
+
+
+class SlowModel:
+    """Stand-in for a Keras model: a fixed cost per call plus one per image"""
+
+    input_shape = (None, 32, 32, 1)
+
+    def __init__(self, per_call=0.002, per_image=0.002):
+        self.per_call = per_call
+        self.per_image = per_image
+
+    def predict(self, batch, verbose=0):
+        time.sleep(self.per_call + self.per_image * len(batch))
+        return np.full((len(batch), 1), 0.25, dtype=np.float32)
+
+
+def test_augment_batch_starts_with_the_identity():
+    tensor = np.arange(32 * 32, dtype=np.uint8).reshape(1, 32, 32, 1)
+    batch, names = augment_batch(tensor, 2)
+    assert names == ['identity', 'hflip']
+    np.testing.assert_array_equal(batch[0], tensor[0])
+    np.testing.assert_array_equal(batch[1, :, :, 0], tensor[0, :, ::-1, 0])
+
+
+def test_variant_count_without_a_budget():
+    tta = augmentation.TestTimeAugmenter(default_variants=4)
+    assert tta.variant_count() == 4
+    assert tta.variant_count(100) == MAX_VARIANTS
+    assert tta.variant_count(0) == 1
+    assert tta.stats()['limited_by_overhead_budget'] == 0
+
+
+def test_budget_is_enforced_before_and_after_warm_up():
+    tta = augmentation.TestTimeAugmenter(max_overhead_ms=7.0)
+    assert tta.variant_count(8) == 1  # nothing measured yet
+    tta.warm_up(SlowModel())
+    stats = tta.stats()
+    assert stats['plain_predictions'] == 0 and stats['tta_predictions'] == 0
+    assert 1 < tta.variant_count(8) < 8
+    assert tta.stats()['limited_by_overhead_budget'] == 2
+
+
+def test_predict_reports_variant_statistics():
+    tta = augmentation.TestTimeAugmenter()
+    result = tta.predict(SlowModel(0, 0), np.zeros((1, 32, 32, 1), dtype=np.uint8), 3)
+    assert result['variants'] == ['identity', 'hflip', 'rot+10']
+    assert result['mean'] == 0.25 and result['variance'] == 0.0
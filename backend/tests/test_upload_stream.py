@@ -0,0 +1,58 @@
+import io
+import struct
+
+import pytest
+from PIL import Image
+
+from upload_stream import NeedMoreData, check_dimensions, sniff_image_header
+
+
+def encoded(fmt, size=(37, 21), **options):
+    buffer = io.BytesIO()
+    Image.new('L', size).save(buffer, format=fmt, **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('fmt, name', [('PNG', 'png'), ('JPEG', 'jpeg'), ('BMP', 'bmp'), ('TIFF', 'tiff')])
+def test_dimensions_from_the_header(fmt, name):
+    assert sniff_image_header(encoded(fmt)) == {'format': name, 'width': 37, 'height': 21}
+
+
+def test_big_endian_tiff():
+    data = b'MM\x00*' + struct.pack('>IH', 8, 2) + struct.pack('>HHII', 256, 4, 1, 640) + \
+        struct.pack('>HHIHH', 257, 3, 1, 480, 0)
+    assert sniff_image_header(data) == {'format': 'tiff', 'width': 640, 'height': 480}
+
+
+def test_jpeg_frame_header_after_a_large_segment():
+    data = encoded('JPEG', exif=b'Exif\x00\x00' + bytes(30000))
+    assert sniff_image_header(data)['width'] == 37
+
+
+def test_dicom_has_no_dimensions():
+    data = bytes(128) + b'DICM' + bytes(16)
+    assert sniff_image_header(data) == {'format': 'dicom', 'width': None, 'height': None}
+
+
+@pytest.mark.parametrize('fmt', ['PNG', 'JPEG', 'BMP', 'TIFF'])
+def test_truncated_headers_need_more_data(fmt):
+    with pytest.raises(NeedMoreData):
+        sniff_image_header(encoded(fmt)[:10])
+
+
+def test_unrecognized_and_corrupt_content():
+    with pytest.raises(ValueError):
+        sniff_image_header(b'GIF89a' + bytes(200))
+    png = encoded('PNG')
+    with pytest.raises(ValueError, match='IHDR'):
+        sniff_image_header(png[:12] + b'XXXX' + png[16:])
+    with pytest.raises(ValueError, match='marker'):
+        sniff_image_header(b'\xff\xd8\x00\x00\x00\x00')
+
+
+def test_check_dimensions():
+    assert check_dimensions({'width': 256, 'height': 256}, min_dim=64, max_dim=4096) is None
+    assert 'too small' in check_dimensions({'width': 32, 'height': 256}, min_dim=64)
+    assert 'too large' in check_dimensions({'width': 256, 'height': 9000}, max_dim=4096)
+    assert 'zero' in check_dimensions({'width': 0, 'height': 10})
+    assert check_dimensions({'width': None, 'height': None}, min_dim=64) is None
@@ -11,28 +11,104 @@ data/
 └── test/
     ├── no_tumor/     # Test images without tumors
     └── tumor/        # Test images with tumors
+
+With --distill, a compact student network is trained on the soft predictions
+of an already trained model (the teacher) and exported as
+model/student_model.h5. Its cascade thresholds are written to
+model/model_info.json: the backend lets the student answer images it is
+confident about and escalates the rest to the teacher.
+
+The input resolution is set with --img-size (128 by default; e.g. 96 for a
+faster triage model). It is recorded in model/model_info.json together with
+the blur and CLAHE parameters, and the backend preprocesses uploads to match
+whatever model it loads. A student is trained at its teacher's resolution.
+
+Every saved model also gets a serving artifact (model/<name>.serving, see
+model_artifact.py), which the backend loads faster than the .h5.
+
+Training also records a drift baseline in model/model_info.json: histograms
+of the training images (grey levels, mean intensity, upload dimensions) and of
+the validation scores, which the backend compares its inputs with (drift.py).
 """
 
+import argparse
 import os
 import numpy as np
 import cv2
 import tensorflow as tf
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout, BatchNormalization
+from tensorflow.keras.layers import (Conv2D, MaxPooling2D, Flatten, Dense, Dropout, BatchNormalization,
+                                     GlobalAveragePooling2D, Input, Rescaling, SeparableConv2D)
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.callbacks import EarlyStopping, ReduceLROnPlateau, ModelCheckpoint
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, confusion_matrix
+from sklearn.metrics import (accuracy_score, classification_report, confusion_matrix, log_loss,
+                             precision_score, recall_score)
 import matplotlib.pyplot as plt
 import seaborn as sns
 from PIL import Image
 import json
 
+from cascade import cascade_route, cascade_thresholds
+from catalog import list_images, sync_catalog
+from drift import build_baseline, dataset_sizes
+from model_artifact import artifact_path, save_artifact, weights_version
+from preprocessing import load_preprocessing_options, preprocess_gray, preprocessing_options, preprocessing_section
+from serving_model import PIXEL_SCALE, with_input_scaling
+from shards import interleave, shard_paths
+
+MODEL_PATH = os.path.join('model', 'brain_tumor_model.h5')
+STUDENT_MODEL_PATH = os.path.join('model', 'student_model.h5')
+MODEL_INFO_PATH = os.path.join('model', 'model_info.json')
+DEFAULT_THRESHOLD = 0.5
+
+
+def merge_model_info(path, updates):
+    """Merge `updates` into model_info.json, replacing the file atomically"""
+    info = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            info = json.load(f)
+    info.update(updates)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(info, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def distillation_loss(temperature=4.0, alpha=0.3):
+    """
+    Loss for a sigmoid student trained on y_true = [hard label, teacher probability].
+
+    `alpha` weights the cross-entropy with the hard label; the rest goes to the
+    cross-entropy between teacher and student probabilities softened by
+    `temperature` (logits divided by it), scaled by temperature² so its
+    gradients stay comparable to the hard term.
+    """
+    epsilon = 1e-7
+
+    def logit(p):
+        p = tf.clip_by_value(p, epsilon, 1 - epsilon)
+        return tf.math.log(p) - tf.math.log1p(-p)
+
+    def loss(y_true, y_pred):
+        y_true = tf.cast(y_true, y_pred.dtype)
+        hard, teacher = y_true[:, 0:1], y_true[:, 1:2]
+        hard_loss = tf.keras.losses.binary_crossentropy(hard, y_pred)
+        soft_teacher = tf.sigmoid(logit(teacher) / temperature)
+        soft_loss = tf.nn.sigmoid_cross_entropy_with_logits(labels=soft_teacher,
+                                                            logits=logit(y_pred) / temperature)
+        return alpha * hard_loss + (1 - alpha) * temperature ** 2 * tf.reduce_mean(soft_loss, axis=-1)
+
+    return loss
+
 class BrainTumorDetector:
-    def __init__(self, img_size=(128, 128), batch_size=32):
-        self.img_size = img_size
+    def __init__(self, img_size=(128, 128), batch_size=32, preprocessing=None):
+        self.img_size = tuple(img_size)
         self.batch_size = batch_size
+        # Blur and CLAHE arguments of preprocessing.preprocess_gray (its defaults if empty)
+        self.preprocessing = dict(preprocessing or {})
         self.model = None
         self.history = None
         
@@ -46,72 +122,81 @@ class BrainTumorDetector:
             if image is None:
                 raise ValueError(f"Could not read image: {image_path}")
             
-            # Convert to grayscale
-            if len(image.shape) == 3:
-                gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            else:
-                gray = image
-            
-            # Resize to target size
-            resized = cv2.resize(gray, self.img_size, interpolation=cv2.INTER_AREA)
-            
-            # Apply Gaussian blur for noise removal
-            blurred = cv2.GaussianBlur(resized, (5, 5), 0)
-            
-            # Apply CLAHE for contrast enhancement
-            clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-            enhanced = clahe.apply(blurred)
-            
-            # Normalize pixel values to 0-1 range
-            normalized = enhanced.astype(np.float32) / 255.0
-            
-            return normalized
+            return self.preprocess_array(image)
             
         except Exception as e:
             print(f"Error preprocessing image {image_path}: {str(e)}")
             return None
     
-    def load_data(self, data_dir):
+    def preprocess_array(self, image):
+        """
+        Preprocess an already decoded image (grayscale or BGR uint8); returns uint8
+        """
+        # Convert to grayscale
+        if len(image.shape) == 3:
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        else:
+            gray = image
+        
+        # Resize, Gaussian blur and CLAHE exactly as the backend does
+        # Kept as uint8: the model's first layer scales to the 0-1 range
+        return preprocess_gray(gray, self.img_size, **self.preprocessing)
+    
+    def list_images(self, data_dir, split='train'):
+        """
+        (path, label) pairs for a split, from the dataset catalog when one exists
+        """
+        return [(path, 1 if label == 'tumor' else 0)
+                for path, label in list_images(data_dir, split)]
+
+    def iter_shards(self, shard_dir, split='train', cycle_length=4):
         """
-        Load and preprocess training data
+        Preprocessed (image, label) pairs streamed from packed shards (see
+        shards.py), reading `cycle_length` shards in parallel
         """
-        print("Loading and preprocessing data...")
+        paths = shard_paths(shard_dir, split)
+        if not paths:
+            raise ValueError(f"No {split} shards found in {shard_dir}")
+        print(f"Reading {len(paths)} {split} shards from {shard_dir}")
+
+        def preprocess(image, label):
+            return self.preprocess_array(image), label
+
+        return interleave(paths, map_fn=preprocess, cycle_length=cycle_length,
+                          flags=cv2.IMREAD_GRAYSCALE)
+    
+    def load_data(self, data_dir, shard_dir=None, split='train'):
+        """
+        Load and preprocess training data, from loose files or from shards
+        """
+        print(f"Loading and preprocessing {split} data...")
         
         images = []
         labels = []
         
-        # Load no_tumor images (label = 0)
-        no_tumor_dir = os.path.join(data_dir, 'train', 'no_tumor')
-        if os.path.exists(no_tumor_dir):
-            for filename in os.listdir(no_tumor_dir):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp')):
-                    image_path = os.path.join(no_tumor_dir, filename)
-                    processed_img = self.preprocess_image(image_path)
-                    if processed_img is not None:
-                        images.append(processed_img)
-                        labels.append(0)
-        
-        # Load tumor images (label = 1)
-        tumor_dir = os.path.join(data_dir, 'train', 'tumor')
-        if os.path.exists(tumor_dir):
-            for filename in os.listdir(tumor_dir):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp')):
-                    image_path = os.path.join(tumor_dir, filename)
-                    processed_img = self.preprocess_image(image_path)
-                    if processed_img is not None:
-                        images.append(processed_img)
-                        labels.append(1)
+        if shard_dir:
+            for processed_img, label in self.iter_shards(shard_dir, split):
+                images.append(processed_img)
+                labels.append(label)
+        else:
+            # Load no_tumor (label = 0) and tumor (label = 1) images
+            for image_path, label in self.list_images(data_dir, split):
+                processed_img = self.preprocess_image(image_path)
+                if processed_img is not None:
+                    images.append(processed_img)
+                    labels.append(label)
         
         if len(images) == 0:
-            raise ValueError("No training images found! Please add images to data/train/no_tumor/ and data/train/tumor/")
+            raise ValueError(f"No {split} images found! Please add images to data/{split}/no_tumor/ and data/{split}/tumor/")
         
-        images = np.array(images)
+        images = np.array(images, dtype=np.uint8)
         labels = np.array(labels)
         
         # Reshape images for CNN (add channel dimension)
         images = images.reshape(images.shape[0], self.img_size[0], self.img_size[1], 1)
         
-        print(f"Loaded {len(images)} training images")
+        print(f"Loaded {len(images)} {split} images "
+              f"({images.nbytes / 2 ** 20:.1f} MB as uint8, {images.nbytes * 4 / 2 ** 20:.1f} MB as float32)")
         print(f"No tumor images: {np.sum(labels == 0)}")
         print(f"Tumor images: {np.sum(labels == 1)}")
         
@@ -124,8 +209,12 @@ class BrainTumorDetector:
         print("Creating model architecture...")
         
         model = Sequential([
+            # uint8 pixels in, scaled to 0-1 inside the model
+            Input(shape=(*self.img_size, 1)),
+            Rescaling(PIXEL_SCALE),
+            
             # First convolutional block
-            Conv2D(32, (3, 3), activation='relu', input_shape=(*self.img_size, 1)),
+            Conv2D(32, (3, 3), activation='relu'),
             BatchNormalization(),
             MaxPooling2D((2, 2)),
             Dropout(0.25),
@@ -176,6 +265,66 @@ class BrainTumorDetector:
         self.model = model
         return model
     
+    def create_student_model(self):
+        """
+        Compact student for distillation: a strided stem, two depthwise-separable
+        blocks and a global-average-pooling head (~6k parameters). No batch
+        normalization: the network is shallow enough without it, and its
+        output then does not depend on moving statistics settling.
+        """
+        print("Creating student architecture...")
+        
+        model = Sequential([
+            Input(shape=(*self.img_size, 1)),
+            Rescaling(PIXEL_SCALE),
+            Conv2D(16, (3, 3), strides=2, activation='relu', padding='same'),
+            SeparableConv2D(32, (3, 3), activation='relu', padding='same'),
+            MaxPooling2D((2, 2)),
+            SeparableConv2D(64, (3, 3), activation='relu', padding='same'),
+            MaxPooling2D((2, 2)),
+            GlobalAveragePooling2D(),
+            Dense(32, activation='relu'),
+            Dropout(0.3),
+            Dense(1, activation='sigmoid')
+        ])
+        return model
+    
+    def distill(self, teacher, X_train, y_train, X_val, y_val, epochs=30, temperature=4.0, alpha=0.3):
+        """
+        Train a student on the teacher's soft predictions (see distillation_loss).
+        The student becomes self.model.
+        """
+        print("Scoring training data with the teacher...")
+        teacher_train = teacher.predict(X_train, batch_size=256, verbose=0).ravel()
+        teacher_val = teacher.predict(X_val, batch_size=256, verbose=0).ravel()
+        
+        student = self.create_student_model()
+        student.compile(
+            optimizer=Adam(learning_rate=0.003),
+            loss=distillation_loss(temperature, alpha)
+        )
+        
+        print(f"Distilling into a student with {student.count_params():,} parameters "
+              f"(temperature {temperature}, alpha {alpha})...")
+        self.history = student.fit(
+            X_train, np.stack([y_train, teacher_train], axis=1),
+            validation_data=(X_val, np.stack([y_val, teacher_val], axis=1)),
+            epochs=epochs,
+            batch_size=self.batch_size,
+            callbacks=[
+                EarlyStopping(patience=5, restore_best_weights=True),
+                ReduceLROnPlateau(factor=0.5, patience=3, min_lr=1e-6)
+            ],
+            verbose=1
+        )
+        
+        # The distillation loss is only needed for training; a plain compile keeps
+        # the saved model loadable without custom objects
+        student.compile(optimizer=Adam(learning_rate=0.001), loss='binary_crossentropy',
+                        metrics=['accuracy'])
+        self.model = student
+        return student
+    
     def train(self, X_train, y_train, X_val, y_val, epochs=100):
         """
         Train the model
@@ -183,7 +332,9 @@ class BrainTumorDetector:
         print("Starting model training...")
         
         # Data augmentation
+        # uint8 batches, so the generator does not keep a float32 copy of the training set
         train_datagen = ImageDataGenerator(
+            dtype='uint8',
             rotation_range=20,
             width_shift_range=0.2,
             height_shift_range=0.2,
@@ -222,12 +373,15 @@ class BrainTumorDetector:
         """
         print("Evaluating model...")
         
-        # Predictions
-        y_pred = self.model.predict(X_test)
-        y_pred_binary = (y_pred > 0.5).astype(int).flatten()
+        # Score once; every metric below is derived from these predictions
+        y_pred = self.model.predict(X_test, batch_size=256, verbose=0).flatten()
+        y_pred_binary = (y_pred > 0.5).astype(int)
         
         # Metrics
-        test_loss, test_accuracy, test_precision, test_recall = self.model.evaluate(X_test, y_test, verbose=0)
+        test_loss = float(log_loss(y_test, np.clip(y_pred, 1e-7, 1 - 1e-7), labels=[0, 1]))
+        test_accuracy = float(accuracy_score(y_test, y_pred_binary))
+        test_precision = float(precision_score(y_test, y_pred_binary, zero_division=0))
+        test_recall = float(recall_score(y_test, y_pred_binary, zero_division=0))
         
         print(f"\nTest Results:")
         print(f"Accuracy: {test_accuracy:.4f}")
@@ -237,7 +391,7 @@ class BrainTumorDetector:
         
         # Classification report
         print("\nClassification Report:")
-        print(classification_report(y_test, y_pred_binary, target_names=['No Tumor', 'Tumor']))
+        print(classification_report(y_test, y_pred_binary, target_names=['No Tumor', 'Tumor'], zero_division=0))
         
         # Confusion matrix
         cm = confusion_matrix(y_test, y_pred_binary)
@@ -308,11 +462,9 @@ class BrainTumorDetector:
             'total_parameters': self.model.count_params(),
             'training_results': results,
             'preprocessing': {
-                'resize': self.img_size,
-                'grayscale': True,
-                'gaussian_blur': True,
-                'clahe': True,
-                'normalization': '0-1'
+                **preprocessing_section(self.img_size, **self.preprocessing),
+                'input_dtype': 'uint8',
+                'normalization': '0-1 (Rescaling layer in the model)'
             }
         }
         
@@ -321,14 +473,127 @@ class BrainTumorDetector:
         
         print("Model information saved to model/model_info.json")
 
+def run_distillation(detector, args, X_train, y_train, X_val, y_val):
+    """
+    Distill the teacher into a student, choose the cascade thresholds on the
+    validation split, report accuracy and throughput on the test split and
+    export the student with its metadata
+    """
+    # Latency is measured the same way as in the architecture search
+    from architecture_search import measure_latency
+
+    if not os.path.exists(args.teacher):
+        raise ValueError(f"No teacher model at {args.teacher}; train one first")
+    teacher = with_input_scaling(tf.keras.models.load_model(args.teacher))
+    if tuple(teacher.input_shape[1:3]) != (detector.img_size[1], detector.img_size[0]):
+        raise ValueError(f"The teacher takes {teacher.input_shape[1]}x{teacher.input_shape[2]} images; "
+                         f"distill at that --img-size")
+    teacher_threshold = DEFAULT_THRESHOLD
+    if os.path.exists(MODEL_INFO_PATH):
+        with open(MODEL_INFO_PATH) as f:
+            teacher_threshold = json.load(f).get('decision_threshold', DEFAULT_THRESHOLD)
+    
+    student = detector.distill(teacher, X_train, y_train, X_val, y_val, epochs=args.distill_epochs,
+                               temperature=args.temperature, alpha=args.alpha)
+    
+    # The student imitates the teacher's probabilities, so it shares its threshold
+    student_val = student.predict(X_val, batch_size=256, verbose=0).ravel()
+    teacher_val = teacher.predict(X_val, batch_size=256, verbose=0).ravel()
+    low, high = cascade_thresholds(student_val, teacher_val >= teacher_threshold,
+                                   threshold=teacher_threshold, min_agreement=args.min_agreement)
+    print(f"Cascade thresholds: student answers p <= {low} or p >= {high}")
+    
+    try:
+        X_test, y_test = detector.load_data(args.data_dir, args.shard_dir, split='test')
+    except ValueError:
+        print("No test split found; reporting on the validation split")
+        X_test, y_test = X_val, y_val
+    teacher_test = teacher.predict(X_test, batch_size=256, verbose=0).ravel()
+    student_test = student.predict(X_test, batch_size=256, verbose=0).ravel()
+    answered = cascade_route(student_test, low, high)
+    cascade_test = np.where(answered, student_test, teacher_test)
+    
+    def accuracy(probs):
+        return float(np.mean((probs >= teacher_threshold) == (y_test == 1)))
+    
+    teacher_speed = measure_latency(teacher, detector.img_size)
+    student_speed = measure_latency(student, detector.img_size)
+    escalation_rate = float(1 - answered.mean())
+    cascade_ms = student_speed['latency_p50_ms'] + escalation_rate * teacher_speed['latency_p50_ms']
+    cascade_throughput = 1 / (1 / student_speed['throughput_images_per_sec'] +
+                              escalation_rate / teacher_speed['throughput_images_per_sec'])
+    report = {
+        'test_images': int(len(y_test)),
+        'teacher_accuracy': accuracy(teacher_test),
+        'student_accuracy': accuracy(student_test),
+        'cascade_accuracy': accuracy(cascade_test),
+        'student_teacher_agreement': float(np.mean(
+            (student_test >= teacher_threshold) == (teacher_test >= teacher_threshold))),
+        'escalation_rate': escalation_rate,
+        'teacher_latency_ms': teacher_speed['latency_p50_ms'],
+        'student_latency_ms': student_speed['latency_p50_ms'],
+        'cascade_latency_ms': cascade_ms,
+        'teacher_throughput': teacher_speed['throughput_images_per_sec'],
+        'student_throughput': student_speed['throughput_images_per_sec'],
+        'cascade_throughput': cascade_throughput
+    }
+    
+    print("\nDistillation Results:")
+    print(f"{'':<10}{'accuracy':>10}{'p50 ms':>10}{'img/s':>10}")
+    for name in ('teacher', 'student', 'cascade'):
+        latency = report[f'{name}_latency_ms']
+        print(f"{name:<10}{report[f'{name}_accuracy']:>10.4f}{latency:>10.2f}"
+              f"{report[f'{name}_throughput']:>10.0f}")
+    print(f"Escalated to the teacher: {escalation_rate:.1%}")
+    print(f"Accuracy retained: {report['cascade_accuracy'] / max(report['teacher_accuracy'], 1e-9):.1%} "
+          f"(student alone {report['student_accuracy'] / max(report['teacher_accuracy'], 1e-9):.1%})")
+    print(f"Throughput gained: {report['teacher_latency_ms'] / cascade_ms:.1f}x per request, "
+          f"{cascade_throughput / report['teacher_throughput']:.1f}x batched")
+    
+    student.save(args.student)
+    save_artifact(student, artifact_path(args.student))
+    merge_model_info(MODEL_INFO_PATH, {'student': {
+        'model_file': os.path.basename(args.student),
+        'total_parameters': student.count_params(),
+        'temperature': args.temperature,
+        'alpha': args.alpha,
+        'threshold': teacher_threshold,
+        'cascade': {'low': low, 'high': high, 'min_agreement': args.min_agreement},
+        'report': report
+    }})
+    print(f"Student saved to {args.student}; cascade thresholds written to {MODEL_INFO_PATH}")
+    print("Run `python cascade.py calibrate` to combine it with the image-statistics stage.")
+    return report
+
 def main():
     """
     Main training function
     """
+    parser = argparse.ArgumentParser(description='Train the brain tumor detection model')
+    parser.add_argument('--data-dir', default='data', help='dataset root directory')
+    parser.add_argument('--shards', dest='shard_dir',
+                        help='read training images from packed shards in this directory '
+                             '(created with `python shards.py convert`)')
+    parser.add_argument('--sync-catalog', action='store_true',
+                        help='add images copied into --data-dir by hand to the dataset catalog first '
+                             '(same as `python catalog.py sync`)')
+    parser.add_argument('--img-size', type=int,
+                        help='input resolution (square; default 128, or the teacher\'s with --distill)')
+    parser.add_argument('--distill', action='store_true',
+                        help='train a compact student from the existing model instead of training the model')
+    parser.add_argument('--teacher', default=MODEL_PATH, help='teacher model for --distill')
+    parser.add_argument('--student', default=STUDENT_MODEL_PATH, help='where --distill saves the student')
+    parser.add_argument('--distill-epochs', type=int, default=30)
+    parser.add_argument('--temperature', type=float, default=4.0, help='softening of the teacher predictions')
+    parser.add_argument('--alpha', type=float, default=0.3, help='weight of the hard labels in the loss')
+    parser.add_argument('--min-agreement', type=float, default=0.99,
+                        help='agreement with the teacher required for the student to answer on its own')
+    args = parser.parse_args()
+    
     print("=== Brain Tumor Detection Model Training ===")
     
     # Check if data directory exists
-    if not os.path.exists('data'):
+    if not args.shard_dir and not os.path.exists(args.data_dir):
         print("Error: Data directory not found!")
         print("Please create the following structure:")
         print("data/")
@@ -340,12 +605,23 @@ def main():
         print("    └── tumor/        # Test images with tumors")
         return
     
-    # Initialize detector
-    detector = BrainTumorDetector(img_size=(128, 128), batch_size=32)
+    # Initialize detector; a student is preprocessed like its teacher
+    if args.distill:
+        options = load_preprocessing_options(MODEL_INFO_PATH)
+    else:
+        options = preprocessing_options()
+    img_size = options.pop('size')
+    if args.img_size:
+        img_size = (args.img_size, args.img_size)
+    detector = BrainTumorDetector(img_size=img_size, batch_size=32, preprocessing=options)
+    print(f"Input size: {img_size[0]}x{img_size[1]}")
     
     try:
+        if args.sync_catalog and not args.shard_dir:
+            sync_catalog(args.data_dir)
+
         # Load training data
-        X, y = detector.load_data('data')
+        X, y = detector.load_data(args.data_dir, args.shard_dir)
         
         # Split data into train and validation
         X_train, X_val, y_train, y_val = train_test_split(
@@ -355,6 +631,11 @@ def main():
         print(f"Training set: {len(X_train)} images")
         print(f"Validation set: {len(X_val)} images")
         
+        if args.distill:
+            run_distillation(detector, args, X_train, y_train, X_val, y_val)
+            print("\n=== Distillation Completed Successfully! ===")
+            return
+        
         # Create model
         model = detector.create_model()
         print(f"Model created with {model.count_params():,} parameters")
@@ -371,8 +652,20 @@ def main():
         # Save model information
         detector.save_model_info(results)
         
+        # Serving artifact of the saved (best) checkpoint, which the backend loads faster
+        saved_model = tf.keras.models.load_model(MODEL_PATH, compile=False)
+        save_artifact(saved_model, artifact_path(MODEL_PATH))
+        
+        # Input statistics of the training data, which the backend's drift monitor compares uploads with
+        scores = saved_model.predict(X_val, batch_size=256, verbose=0).ravel()
+        baseline = build_baseline(X, scores, dataset_sizes(args.data_dir, args.shard_dir),
+                                  model_version=weights_version(saved_model))
+        merge_model_info(MODEL_INFO_PATH, {'drift_baseline': baseline})
+        print(f"Drift baseline saved to {MODEL_INFO_PATH}")
+        
         print("\n=== Training Completed Successfully! ===")
-        print("Model saved to: model/brain_tumor_model.h5")
+        print(f"Model saved to: {MODEL_PATH} (serving artifact: {artifact_path(MODEL_PATH)})")
+        print("Run `python evaluate_model.py` to choose the decision threshold on the test set.")
         print("You can now use this model with the Flask backend.")
         
     except Exception as e:
@@ -0,0 +1,166 @@
+"""
+Test-time augmentation (TTA) for /predict
+
+Instead of the client calling /predict once per augmented copy, the server
+builds flipped and slightly rotated variants of the preprocessed tensor and
+scores them all in one batched forward pass. The variants mirror the training
+augmentation (horizontal flips, small rotations, nearest-pixel fill), so they
+stay within the distribution the model has seen.
+
+Overhead is bounded two ways: TTA_MAX_VARIANTS caps the batch size outright,
+and TTA_MAX_OVERHEAD_MS caps the expected extra latency over a plain
+prediction. The expected overhead is estimated from moving averages of the
+plain and TTA forward passes, which are also reported by /metrics. The
+averages are seeded by a warm-up pass when the model loads; until an estimate
+exists, requests under an overhead budget score the plain image only.
+"""
+
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# (name, horizontal flip, rotation in degrees), most informative first
+VARIANTS = [
+    ('identity', False, 0),
+    ('hflip', True, 0),
+    ('rot+10', False, 10),
+    ('rot-10', False, -10),
+    ('hflip_rot+10', True, 10),
+    ('hflip_rot-10', True, -10),
+    ('rot+5', False, 5),
+    ('rot-5', False, -5)
+]
+MAX_VARIANTS = len(VARIANTS)
+
+EWMA_ALPHA = 0.2
+
+
+def augment_batch(tensor, count):
+    """
+    Stack `count` variants of a preprocessed (1, H, W, 1) tensor into a
+    (count, H, W, 1) batch. Returns (batch, variant names).
+    """
+    image = tensor[0, :, :, 0]
+    height, width = image.shape
+    center = (width / 2 - 0.5, height / 2 - 0.5)
+    batch = np.empty((count, height, width, 1), dtype=tensor.dtype)
+    names = []
+    for i, (name, flip, angle) in enumerate(VARIANTS[:count]):
+        variant = image[:, ::-1] if flip else image
+        if angle:
+            matrix = cv2.getRotationMatrix2D(center, angle, 1.0)
+            variant = cv2.warpAffine(np.ascontiguousarray(variant), matrix, (width, height),
+                                     flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        batch[i, :, :, 0] = variant
+        names.append(name)
+    return batch, names
+
+
+class TestTimeAugmenter:
+    """Runs batched TTA and keeps the latency figures used to bound it"""
+
+    def __init__(self, max_variants=MAX_VARIANTS, default_variants=4, max_overhead_ms=None):
+        self.max_variants = max(1, min(max_variants, MAX_VARIANTS))
+        self.default_variants = max(1, min(default_variants, self.max_variants))
+        self.max_overhead_ms = max_overhead_ms
+        self._lock = threading.Lock()
+        self._plain_ms = None
+        self._variant_ms = None  # extra forward-pass cost per additional variant
+        self._plain_count = 0
+        self._tta_count = 0
+        self._tta_variants = 0
+        self._limited = 0
+
+    def record_plain(self, seconds):
+        """Record the forward-pass time of a plain (single image) prediction"""
+        ms = seconds * 1000
+        with self._lock:
+            self._plain_count += 1
+            self._plain_ms = ms if self._plain_ms is None else \
+                (1 - EWMA_ALPHA) * self._plain_ms + EWMA_ALPHA * ms
+
+    def variant_count(self, requested=None):
+        """Number of variants to score: requested (or default), within the configured bounds"""
+        count = self.default_variants if requested is None else requested
+        count = max(1, min(count, self.max_variants))
+        with self._lock:
+            if self.max_overhead_ms is not None:
+                if self._variant_ms is None:
+                    affordable = 1  # nothing measured yet, so nothing extra is known to fit the budget
+                elif self._variant_ms > 0:
+                    affordable = 1 + int(self.max_overhead_ms / self._variant_ms)
+                else:
+                    affordable = count
+                if affordable < count:
+                    self._limited += 1
+                    count = affordable
+        return count
+
+    def warm_up(self, model):
+        """
+        Seed the latency estimates with one plain and one full-size TTA pass on
+        a blank image, after untimed passes that absorb first-call tracing
+        """
+        tensor = np.zeros((1,) + tuple(model.input_shape[1:]), dtype=np.float32)
+        model.predict(tensor, verbose=0)
+        model.predict(np.repeat(tensor, self.max_variants, axis=0), verbose=0)
+        start = time.perf_counter()
+        model.predict(tensor, verbose=0)
+        self.record_plain(time.perf_counter() - start)
+        if self.max_variants > 1:
+            self.predict(model, tensor, self.max_variants)
+        with self._lock:
+            # warm-up passes are not traffic
+            self._plain_count -= 1
+            if self.max_variants > 1:
+                self._tta_count -= 1
+                self._tta_variants -= self.max_variants
+
+    def predict(self, model, tensor, count):
+        """Score `count` variants of `tensor` in one forward pass"""
+        start = time.perf_counter()
+        batch, names = augment_batch(tensor, count)
+        augmented = time.perf_counter()
+        probabilities = model.predict(batch, verbose=0).ravel().astype(float)
+        finished = time.perf_counter()
+
+        augment_ms = (augmented - start) * 1000
+        inference_ms = (finished - augmented) * 1000
+        with self._lock:
+            self._tta_count += 1
+            self._tta_variants += count
+            baseline = self._plain_ms
+            if baseline is not None and count > 1:
+                per_variant = max(0.0, (augment_ms + inference_ms - baseline) / (count - 1))
+                self._variant_ms = per_variant if self._variant_ms is None else \
+                    (1 - EWMA_ALPHA) * self._variant_ms + EWMA_ALPHA * per_variant
+
+        return {
+            'variants': names,
+            'probabilities': [round(p, 4) for p in probabilities],
+            'mean': round(float(probabilities.mean()), 4),
+            'variance': round(float(probabilities.var()), 6),
+            'std': round(float(probabilities.std()), 4),
+            'latency_ms': {
+                'augment': round(augment_ms, 2),
+                'inference': round(inference_ms, 2),
+                'plain_inference_avg': None if baseline is None else round(baseline, 2),
+                'overhead': None if baseline is None else round(augment_ms + inference_ms - baseline, 2)
+            }
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_variants': self.max_variants,
+                'default_variants': self.default_variants,
+                'max_overhead_ms': self.max_overhead_ms,
+                'plain_predictions': self._plain_count,
+                'plain_inference_ms': None if self._plain_ms is None else round(self._plain_ms, 2),
+                'tta_predictions': self._tta_count,
+                'avg_variants': round(self._tta_variants / self._tta_count, 2) if self._tta_count else None,
+                'per_variant_overhead_ms': None if self._variant_ms is None else round(self._variant_ms, 2),
+                'limited_by_overhead_budget': self._limited
+            }
@@ -0,0 +1,280 @@
+"""
+Streaming upload validation
+
+Werkzeug normally receives the whole multipart body before the application can
+look at it. `ValidatingRequest` hooks into the multipart parser so that every
+uploaded file is inspected as it streams in:
+
+- the filename extension is checked before any file bytes are stored
+- the magic bytes and image header are sniffed from the first chunk
+- width/height are read from the header alone (no pixel decode) and checked
+  against the configured limits
+- the per-file byte limit is enforced while the body is being received
+
+A failing check raises `UploadRejected` from inside the parser, which stops
+reading the request body immediately. When UPLOAD_ABORT_ON_INVALID is False
+(multi-file uploads) the offending file is marked as rejected and its bytes are
+dropped on the floor instead, so the remaining files can still be accepted.
+"""
+
+import struct
+from tempfile import SpooledTemporaryFile
+
+from flask import Request, current_app
+from werkzeug.exceptions import BadRequest
+
+# Bytes needed to find the dimensions. JPEG files may carry large EXIF/ICC
+# segments before the frame header, so allow a generous window for them.
+SNIFF_LIMIT = 256 * 1024
+SPOOL_MAX_SIZE = 500 * 1024
+
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                    0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class UploadRejected(BadRequest):
+    """An upload failed early validation"""
+
+    def __init__(self, description, code=400):
+        super().__init__(description)
+        self.code = code
+
+
+class NeedMoreData(Exception):
+    """The header could not be parsed from the bytes received so far"""
+
+
+def _png_header(data):
+    if len(data) < 24:
+        raise NeedMoreData()
+    if data[12:16] != b'IHDR':
+        raise ValueError('PNG file is missing its IHDR header')
+    width, height = struct.unpack('>II', data[16:24])
+    return width, height
+
+
+def _jpeg_header(data):
+    offset = 2
+    while True:
+        if offset + 4 > len(data):
+            raise NeedMoreData()
+        if data[offset] != 0xFF:
+            raise ValueError('Corrupt JPEG marker stream')
+        marker = data[offset + 1]
+        if marker == 0xFF:  # fill byte
+            offset += 1
+            continue
+        if marker in (0x01,) or 0xD0 <= marker <= 0xD7:  # markers without length
+            offset += 2
+            continue
+        if marker == 0xD9:
+            raise ValueError('JPEG file has no frame header')
+        length = struct.unpack('>H', data[offset + 2:offset + 4])[0]
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(data):
+                raise NeedMoreData()
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + length
+
+
+def _bmp_header(data):
+    if len(data) < 26:
+        raise NeedMoreData()
+    header_size = struct.unpack('<I', data[14:18])[0]
+    if header_size == 12:  # OS/2 BITMAPCOREHEADER
+        width, height = struct.unpack('<HH', data[18:22])
+    else:
+        width, height = struct.unpack('<ii', data[18:26])
+    return abs(width), abs(height)
+
+
+def _tiff_header(data):
+    endian = '<' if data[:2] == b'II' else '>'
+    if len(data) < 8:
+        raise NeedMoreData()
+    ifd = struct.unpack(endian + 'I', data[4:8])[0]
+    if ifd + 2 > len(data):
+        raise NeedMoreData()
+    count = struct.unpack(endian + 'H', data[ifd:ifd + 2])[0]
+    if ifd + 2 + count * 12 > len(data):
+        raise NeedMoreData()
+    width = height = None
+    for i in range(count):
+        entry = ifd + 2 + i * 12
+        tag, field_type = struct.unpack(endian + 'HH', data[entry:entry + 4])
+        if tag not in (256, 257):
+            continue
+        if field_type == 3:  # SHORT
+            value = struct.unpack(endian + 'H', data[entry + 8:entry + 10])[0]
+        else:  # LONG
+            value = struct.unpack(endian + 'I', data[entry + 8:entry + 12])[0]
+        if tag == 256:
+            width = value
+        else:
+            height = value
+    if width is None or height is None:
+        raise ValueError('TIFF file is missing its image dimensions')
+    return width, height
+
+
+def sniff_image_header(data):
+    """
+    Identify the image format from its magic bytes and read its dimensions.
+
+    Returns a dict with 'format', 'width' and 'height' (None when the format
+    does not expose them, e.g. DICOM). Raises NeedMoreData if `data` is too
+    short to decide and ValueError for unsupported or corrupt content.
+    """
+    if len(data) < 4:
+        raise NeedMoreData()
+
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        fmt, parse = 'png', _png_header
+    elif data.startswith(b'\xff\xd8'):
+        fmt, parse = 'jpeg', _jpeg_header
+    elif data.startswith(b'BM'):
+        fmt, parse = 'bmp', _bmp_header
+    elif data.startswith(b'II*\x00') or data.startswith(b'MM\x00*'):
+        fmt, parse = 'tiff', _tiff_header
+    elif len(data) < 132:
+        raise NeedMoreData()
+    elif data[128:132] == b'DICM':
+        return {'format': 'dicom', 'width': None, 'height': None}
+    else:
+        raise ValueError('Unrecognized image format')
+
+    try:
+        width, height = parse(data)
+    except struct.error:
+        raise NeedMoreData()
+    return {'format': fmt, 'width': width, 'height': height}
+
+
+def read_image_header(image_path, limit=SNIFF_LIMIT):
+    """Sniff the header of an image on disk, reading at most `limit` bytes"""
+    with open(image_path, 'rb') as f:
+        data = f.read(limit)
+    try:
+        return sniff_image_header(data)
+    except NeedMoreData:
+        raise ValueError('Truncated image header')
+
+
+def check_dimensions(header, min_dim=None, max_dim=None):
+    """Return an error message if the header dimensions are out of range, else None"""
+    width, height = header['width'], header['height']
+    if width is None or height is None:
+        return None
+    if width == 0 or height == 0:
+        return 'Image has zero width or height'
+    if min_dim and (height < min_dim or width < min_dim):
+        return f'Image too small (minimum {min_dim}x{min_dim} pixels)'
+    if max_dim and (height > max_dim or width > max_dim):
+        return f'Image too large (maximum {max_dim}x{max_dim} pixels)'
+    return None
+
+
+class ValidatingFileStream:
+    """
+    Writable spool handed to the multipart parser for one uploaded file.
+    Validates the header as soon as enough bytes have arrived.
+
+    With `abort=True` a failed check raises UploadRejected and stops reading the
+    request. Otherwise the file is marked with `error`, its remaining bytes are
+    discarded instead of spooled, and the other files in the request proceed.
+    """
+
+    def __init__(self, filename, max_file_size=None, min_dim=None, max_dim=None, abort=True):
+        self.filename = filename
+        self.max_file_size = max_file_size
+        self.min_dim = min_dim
+        self.max_dim = max_dim
+        self.abort = abort
+        self.header = None
+        self.error = None
+        self.error_code = None
+        self.bytes_received = 0
+        self._head = bytearray()
+        self._spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='rb+')
+
+    def reject(self, message, code=400):
+        """Fail validation for this file"""
+        if self.abort:
+            raise UploadRejected(f'{self.filename}: {message}', code)
+        if self.error is None:
+            self.error = message
+            self.error_code = code
+            self._head = bytearray()
+            self._spool.close()
+            self._spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, mode='rb+')
+
+    def write(self, chunk):
+        self.bytes_received += len(chunk)
+        if self.error is not None:
+            return len(chunk)
+        if self.max_file_size and self.bytes_received > self.max_file_size:
+            self.reject(f'file exceeds the {self.max_file_size // (1024 * 1024)}MB limit', 413)
+            return len(chunk)
+        if self.header is None:
+            self._head.extend(chunk[:SNIFF_LIMIT - len(self._head)])
+            self._sniff(final=False)
+            if self.error is not None:
+                return len(chunk)
+        return self._spool.write(chunk)
+
+    def _sniff(self, final):
+        try:
+            self.header = sniff_image_header(bytes(self._head))
+        except NeedMoreData:
+            if final or len(self._head) >= SNIFF_LIMIT:
+                self.reject('could not read image header')
+            return
+        except ValueError as e:
+            self.reject(str(e))
+            return
+
+        error = check_dimensions(self.header, self.min_dim, self.max_dim)
+        if error:
+            self.header = None
+            self.reject(error)
+            return
+        self._head = bytearray()
+
+    def seek(self, *args):
+        # The parser seeks back to the start once the part is complete
+        if self.header is None and self.error is None:
+            self._sniff(final=True)
+        return self._spool.seek(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._spool, name)
+
+
+class ValidatingRequest(Request):
+    """
+    Request class that validates uploads while they stream in. Limits come from
+    the app config: ALLOWED_EXTENSIONS, MAX_FILE_SIZE, MIN_IMAGE_DIMENSION,
+    MAX_IMAGE_DIMENSION and UPLOAD_ABORT_ON_INVALID. Endpoints listed in
+    RAW_UPLOAD_ENDPOINTS (e.g. archive uploads) get Werkzeug's default spooling.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        config = current_app.config
+        if self.endpoint in config.get('RAW_UPLOAD_ENDPOINTS', ()):
+            return super()._get_file_stream(total_content_length, content_type,
+                                            filename, content_length)
+        stream = ValidatingFileStream(
+            filename or 'upload',
+            max_file_size=config.get('MAX_FILE_SIZE'),
+            min_dim=config.get('MIN_IMAGE_DIMENSION'),
+            max_dim=config.get('MAX_IMAGE_DIMENSION'),
+            abort=config.get('UPLOAD_ABORT_ON_INVALID', True)
+        )
+        allowed = config.get('ALLOWED_EXTENSIONS')
+        if filename and allowed:
+            extension = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+            if extension not in allowed:
+                stream.reject('Invalid file type')
+        return stream
@@ -10,6 +10,8 @@ function App() {
   const [isProcessing, setIsProcessing] = useState(false);
   const [predictionResult, setPredictionResult] = useState(null);
   const [error, setError] = useState(null);
+  const [explanation, setExplanation] = useState(null);
+  const [isExplaining, setIsExplaining] = useState(false);
   const [backendStatus, setBackendStatus] = useState('checking'); // 'connected', 'disconnected', 'checking'
 
   // Backend API configuration
@@ -50,6 +52,7 @@ function App() {
     setDetectionStatus('Image Uploaded');
     setError(null);
     setPredictionResult(null);
+    setExplanation(null);
   };
 
   const handleDetection = async () => {
@@ -65,6 +68,7 @@ function App() {
     setIsProcessing(true);
     setDetectionStatus('Processing...');
     setError(null);
+    setExplanation(null);
     
     try {
       // Create FormData for file upload
@@ -104,12 +108,40 @@ function App() {
     }
   };
 
+  // Fetch the Grad-CAM heatmap; the backend reuses the activations from /predict
+  const handleExplain = async () => {
+    if (!uploadedImage) return;
+    
+    setIsExplaining(true);
+    try {
+      const formData = new FormData();
+      formData.append('file', uploadedImage);
+      
+      const response = await fetch(`${API_BASE_URL}/explain`, {
+        method: 'POST',
+        body: formData,
+      });
+      
+      if (!response.ok) {
+        throw new Error(`HTTP error! status: ${response.status}`);
+      }
+      
+      setExplanation(await response.json());
+    } catch (error) {
+      console.error('Error fetching explanation:', error);
+      setExplanation({ error: `Failed to load explanation: ${error.message}` });
+    } finally {
+      setIsExplaining(false);
+    }
+  };
+
   const resetDetection = () => {
     setUploadedImage(null);
     setDetectionStatus('No Image Uploaded');
     setIsProcessing(false);
     setPredictionResult(null);
     setError(null);
+    setExplanation(null);
   };
 
   return (
@@ -171,6 +203,9 @@ function App() {
               predictionResult={predictionResult}
               error={error}
               backendStatus={backendStatus}
+              explanation={explanation}
+              isExplaining={isExplaining}
+              onExplain={handleExplain}
             />
           </div>
         </div>
@@ -98,7 +98,8 @@ const BrainVisualization = ({ status }) => {
   );
 };
 
-const Result = ({ status, isProcessing, uploadedImage, onReset, predictionResult, error, backendStatus }) => {
+const Result = ({ status, isProcessing, uploadedImage, onReset, predictionResult, error, backendStatus,
+                  explanation, isExplaining, onExplain }) => {
   const getStatusMessage = () => {
     switch (status) {
       case 'No Image Uploaded':
@@ -227,6 +228,16 @@ const Result = ({ status, isProcessing, uploadedImage, onReset, predictionResult
           {/* Action buttons */}
           {(status === 'Tumor Detected' || status === 'No Tumor Detected') && (
             <div className="flex space-x-4 justify-center">
+              <button
+                onClick={onExplain}
+                disabled={isExplaining}
+                className="px-6 py-3 bg-white hover:bg-slate-50 text-indigo-700 font-medium 
+                         border border-indigo-200 rounded-lg shadow-sm transition-colors duration-200
+                         disabled:opacity-50 disabled:cursor-not-allowed
+                         focus:outline-none focus:ring-2 focus:ring-indigo-300"
+              >
+                {isExplaining ? 'Loading Heatmap...' : 'Show Heatmap'}
+              </button>
               <button
                 onClick={onReset}
                 className="px-6 py-3 bg-indigo-600 hover:bg-indigo-700 text-white font-medium 
@@ -267,6 +278,26 @@ const Result = ({ status, isProcessing, uploadedImage, onReset, predictionResult
           )}
         </div>
       )}
+
+      {/* Grad-CAM heatmap: regions that drove the prediction */}
+      {(status === 'Tumor Detected' || status === 'No Tumor Detected') && explanation && (
+        <div className="mt-6 text-center">
+          {explanation.error ? (
+            <p className="text-red-600 text-sm">{explanation.error}</p>
+          ) : (
+            <>
+              <img
+                src={explanation.overlay}
+                alt="Grad-CAM heatmap overlay"
+                className="mx-auto rounded-xl border border-slate-200 max-w-full"
+              />
+              <p className="mt-2 text-xs text-slate-500">
+                Red areas contributed most to the prediction.
+              </p>
+            </>
+          )}
+        </div>
+      )}
     </div>
   );
 };